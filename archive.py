@@ -0,0 +1,376 @@
+import os
+import json
+import time
+import gzip
+import fcntl
+import tempfile
+import argparse
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+
+from chunking import count_tokens
+from sheetwriter import category_names
+from metrics import metrics
+
+try:
+    import zstandard
+except ImportError:  # zstandard がない環境では gzip で圧縮する
+    zstandard = None
+
+# 生成結果を追記だけで保存するローカルのアーカイブ
+# 記録は圧縮した JSON Lines のセグメントに1件ずつ独立したフレームとして追記し、
+# ID・日時・カテゴリとセグメント内の位置を固定長の索引に書くので、
+# IDの検索・期間の走査・カテゴリでの絞り込みは索引をメモリマップするだけで、必要な記録だけを展開する
+# （セグメントはフレームを連結しただけなので zstdcat・zcat でもそのまま読める）
+# コールドスタートを速くするため、numpy は索引を読み書きする時にインポートする
+
+# アーカイブのデフォルトの保存先
+DEFAULT_ARCHIVE_DIR = os.path.join(tempfile.gettempdir(), 'autonews_archive')
+# セグメントがこの大きさを超えたら次のセグメントに書く
+ARCHIVE_SEGMENT_BYTES = int(os.getenv('ARCHIVE_SEGMENT_BYTES', 64 * 1024 * 1024))
+# 圧縮形式（'zstd' か 'gzip'）と zstd の圧縮レベル
+ARCHIVE_CODEC = os.getenv('ARCHIVE_CODEC', 'zstd' if zstandard is not None else 'gzip')
+ARCHIVE_ZSTD_LEVEL = int(os.getenv('ARCHIVE_ZSTD_LEVEL', '9'))
+CODEC_EXTENSIONS = {'zstd': '.jsonl.zst', 'gzip': '.jsonl.gz'}
+
+# 索引の1件（ニュースID・記事の日時・保存した日時・カテゴリのビットマスク・セグメント番号・フレームの長さと位置）
+INDEX_FIELDS = [
+    ('id', '<i8'), ('time', '<i8'), ('archived', '<i8'), ('categories', '<u8'),
+    ('segment', '<u4'), ('length', '<u4'), ('offset', '<u8'),
+]
+INDEX_ITEMSIZE = 48
+# カテゴリごとのビット（64個目以降のカテゴリは最後のビットを共有し、絞り込む時に記録の中身で確認する）
+OTHER_CATEGORY_BIT = 63
+# 行の日時の書式（write_to_sheet と同じ）
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+# トークン数を記録する項目
+TOKEN_FIELDS = ('summary', 'opinion', 'lead')
+
+
+# 索引に保存できるニュースID（64ビットの符号付き整数）か確認する関数
+def _check_id(value):
+    if isinstance(value, bool) or not isinstance(value, int) or not -(1 << 63) <= value < 1 << 63:
+        raise ValueError(f"アーカイブのIDは64ビットの整数にしてください: {value!r}")
+    return value
+
+
+def _category_key(name):
+    return str(name).strip().casefold()
+
+
+# パイプラインのニュース（辞書）からアーカイブに保存する記録を作る関数
+def archive_record(item, archived_at=None):
+    archived_at = time.time() if archived_at is None else archived_at
+    tokens = {'input': count_tokens(item.get('page_content'))}
+    tokens.update({field: count_tokens(item.get(field)) for field in TOKEN_FIELDS})
+    return {
+        'id': item['id'],
+        'archived_at': round(archived_at, 3),
+        'time': item.get('time'),
+        'source': item.get('source', 'hn'),
+        'title': item.get('title'),
+        'url': item.get('url'),
+        'summary': item.get('summary'),
+        'opinion': item.get('opinion'),
+        'lead': item.get('lead'),
+        'categories': category_names(item.get('categories')),
+        'duplicate': bool(item.get('duplicate')),
+        'tokens': tokens,
+    }
+
+
+# 記録をスプレッドシートと同じ形の行（日時・要約・意見・カテゴリ・リード文・ニュースID）に変換する関数
+def record_to_row(record):
+    written_at = datetime.fromtimestamp(record['archived_at']).strftime(TIMESTAMP_FORMAT)
+    return [written_at, record['summary'] or '', record['opinion'] or '', ', '.join(record['categories']),
+            record['lead'] or '', record['id']]
+
+
+# 生成結果の追記専用アーカイブ
+# 同じニュースを保存し直した場合は後の記録が有効になる（検索・走査は最後の記録だけを返す）
+# 複数のプロセスからの追記はファイルロックで順番に行う
+class ArticleArchive:
+    def __init__(self, directory=DEFAULT_ARCHIVE_DIR, codec=ARCHIVE_CODEC, segment_bytes=ARCHIVE_SEGMENT_BYTES):
+        if codec not in CODEC_EXTENSIONS:
+            raise ValueError(f"圧縮形式 '{codec}' は使えません（'zstd'・'gzip'）。")
+        if codec == 'zstd' and zstandard is None:
+            raise ValueError("zstd で圧縮するには zstandard をインストールしてください（ARCHIVE_CODEC=gzip でも使えます）。")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.codec = codec
+        self.segment_bytes = segment_bytes
+        self._lock = threading.Lock()
+        self._index_path = os.path.join(directory, 'index.bin')
+        self._categories_path = os.path.join(directory, 'categories.json')
+        self._lock_path = os.path.join(directory, 'archive.lock')
+        self._index = None
+        self._latest = None
+        self._segment_paths = {}
+        self._categories = self._load_categories()
+
+    # ARCHIVE=0 ならアーカイブを使わない
+    @classmethod
+    def from_env(cls):
+        if os.getenv('ARCHIVE', '1') != '1':
+            return None
+        return cls(os.getenv('ARCHIVE_DIR', DEFAULT_ARCHIVE_DIR))
+
+    # ---- 追記 ----
+
+    @contextmanager
+    def _file_lock(self):
+        with open(self._lock_path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _load_categories(self):
+        try:
+            with open(self._categories_path, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+
+    def _save_categories(self):
+        temp_path = self._categories_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._categories, f, ensure_ascii=False)
+        os.replace(temp_path, self._categories_path)
+
+    # カテゴリ名のリストをビットマスクに変換する（追記の時は未登録のカテゴリにビットを割り当てる）
+    def _category_mask(self, names, register=False):
+        mask = 0
+        for name in names:
+            key = _category_key(name)
+            if key not in self._categories and register and len(self._categories) < OTHER_CATEGORY_BIT:
+                self._categories.append(key)
+            mask |= 1 << (self._categories.index(key) if key in self._categories else OTHER_CATEGORY_BIT)
+        return mask
+
+    def _compress(self, data):
+        if self.codec == 'zstd':
+            return zstandard.ZstdCompressor(level=ARCHIVE_ZSTD_LEVEL).compress(data)
+        return gzip.compress(data, mtime=0)
+
+    def _segment_path(self, segment):
+        path = self._segment_paths.get(segment)
+        if path is None:
+            name = f'segment-{segment:06d}'
+            for extension in CODEC_EXTENSIONS.values():
+                if os.path.exists(os.path.join(self.directory, name + extension)):
+                    path = os.path.join(self.directory, name + extension)
+                    break
+            else:
+                path = os.path.join(self.directory, name + CODEC_EXTENSIONS[self.codec])
+            self._segment_paths[segment] = path
+        return path
+
+    # 追記するセグメントを返す（最後のセグメントが大きすぎるか圧縮形式が違えば次のセグメント）
+    def _writable_segment(self):
+        segments = [int(name[len('segment-'):].split('.')[0]) for name in os.listdir(self.directory)
+                    if name.startswith('segment-')]
+        if not segments:
+            return 0
+        segment = max(segments)
+        path = self._segment_path(segment)
+        if not path.endswith(CODEC_EXTENSIONS[self.codec]) or os.path.getsize(path) >= self.segment_bytes:
+            segment += 1
+        return segment
+
+    # 記録をまとめて追記し、追記した件数を返す
+    # 先にセグメントを書いてから索引を書くので、途中で落ちても索引にない書きかけのフレームは読まれない
+    def extend(self, records):
+        import numpy as np
+
+        records = list(records)
+        if not records:
+            return 0
+        # 書き始めてから失敗して索引にないフレームが残らないよう、先にすべてのIDを確認する
+        for record in records:
+            _check_id(record['id'])
+        with metrics.timer('archive_write'), self._lock, self._file_lock():
+            self._categories = self._load_categories()
+            known = len(self._categories)
+            entries = np.zeros(len(records), dtype=INDEX_FIELDS)
+            segment = self._writable_segment()
+            with open(self._segment_path(segment), 'ab') as f:
+                offset = f.seek(0, os.SEEK_END)
+                for entry, record in zip(entries, records):
+                    frame = self._compress(json.dumps(record, ensure_ascii=False).encode('utf-8'))
+                    f.write(frame)
+                    entry['id'] = record['id']
+                    entry['time'] = record.get('time') or 0
+                    entry['archived'] = int(record['archived_at'])
+                    entry['categories'] = self._category_mask(record.get('categories') or [], register=True)
+                    entry['segment'] = segment
+                    entry['length'] = len(frame)
+                    entry['offset'] = offset
+                    offset += len(frame)
+                f.flush()
+                os.fsync(f.fileno())
+            if len(self._categories) > known:
+                self._save_categories()
+            with open(self._index_path, 'ab') as f:
+                # 前回書きかけで落ちた索引の端数は切り捨てる
+                size = f.seek(0, os.SEEK_END)
+                if size % INDEX_ITEMSIZE:
+                    f.truncate(size - size % INDEX_ITEMSIZE)
+                f.write(entries.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+        metrics.incr('archive_records_total', len(records))
+        return len(records)
+
+    def append(self, record):
+        return self.extend([record])
+
+    # ---- 読み出し ----
+
+    # 索引をメモリマップして返す（他のプロセスが追記していれば、増えた分を含めてマップし直す）
+    def _entries(self):
+        import numpy as np
+
+        with self._lock:
+            try:
+                count = os.path.getsize(self._index_path) // INDEX_ITEMSIZE
+            except FileNotFoundError:
+                count = 0
+            if self._index is None or count != len(self._index):
+                if count:
+                    self._index = np.memmap(self._index_path, dtype=INDEX_FIELDS, mode='r', shape=(count,))
+                else:
+                    self._index = np.zeros(0, dtype=INDEX_FIELDS)
+                self._latest = None
+            return self._index
+
+    # 各ニュースIDの最後の記録なら True の配列（索引が変わるまで使い回す）
+    def _latest_mask(self, entries):
+        import numpy as np
+
+        with self._lock:
+            if self._latest is None or len(self._latest) != len(entries):
+                _, last = np.unique(entries['id'][::-1], return_index=True)
+                latest = np.zeros(len(entries), dtype=bool)
+                latest[len(entries) - 1 - last] = True
+                self._latest = latest
+            return self._latest
+
+    # 索引の行の記録を順に読む（記録ごとに独立したフレームなので、その部分だけを読んで展開する）
+    def _read(self, entries):
+        handles = {}
+        try:
+            for entry in entries:
+                segment = int(entry['segment'])
+                if segment not in handles:
+                    handles[segment] = open(self._segment_path(segment), 'rb')
+                f = handles[segment]
+                f.seek(int(entry['offset']))
+                frame = f.read(int(entry['length']))
+                if f.name.endswith(CODEC_EXTENSIONS['zstd']):
+                    data = zstandard.ZstdDecompressor().decompress(frame)
+                else:
+                    data = gzip.decompress(frame)
+                yield json.loads(data)
+        finally:
+            for f in handles.values():
+                f.close()
+
+    def __len__(self):
+        entries = self._entries()
+        return int(self._latest_mask(entries).sum()) if len(entries) else 0
+
+    # ニュースIDの最後の記録を返す（なければ None）
+    def get(self, item_id):
+        import numpy as np
+
+        entries = self._entries()
+        positions = np.flatnonzero(entries['id'] == item_id)
+        if not len(positions):
+            return None
+        return next(self._read(entries[positions[-1:]]))
+
+    # 期間とカテゴリで絞り込んだ記録を保存した順に返す
+    # since・until はUNIX時刻（until は含まない）、by は 'archived'（保存した日時）か 'time'（記事の日時）
+    def scan(self, since=None, until=None, category=None, by='archived', limit=None):
+        import numpy as np
+
+        entries = self._entries()
+        if not len(entries):
+            return
+        selected = self._latest_mask(entries).copy()
+        if since is not None:
+            selected &= entries[by] >= int(since)
+        if until is not None:
+            selected &= entries[by] < int(until)
+        verify = None
+        if category is not None:
+            key = _category_key(category)
+            if key not in self._categories:
+                self._categories = self._load_categories()
+            if key in self._categories:
+                bit = self._categories.index(key)
+            elif len(self._categories) >= OTHER_CATEGORY_BIT:
+                bit, verify = OTHER_CATEGORY_BIT, key
+            else:
+                return
+            selected &= (entries['categories'] & np.uint64(1 << bit)) != 0
+        count = 0
+        for record in self._read(entries[np.flatnonzero(selected)]):
+            if verify is not None and verify not in map(_category_key, record['categories']):
+                continue
+            yield record
+            count += 1
+            if limit is not None and count >= limit:
+                return
+
+    def stats(self):
+        entries = self._entries()
+        segments = sorted({int(segment) for segment in entries['segment']}) if len(entries) else []
+        return {
+            'records': len(self),
+            'index_entries': len(entries),
+            'segments': len(segments),
+            'segment_bytes': sum(os.path.getsize(self._segment_path(segment)) for segment in segments),
+            'index_bytes': len(entries) * INDEX_ITEMSIZE,
+            'categories': len(self._load_categories()),
+            'first_archived': int(entries['archived'].min()) if len(entries) else None,
+            'last_archived': int(entries['archived'].max()) if len(entries) else None,
+        }
+
+
+def _parse_date(value):
+    return datetime.fromisoformat(value).timestamp() if value else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='生成結果のアーカイブを検索する')
+    parser.add_argument('--dir', default=os.getenv('ARCHIVE_DIR', DEFAULT_ARCHIVE_DIR), help='アーカイブのディレクトリ')
+    commands = parser.add_subparsers(dest='command', required=True)
+    get_parser = commands.add_parser('get', help='ニュースIDの記録を表示する')
+    get_parser.add_argument('item_id', type=int)
+    scan_parser = commands.add_parser('scan', help='期間とカテゴリで絞り込んだ記録を JSON Lines で出力する')
+    scan_parser.add_argument('--since', help='開始日時（ISO形式、例: 2024-01-01）')
+    scan_parser.add_argument('--until', help='終了日時（ISO形式、この日時は含まない）')
+    scan_parser.add_argument('--days', type=float, help='直近の日数（--since の代わり）')
+    scan_parser.add_argument('--category', help='カテゴリ名')
+    scan_parser.add_argument('--by', default='archived', choices=['archived', 'time'], help='期間を判定する日時')
+    scan_parser.add_argument('--limit', type=int, help='最大件数')
+    commands.add_parser('stats', help='記録数とファイルの大きさを表示する')
+    args = parser.parse_args()
+
+    archive = ArticleArchive(args.dir)
+    if args.command == 'get':
+        print(json.dumps(archive.get(args.item_id), ensure_ascii=False, indent=2))
+    elif args.command == 'scan':
+        since = time.time() - args.days * 24 * 60 * 60 if args.days is not None else _parse_date(args.since)
+        for record in archive.scan(since, _parse_date(args.until), args.category, args.by, args.limit):
+            print(json.dumps(record, ensure_ascii=False))
+    else:
+        print(json.dumps(archive.stats(), indent=2))
+
+
+if __name__ == '__main__':
+    main()
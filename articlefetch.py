@@ -0,0 +1,331 @@
+import os
+import re
+import atexit
+import time
+import socket
+import sqlite3
+import asyncio
+import tempfile
+import ipaddress
+import threading
+from urllib.parse import urlsplit, urljoin
+
+from chunking import truncate_tokens, CHUNK_TOKENS
+from metrics import metrics
+
+# aiohttp と lxml は最初の取得時にインポートする（コールドスタートを遅くしないため）
+
+# '0' にするとリンク先の記事を取得せず、HNの内容だけを要約する
+ARTICLE_FETCH = os.getenv('ARTICLE_FETCH', '1') == '1'
+
+# レスポンスキャッシュのデフォルトの保存先
+DEFAULT_ARTICLE_CACHE_PATH = os.path.join(tempfile.gettempdir(), 'autonews_articles.sqlite3')
+# キャッシュした本文を再検証なしで使う秒数
+DEFAULT_FRESH_SECONDS = 60 * 60
+# キャッシュを残す秒数
+DEFAULT_MAX_AGE = 7 * 24 * 60 * 60
+# ダウンロードするレスポンスの上限バイト数（超えた分は読まずに打ち切る）
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024
+# 要約に渡す本文の上限トークン数（1チャンクに収め、まとめて生成するモードでも使えるようにする）
+DEFAULT_MAX_TOKENS = CHUNK_TOKENS
+# たどるリダイレクトの最大回数（リダイレクト先も毎回アドレスを確認する）
+MAX_REDIRECTS = 5
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+# '1' にするとプライベート・ループバック・リンクローカルのアドレスにも接続する（ローカルの代替サーバー用）
+# 投稿やフィードのURLは誰でも指定できるので、通常はメタデータサーバー（169.254.169.254）や
+# 社内ネットワークに届かないよう、公開アドレス以外への接続を拒否する
+ARTICLE_ALLOW_PRIVATE = os.getenv('ARTICLE_ALLOW_PRIVATE', '0') == '1'
+
+# 本文として扱うContent-Type
+TEXT_TYPES = ('text/html', 'application/xhtml+xml', 'text/plain')
+# 本文の抽出前に取り除く要素
+BOILERPLATE_TAGS = ('script', 'style', 'noscript', 'nav', 'header', 'footer', 'aside', 'form',
+                    'iframe', 'svg', 'button', 'figure')
+# 段落として扱う要素
+BLOCK_TAGS = ('p', 'h1', 'h2', 'h3', 'h4', 'li', 'pre', 'blockquote')
+# 本文の候補になる要素
+CONTAINER_XPATH = '//article | //main | //*[@role="main"] | //div | //section'
+
+USER_AGENT = 'autonews-article-fetcher/1.0 (+https://news.ycombinator.com)'
+
+
+def _normalize_space(text):
+    return re.sub(r'[ \t\r\f\v]+', ' ', text).strip()
+
+
+# 接続してよい（インターネット上の公開）アドレスか
+def is_public_address(address):
+    try:
+        ip = ipaddress.ip_address(address.split('%', 1)[0])
+    except ValueError:
+        return False
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+# 取得してよいURLか確認する関数（http・https 以外と、公開アドレス以外のIPアドレスを直接指定したURLを拒否する）
+# ホスト名のURLは、名前解決の結果を PublicResolver で確認する
+def check_url(url, allow_private=False):
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ValueError(f'unsupported URL: {url}')
+    if allow_private:
+        return
+    try:
+        ipaddress.ip_address(parts.hostname.split('%', 1)[0])
+    except ValueError:
+        return
+    if not is_public_address(parts.hostname):
+        raise ValueError(f'refusing to fetch non-public address: {url}')
+
+
+# 名前解決の結果から公開アドレス以外を除くリゾルバ（接続の直前に確認するので、DNSの書き換えでもすり抜けない）
+def public_resolver():
+    from aiohttp.resolver import DefaultResolver
+
+    class PublicResolver(DefaultResolver):
+        async def resolve(self, host, port=0, family=socket.AF_INET):
+            addresses = [address for address in await super().resolve(host, port, family)
+                         if is_public_address(address['host'])]
+            if not addresses:
+                raise OSError(f'{host} resolves only to non-public addresses')
+            return addresses
+
+    return PublicResolver()
+
+
+# HTMLの木から本文らしい部分のテキストを取り出す関数
+# 段落のテキスト量が最も多い要素を本文とみなす（リンクだらけの要素は減点する）
+def extract_main_text(root):
+    if root is None:
+        return ''
+    for element in root.xpath('|'.join(f'//{tag}' for tag in BOILERPLATE_TAGS)):
+        element.drop_tree()
+
+    best, best_score = None, 0
+    for container in root.xpath(CONTAINER_XPATH):
+        paragraphs = [p for p in container.iterchildren(*BLOCK_TAGS)]
+        if not paragraphs:
+            continue
+        text_length = sum(len(p.text_content()) for p in paragraphs)
+        link_length = sum(len(a.text_content()) for a in container.iter('a'))
+        score = text_length - link_length
+        if container.tag in ('article', 'main'):
+            score *= 1.5
+        if score > best_score:
+            best, best_score = container, score
+
+    if best is None:
+        body = root.find('body')
+        return _normalize_space((body if body is not None else root).text_content())
+    blocks = (_normalize_space(element.text_content()) for element in best.iter(*BLOCK_TAGS))
+    return '\n\n'.join(block for block in blocks if block)
+
+
+# URLごとに検証用ヘッダ（ETag・Last-Modified）と抽出済みの本文を保存するキャッシュ
+class ResponseCache:
+    def __init__(self, path=DEFAULT_ARTICLE_CACHE_PATH, max_age=DEFAULT_MAX_AGE):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            ' url TEXT PRIMARY KEY,'
+            ' etag TEXT,'
+            ' last_modified TEXT,'
+            ' text TEXT NOT NULL,'
+            ' fetched_at REAL NOT NULL)'
+        )
+        if max_age:
+            self._conn.execute('DELETE FROM responses WHERE fetched_at < ?', (time.time() - max_age,))
+
+    def get(self, url):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT etag, last_modified, text, fetched_at FROM responses WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return None
+        return {'etag': row[0], 'last_modified': row[1], 'text': row[2], 'fetched_at': row[3]}
+
+    def set(self, url, text, etag=None, last_modified=None):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO responses (url, etag, last_modified, text, fetched_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (url, etag, last_modified, text, time.time()),
+            )
+
+    # 304 Not Modified の時は取得時刻だけを更新する
+    def touch(self, url):
+        with self._lock:
+            self._conn.execute('UPDATE responses SET fetched_at = ? WHERE url = ?', (time.time(), url))
+
+    def close(self):
+        self._conn.close()
+
+
+# ニュースのリンク先の記事を取得し、本文を抽出するクラス
+# 接続をプールした aiohttp のセッションを専用のイベントループで動かすので、
+# 同期版のパイプラインのワーカースレッドからも非同期版からも同じ接続を共有できる
+class ArticleFetcher:
+    def __init__(self, cache=None, max_connections=20, per_host=2, timeout=10,
+                 max_bytes=DEFAULT_MAX_BYTES, max_tokens=DEFAULT_MAX_TOKENS,
+                 fresh_seconds=DEFAULT_FRESH_SECONDS, allow_private=ARTICLE_ALLOW_PRIVATE):
+        self.cache = cache
+        self.max_connections = max_connections
+        self.per_host = per_host
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.max_tokens = max_tokens
+        self.fresh_seconds = fresh_seconds
+        self.allow_private = allow_private
+        self.request_count = 0
+        self._loop = None
+        self._session = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        cache_path = os.getenv('ARTICLE_CACHE_PATH', DEFAULT_ARTICLE_CACHE_PATH)
+        return cls(
+            cache=ResponseCache(cache_path) if cache_path else None,
+            max_connections=int(os.getenv('ARTICLE_MAX_CONNECTIONS', '20')),
+            per_host=int(os.getenv('ARTICLE_PER_HOST', '2')),
+            timeout=float(os.getenv('ARTICLE_TIMEOUT', '10')),
+            max_bytes=int(os.getenv('ARTICLE_MAX_BYTES', DEFAULT_MAX_BYTES)),
+            max_tokens=int(os.getenv('ARTICLE_MAX_TOKENS', DEFAULT_MAX_TOKENS)),
+            fresh_seconds=float(os.getenv('ARTICLE_FRESH_SECONDS', DEFAULT_FRESH_SECONDS)),
+        )
+
+    # 専用のイベントループを（初回だけ）バックグラウンドのスレッドで起動する
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='article-fetcher', daemon=True).start()
+                self._loop = loop
+                # 終了時にセッションを閉じて接続を解放する
+                atexit.register(self.close)
+        return self._loop
+
+    def _get_session(self):
+        if self._session is None:
+            import aiohttp
+
+            connector = aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.per_host,
+                                             resolver=None if self.allow_private else public_resolver())
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={'User-Agent': USER_AGENT, 'Accept': 'text/html,application/xhtml+xml'},
+            )
+        return self._session
+
+    # レスポンスを少しずつ読みながら lxml のパーサーに流し込み、上限バイト数で打ち切る
+    async def _parse_stream(self, response):
+        from lxml import html as lxml_html
+
+        content_type = response.headers.get('Content-Type', '')
+        if content_type.split(';')[0].strip().lower() == 'text/plain':
+            data = bytearray()
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                data.extend(chunk[:self.max_bytes - len(data)])
+                if len(data) >= self.max_bytes:
+                    break
+            return bytes(data).decode(response.charset or 'utf-8', errors='replace')
+
+        # 文字コードがヘッダにない場合は lxml に meta タグから判定させる
+        parser = lxml_html.HTMLParser(encoding=response.charset, remove_comments=True)
+        received = 0
+        async for chunk in response.content.iter_chunked(64 * 1024):
+            chunk = chunk[:self.max_bytes - received]
+            parser.feed(chunk)
+            received += len(chunk)
+            if received >= self.max_bytes:
+                metrics.incr('article_truncated_total')
+                break
+        if not received:
+            return ''
+        return extract_main_text(parser.close())
+
+    async def _fetch(self, url):
+        cached = self.cache.get(url) if self.cache else None
+        if cached and time.time() - cached['fetched_at'] < self.fresh_seconds:
+            metrics.incr('article_requests_total', result='fresh')
+            return cached['text']
+
+        headers = {}
+        if cached and cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached and cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+
+        session = self._get_session()
+        # リダイレクトは自分でたどり、移動先のURLも確認する
+        target = url
+        for _ in range(MAX_REDIRECTS + 1):
+            check_url(target, self.allow_private)
+            self.request_count += 1
+            async with session.get(target, headers=headers, allow_redirects=False) as response:
+                location = response.headers.get('Location')
+                if response.status in REDIRECT_STATUSES and location:
+                    target = urljoin(str(response.url), location)
+                    continue
+                if response.status == 304 and cached:
+                    metrics.incr('article_requests_total', result='not_modified')
+                    self.cache.touch(url)
+                    return cached['text']
+                response.raise_for_status()
+                content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+                if content_type and content_type not in TEXT_TYPES:
+                    metrics.incr('article_requests_total', result='skipped')
+                    return None
+                text = truncate_tokens(await self._parse_stream(response), self.max_tokens)
+                etag = response.headers.get('ETag')
+                last_modified = response.headers.get('Last-Modified')
+                break
+        else:
+            raise ValueError(f'too many redirects: {url}')
+        metrics.incr('article_requests_total', result='fetched')
+        if self.cache:
+            self.cache.set(url, text, etag, last_modified)
+        return text
+
+    async def _fetch_safe(self, url):
+        if not url or urlsplit(url).scheme not in ('http', 'https'):
+            return None
+        try:
+            return await self._fetch(url)
+        except Exception as e:
+            print(f"Error fetching article {url}: {e}")
+            metrics.incr('article_requests_total', result='error')
+            return None
+
+    # 記事の本文を取得する（取得できなければ None）
+    def fetch(self, url):
+        future = asyncio.run_coroutine_threadsafe(self._fetch_safe(url), self._ensure_loop())
+        return future.result()
+
+    # fetch の非同期版
+    async def afetch(self, url):
+        future = asyncio.run_coroutine_threadsafe(self._fetch_safe(url), self._ensure_loop())
+        return await asyncio.wrap_future(future)
+
+    def close(self):
+        if self._loop is None:
+            return
+        if self._session is not None:
+            asyncio.run_coroutine_threadsafe(self._session.close(), self._loop).result()
+            self._session = None
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop = None
+
+
+# ニュースの内容にリンク先の記事本文を加える関数
+# HNのタイトルやテキストに記事の本文を続け、要約の材料にする
+def with_article_text(item, article_text):
+    if not article_text:
+        return item
+    item['page_content'] = '\n\n'.join(part for part in (item['page_content'], article_text) if part)
+    return item
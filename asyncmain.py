@@ -1,10 +1,23 @@
 import os
 import requests
 import traceback
-from langchain.document_loaders import HNLoader
 from langchain.chat_models import ChatOpenAI
 from langchain.chains import create_extraction_chain
 import openai
+from llm import achat_completion, acached_extraction
+from hnsource import HNItemSource
+from metrics import metrics, timed
+from sheetwriter import format_categories
+from chunking import amap_reduce_summarize
+from enrich import ENRICH_MODE, ENRICHMENT_FIELDS, aenrich_content, require
+from dedup import DedupIndex
+from statestore import StateStore, RETRY_MAX_ATTEMPTS
+from categorizer import category_engine
+from articlefetch import ARTICLE_FETCH, ArticleFetcher, with_article_text
+from routing import model_router
+from sources import IngestScheduler
+from archive import ArticleArchive, archive_record
+from pipeline import AsyncPipeline, Stage, stage_workers, shutdown
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 from datetime import datetime
@@ -12,6 +25,27 @@ import asyncio
 
 # 最後に確認したニュースのID
 last_checked_id = None
+# 同時に処理するニュースの最大数
+MAX_CONCURRENCY = int(os.getenv('HN_MAX_CONCURRENCY', '5'))
+# 1回の実行で処理するニュースの最大数
+MAX_ITEMS = int(os.getenv('HN_MAX_ITEMS', '30'))
+# 新着ニュースの取得元（接続を使い回すためモジュールで共有）
+hn_source = HNItemSource()
+# HNの新着・トップページ・RSS/Atom フィードから処理するニュースを選ぶスケジューラ（INGEST_SOURCES で設定する）
+ingest_scheduler = IngestScheduler.from_env()
+# ほぼ同じ記事を検出するための指紋インデックス
+dedup_index = DedupIndex.from_env()
+
+# ステージの出力と再試行キューを保存するローカルの状態ストア
+state_store = StateStore.from_env()
+
+# 生成結果を保存するローカルのアーカイブ（ARCHIVE=0 で無効）
+article_archive = ArticleArchive.from_env()
+# スプレッドシートにも書き出すかどうか（'0' ならアーカイブだけに保存する）
+SHEET_EXPORT = os.getenv('SHEET_EXPORT', '1') == '1'
+
+# リンク先の記事本文の取得元（接続とレスポンスキャッシュを共有する）
+article_fetcher = ArticleFetcher.from_env() if ARTICLE_FETCH else None
 # OpenAI APIキーの取得
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
@@ -25,79 +59,102 @@ schema = {
     "required": ["category1"]
 }
 
-# OpenAI APIを呼び出す関数
-def openai_api_call(model, temperature, messages):
+# OpenAI APIを非同期で呼び出す関数（イベントループをブロックしない）
+async def openai_api_call(model, temperature, messages):
     try:
-        response = openai.ChatCompletion.create(
-            model=model,
-            temperature=temperature,
-            messages=messages
-        )
-        return response.choices[0].message['content']
+        response = await achat_completion(model, temperature, messages)
+        return response['content']
     except Exception as e:
         print(f"Error in OpenAI API call: {e}")
         traceback.print_exc()
         return None
 
 # カテゴリー作成関数
+@timed('category')
 async def generate_category(content):
+    # 埋め込みで十分な確信度が得られれば、LLMを呼ばずに固定のカテゴリ一覧から割り当てる
+    if category_engine is not None:
+        try:
+            categories = await asyncio.to_thread(category_engine.assign, content)
+            if categories:
+                return categories
+        except Exception as e:
+            print(f"Error in embedding category assignment: {e}")
     try:
-        # LLM (Language Model) を初期化
-        llm = ChatOpenAI(temperature=0, model="gpt-3.5-turbo")
-        # 抽出チェーンを作成
-        chain = create_extraction_chain(schema, llm)
-        # チェーンを実行
-        extracted_categories = await chain.run(f"あなたは優秀なカテゴリ生成アシスタントです。提供された文章をもとに、カテゴリ(2個から3個)を生成してください。\n\n{content}")
+        prompt = f"あなたは優秀なカテゴリ生成アシスタントです。提供された文章をもとに、カテゴリ(2個から3個)を生成してください。\n\n{content}"
+
+        async def run():
+            # LLM (Language Model) を初期化
+            llm = ChatOpenAI(temperature=0, model="gpt-3.5-turbo")
+            # 抽出チェーンを作成
+            chain = create_extraction_chain(schema, llm)
+            # チェーンを実行
+            return await chain.arun(prompt)
+
+        # 同じ内容なら前回の抽出結果をキャッシュから再利用
+        extracted_categories = await acached_extraction("gpt-3.5-turbo", schema, prompt, run)
         return extracted_categories
     except Exception as e:
         print(f"Error in category generation: {e}")
         traceback.print_exc()
         return "カテゴリを生成できませんでした"
 
-# リード文作成関数
+# リード文作成関数（意見と同じく、品質チェックに通らなければ大きなモデルに切り替える）
+@timed('lead')
 async def generate_lead(content):
     try:
-        lead = openai_api_call(
-        "gpt-3.5-turbo-0613",
+        lead = await model_router.acomplete(
+        'lead',
         0.6,
         [
             {"role": "system", "content": "あなたは優秀なリード文生成アシスタントです。提供された文章をもとに、日本語のリード文を生成してください。"},
             {"role": "user", "content": content}
-        ]
-    )
+        ],
+        openai_api_call,
+        )
         return lead
     except Exception as e:
         print(f"Error in lead generation: {e}")
         traceback.print_exc()
         return "リード文を生成できませんでした"
 
-# 要約用の関数
-async def summarize_content(content):
-    try:
-        summary = openai_api_call(
-        "gpt-3.5-turbo-16k-0613",
+# 文章の一部（チャンク）を要約する関数（トークン数がコンテキストに収まる最も速いモデルを使う）
+@timed('summarize_chunk')
+async def summarize_chunk(content):
+    return await model_router.acomplete(
+        'summarize',
         0,
         [
             {"role": "system", "content": "あなたは優秀な要約アシスタントです。提供された文章をもとに、できる限り正確な内容にすることを意識して要約してください。"},
             {"role": "user", "content": content}
-        ]
-        )
+        ],
+        openai_api_call,
+    )
+
+
+# 要約用の関数（長い文章はトークン数で分割して並行に要約し、最後にまとめる）
+@timed('summarize')
+async def summarize_content(content):
+    try:
+        summary = await amap_reduce_summarize(content, summarize_chunk)
         return summary
     except Exception as e:
         print(f"Error in summarization: {e}")
         traceback.print_exc()
         return "要約できませんでした"
 
-# 意見生成用の関数
+# 意見生成用の関数（速いモデルから試し、短すぎる・日本語でない場合は gpt-4 に切り替える）
+@timed('opinion')
 async def generate_opinion(content):
     try:
-        opinion = openai_api_call(
-        "gpt-4",
+        opinion = await model_router.acomplete(
+        'opinion',
         0.6,
         [
             {"role": "system", "content": "あなたは優秀な意見生成アシスタントです。提供された文章をもとに、感想や意見を生成してください。"},
             {"role": "user", "content": content}
-        ]
+        ],
+        openai_api_call,
         )
         return opinion
     except Exception as e:
@@ -106,7 +163,8 @@ async def generate_opinion(content):
         return "意見を生成できませんでした"
 
 # スプレッドシートへの書き込み関数
-def write_to_sheet(summary, opinion, categories, lead):
+@timed('sheets_write')
+def write_to_sheet(summary, opinion, categories, lead, item_id=None):
     creds = None
     # トークンの読み込み
     if os.path.exists('token.json'):
@@ -121,57 +179,143 @@ def write_to_sheet(summary, opinion, categories, lead):
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
     # データの書き込み
-    values = [[now, summary, opinion, ", ".join(categories), lead]]
+    values = [[now, summary, opinion, format_categories(categories), lead, item_id]]
     body = {'values': values}
     result = service.spreadsheets().values().append(
         spreadsheetId=SPREADSHEET_ID, range=RANGE_NAME,
         valueInputOption='RAW', body=body).execute()
     print(result)
 
-# 新しいHacker Newsのコンテンツを確認する関数
-async def check_new_hn_content():
-    global last_checked_id
-    try:
-        # Hacker Newsのトップページをロード
-        loader = HNLoader("https://news.ycombinator.com/")
-        data = await loader.load()
+# ---- パイプラインのステージ ----
+# 各ステージは1件のニュース（辞書）を受け取り、生成した項目を追加して次のステージに渡す
+# 各ステージの出力は状態ストアに保存し、失敗したニュースは次回、保存済みの続きから処理する
+
+# 生成結果を検証してチェックポイントに保存する（失敗していれば例外で再試行キューに回す）
+def checkpoint(item, field, value):
+    item[field] = require(value, field)
+    state_store.save_checkpoint(item['id'], field, item[field])
+
+
+# 取得ステージ：IDからニュースの内容を取得する（ブロッキングなのでスレッドで実行、削除済みなら除外、フィードの記事は内容が渡される）
+# 途中まで処理したニュースは、保存済みの内容と生成結果から再開する
+async def fetch_stage(value):
+    item_id = value['id'] if isinstance(value, dict) else value
+    saved = state_store.checkpoints(item_id)
+    if 'document' in saved:
+        item = saved.pop('document')
+        item.update(saved)
+        item['resumed'] = True
+        return item
+    # フィードの記事は取得済みの内容をそのまま使う（内容を保存する前に失敗したフィードの記事は再取得できない）
+    if isinstance(value, dict):
+        return value
+    if item_id < 0:
+        return None
+    return await asyncio.to_thread(hn_source.fetch_document, item_id)
+
+
+# 記事ステージ：リンク先の記事本文を取得して要約の材料に加える（取得できなければHNの内容だけを使う）
+async def article_stage(item):
+    if item.get('resumed'):
+        return item
+    if article_fetcher is not None and item.get('url'):
+        with_article_text(item, await article_fetcher.afetch(item['url']))
+    state_store.save_checkpoint(item['id'], 'document', item)
+    return item
 
-        # 最新のニュースアイテムのIDを取得
-        new_id = data[0]['id']
-        max_checked_id = last_checked_id  # 最大の確認済みニュースIDを保持する変数
 
-        # 新しいニュースがあるか確認
-        if new_id > last_checked_id:
-            # 新しいニュースアイテムを処理
-            for item in data:
-                # 現在のニュースアイテムのIDを取得
-                current_id = item['id']
+# 要約ステージ：重複記事の再利用・まとめて生成・要約のいずれかを行う
+async def summarize_stage(item):
+    if 'summary' in item:
+        return item
+    full_content = item['page_content']
 
-                # 前回チェックしたID + 1 から最新のニュースIDまで処理
-                if last_checked_id < current_id <= new_id:
-                    full_content = item['page_content']
+    # ほぼ同じ記事を処理済みなら、その生成結果を再利用してLLMの呼び出しを省く
+    duplicate = dedup_index.find(full_content)
+    if duplicate:
+        enriched = duplicate['enrichment']
+    # まとめて生成するモードなら1回の呼び出しで全項目を生成
+    elif ENRICH_MODE == 'combined':
+        enriched = await aenrich_content(full_content, schema)
+    else:
+        enriched = None
+    item['duplicate'] = bool(duplicate)
+    if enriched:
+        for field in ENRICHMENT_FIELDS:
+            checkpoint(item, field, enriched[field])
+    else:
+        # 内容を要約
+        checkpoint(item, 'summary', await summarize_content(full_content))
+    return item
 
-                    # 内容を要約
-                    summary = await summarize_content(full_content)
 
-                    # 意見を生成
-                    opinion = await generate_opinion(summary)
+# 生成ステージ：意見・リード文・カテゴリのうち未生成のものを要約から同時に生成し、
+# 生成結果を重複判定用に登録する
+async def annotate_stage(item):
+    generators = {'opinion': generate_opinion, 'lead': generate_lead, 'categories': generate_category}
+    missing = [field for field in generators if field not in item]
+    values = await asyncio.gather(*(generators[field](item['summary']) for field in missing))
+    for field, value in zip(missing, values):
+        checkpoint(item, field, value)
+    # 次に同じ記事が来た時のために生成結果を登録
+    if not item.get('duplicate'):
+        dedup_index.add(item['id'], item['page_content'], {field: item[field] for field in ENRICHMENT_FIELDS})
+    return item
 
-                    # リード文を生成
-                    lead = await generate_lead(summary)
 
-                    # カテゴリを生成
-                    categories = await generate_category(full_content)
+# 書き込みステージ：アーカイブとスプレッドシートへの書き込みはブロッキングなのでスレッドで実行
+async def sink_stage(item):
+    if article_archive is not None:
+        await asyncio.to_thread(lambda: article_archive.append(archive_record(item)))
+    if SHEET_EXPORT:
+        await asyncio.to_thread(
+            write_to_sheet, item['summary'], item['opinion'], item['categories'], item['lead'], item['id'])
+    return item['id']
 
-                    # スプレッドシートに要約と意見を書き込む
-                    write_to_sheet(summary, opinion, categories, lead)
 
-                    # 最大の確認済みニュースIDを更新
-                    max_checked_id = max(max_checked_id, current_id)
+# ステージとワーカー数（PIPELINE_<NAME>_WORKERS で変更できる）
+def build_pipeline():
+    return AsyncPipeline([
+        Stage('fetch', fetch_stage, stage_workers('fetch', hn_source.max_workers)),
+        Stage('article', article_stage, stage_workers('article', 8)),
+        Stage('summarize', summarize_stage, stage_workers('summarize', MAX_CONCURRENCY)),
+        Stage('annotate', annotate_stage, stage_workers('annotate', MAX_CONCURRENCY)),
+        Stage('sink', sink_stage, stage_workers('sink', 1)),
+    ])
+
+
+# 失敗したニュースを再試行キューに入れる関数
+def retry_failures(failed):
+    for item_id, (stage, error) in failed.items():
+        if not state_store.enqueue_retry(item_id, stage, error):
+            print(f"Giving up on item {item_id} after {RETRY_MAX_ATTEMPTS} attempts: {error}")
+
+
+# 新しいHacker Newsのコンテンツを確認する関数（処理したニュースの件数を返す）
+async def check_new_hn_content():
+    global last_checked_id
+    try:
+        # 再試行の時刻になった失敗済みのニュースと、各ソースの未処理のニュースを優先度順に取得
+        # （ブロッキングなのでスレッドで実行）
+        retry_ids = state_store.due_retries(MAX_ITEMS)
+        batch = await asyncio.to_thread(
+            ingest_scheduler.next_batch, hn_source, state_store, last_checked_id, retry_ids, MAX_ITEMS)
+
+        # 取得・生成・書き込みの各ステージを並行に流す（停止の指示があれば投入済みのニュースだけを処理する）
+        result = await build_pipeline().run(batch.items, stop=shutdown)
 
-            # 最後に確認したニュースのIDを更新
-            last_checked_id = max_checked_id
+        # 書き込めたニュースは完了、失敗したニュースは再試行キューに回す（スプレッドシートには書かない）
+        state_store.mark_done(*result.completed)
+        retry_failures(result.failed)
 
+        # 失敗したニュースは再試行キューから処理するので、取得したIDはすべて確認済みにする
+        # 上限や予算、停止の指示で処理しなかった新着があれば、その手前までを確認済みにする
+        held_back = batch.held_back + [item_id for item_id in batch.polled if item_id in result.skipped]
+        if held_back:
+            last_checked_id = min(held_back) - 1
+        elif batch.polled:
+            last_checked_id = max(batch.polled)
+        return len(batch.items) - len(result.skipped)
     except requests.exceptions.RequestException as e:
         print(f"Request error: {e}")
     except openai.Error as e:
@@ -179,3 +323,7 @@ async def check_new_hn_content():
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
         traceback.print_exc()
+    finally:
+        # 実行ごとの計測結果を出力
+        metrics.flush()
+    return 0
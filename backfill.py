@@ -0,0 +1,444 @@
+import os
+import re
+import ast
+import json
+import time
+import sqlite3
+import argparse
+import tempfile
+import threading
+from datetime import datetime
+
+from llmcache import content_hash
+from chunking import truncate_tokens, CHUNK_TOKENS
+from enrich import enrich_request, parse_enrichment, is_complete
+from metrics import metrics
+
+# 過去分をまとめて処理する時の状態のデフォルトの保存先
+DEFAULT_BACKFILL_PATH = os.path.join(tempfile.gettempdir(), 'autonews_backfill.sqlite3')
+# 1ファイルに書くリクエスト数とバイト数の上限（バッチAPIの上限より小さくしておく）
+DEFAULT_CHUNK_SIZE = 5000
+MAX_FILE_BYTES = 100 * 1024 * 1024
+# バッチAPIのエンドポイント
+BATCH_ENDPOINT = '/v1/chat/completions'
+
+# カテゴリのスキーマ（各エントリポイントと同じ）
+CATEGORY_SCHEMA = {
+    "properties": {
+        "category1": {"type": "string"},
+        "category2": {"type": "string"},
+        "category3": {"type": "string"},
+    },
+    "required": ["category1"]
+}
+
+# ステージごとのモデル・温度・プロンプト（各エントリポイントの生成関数と同じ）
+STAGE_PROMPTS = {
+    'summarize': ("gpt-3.5-turbo-16k-0613", 0,
+                  "あなたは優秀な要約アシスタントです。提供された文章をもとに、できる限り正確な内容にすることを意識して要約してください。"),
+    'opinion': ("gpt-4", 0.6,
+                "あなたは優秀な意見生成アシスタントです。提供された文章をもとに、文章に関する感想や意見を生成してください。"),
+    'lead': ("gpt-3.5-turbo-0613", 0.6,
+             "あなたは優秀なリード文生成アシスタントです。提供された文章をもとに、日本語のリード文を生成してください。"),
+    'category': ("gpt-3.5-turbo", 0,
+                 "あなたは優秀なカテゴリ生成アシスタントです。提供された文章をもとに、カテゴリ(2個から3個)を生成してください。"),
+}
+# 要約の後に、要約をもとに生成するステージ
+ANNOTATE_STAGES = ('opinion', 'lead', 'category')
+# prepare で指定できるステージ（enrich は1回の呼び出しで4項目を生成する）
+PREPARE_STAGES = ('summarize', 'annotate', 'enrich')
+
+CATEGORY_FUNCTION = {
+    "name": "categories",
+    "description": "文章のカテゴリを記録する",
+    "parameters": dict(CATEGORY_SCHEMA, type="object"),
+}
+
+
+def custom_id(item_id, stage):
+    return f'{item_id}:{stage}'
+
+
+def split_custom_id(value):
+    item_id, stage = value.rsplit(':', 1)
+    return item_id, stage
+
+
+# アーカイブに保存するID（HNのIDはそのまま、ハッシュから作ったIDはフィードの記事と同じく負の整数にする）
+def archive_item_id(item_id):
+    from sources import feed_item_id
+
+    return int(item_id) if str(item_id).lstrip('-').isdigit() else feed_item_id(str(item_id))
+
+
+# ---- コーパスの読み込み ------------------------------------------------------
+
+# backtest.py が保存した Document の文字列表現（page_content='...' metadata={...}）
+DOCUMENT_PATTERN = re.compile(
+    r"page_content=('(?:\\.|[^'\\])*'|\"(?:\\.|[^\"\\])*\") metadata=(\{.*?\})(?=\n\npage_content=|\s*\Z)",
+    re.DOTALL,
+)
+
+
+# 保存済みのコーパスを読み込む関数
+# hnsource の辞書を1行1件で保存した JSON Lines と、backtest.py の出力に対応する
+def load_corpus(path):
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+    documents = []
+    if path.endswith('.jsonl'):
+        documents = [json.loads(line) for line in text.splitlines() if line.strip()]
+    else:
+        for content, metadata in DOCUMENT_PATTERN.findall(text):
+            metadata = ast.literal_eval(metadata)
+            documents.append(dict(metadata, page_content=ast.literal_eval(content)))
+    for document in documents:
+        # IDがなければ出典URLか本文から安定したIDを作る
+        if not document.get('id'):
+            document['id'] = content_hash(document.get('source') or document['page_content'])[:16]
+        document['id'] = str(document['id'])
+    return documents
+
+
+# ---- 状態の保存 --------------------------------------------------------------
+
+# 読み込んだ記事・送信したリクエスト・受け取った結果・書き出し済みの記事を保存するクラス
+# 各コマンドはこの状態を見て未完了の分だけを処理するので、途中で止めても続きから再開できる
+class BackfillStore:
+    def __init__(self, path=DEFAULT_BACKFILL_PATH):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(
+            'CREATE TABLE IF NOT EXISTS items ('
+            ' id TEXT PRIMARY KEY,'
+            ' document TEXT NOT NULL);'
+            'CREATE TABLE IF NOT EXISTS requests ('
+            ' custom_id TEXT PRIMARY KEY,'
+            ' file TEXT NOT NULL,'
+            ' requested_at REAL NOT NULL);'
+            'CREATE TABLE IF NOT EXISTS results ('
+            ' custom_id TEXT PRIMARY KEY,'
+            ' item_id TEXT NOT NULL,'
+            ' stage TEXT NOT NULL,'
+            ' value TEXT NOT NULL,'
+            ' created_at REAL NOT NULL);'
+            'CREATE INDEX IF NOT EXISTS results_item ON results (item_id);'
+            'CREATE TABLE IF NOT EXISTS exported ('
+            ' item_id TEXT PRIMARY KEY,'
+            ' exported_at REAL NOT NULL);'
+        )
+
+    @classmethod
+    def from_env(cls):
+        return cls(os.getenv('BACKFILL_DB', DEFAULT_BACKFILL_PATH))
+
+    def _executemany(self, sql, rows):
+        with self._lock, self._conn:
+            self._conn.execute('BEGIN')
+            self._conn.executemany(sql, rows)
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def add_items(self, documents):
+        self._executemany(
+            'INSERT OR IGNORE INTO items (id, document) VALUES (?, ?)',
+            [(d['id'], json.dumps(d, ensure_ascii=False)) for d in documents],
+        )
+
+    def items(self):
+        return [json.loads(row[0]) for row in self._query('SELECT document FROM items ORDER BY id')]
+
+    def record_requests(self, custom_ids, file):
+        now = time.time()
+        self._executemany(
+            'INSERT OR REPLACE INTO requests (custom_id, file, requested_at) VALUES (?, ?, ?)',
+            [(cid, file, now) for cid in custom_ids],
+        )
+
+    def requested(self):
+        return {row[0] for row in self._query('SELECT custom_id FROM requests')}
+
+    def save_results(self, results):
+        now = time.time()
+        self._executemany(
+            'INSERT OR REPLACE INTO results (custom_id, item_id, stage, value, created_at) VALUES (?, ?, ?, ?, ?)',
+            [(cid, *split_custom_id(cid), json.dumps(value, ensure_ascii=False), now) for cid, value in results],
+        )
+
+    # item_id -> {ステージ: 結果}
+    def results(self):
+        joined = {}
+        for item_id, stage, value in self._query('SELECT item_id, stage, value FROM results'):
+            joined.setdefault(item_id, {})[stage] = json.loads(value)
+        return joined
+
+    def mark_exported(self, item_ids):
+        now = time.time()
+        self._executemany(
+            'INSERT OR REPLACE INTO exported (item_id, exported_at) VALUES (?, ?)',
+            [(item_id, now) for item_id in item_ids],
+        )
+
+    def exported(self):
+        return {row[0] for row in self._query('SELECT item_id FROM exported')}
+
+    def counts(self):
+        return {
+            'items': self._query('SELECT COUNT(*) FROM items')[0][0],
+            'requested': self._query('SELECT COUNT(*) FROM requests')[0][0],
+            'results': dict(self._query('SELECT stage, COUNT(*) FROM results GROUP BY stage')),
+            'exported': self._query('SELECT COUNT(*) FROM exported')[0][0],
+        }
+
+    def close(self):
+        self._conn.close()
+
+
+# ---- リクエストファイルの作成 -------------------------------------------------
+
+def _chat_body(stage, content):
+    model, temperature, prompt = STAGE_PROMPTS[stage]
+    body = {
+        'model': model,
+        'temperature': temperature,
+        'messages': [
+            {"role": "system", "content": prompt},
+            {"role": "user", "content": content},
+        ],
+    }
+    if stage == 'category':
+        body['functions'] = [CATEGORY_FUNCTION]
+        body['function_call'] = {'name': CATEGORY_FUNCTION['name']}
+    return body
+
+
+# ステージごとに (custom_id, リクエスト本文) を作る関数
+# 長い記事はバッチでは分割要約できないので、1チャンクの長さに切り詰める
+def build_requests(stage, documents, joined):
+    for document in documents:
+        item_id = document['id']
+        content = truncate_tokens(document['page_content'], CHUNK_TOKENS)
+        if stage == 'enrich':
+            yield custom_id(item_id, 'enrich'), enrich_request(content, CATEGORY_SCHEMA)
+        elif stage == 'summarize':
+            yield custom_id(item_id, 'summarize'), _chat_body('summarize', content)
+        else:
+            # 要約の結果が揃った記事だけ、要約をもとに意見・リード文・カテゴリを生成する
+            summary = joined.get(item_id, {}).get('summarize')
+            if not summary:
+                continue
+            for annotate_stage in ANNOTATE_STAGES:
+                yield custom_id(item_id, annotate_stage), _chat_body(annotate_stage, summary)
+
+
+# 未処理のリクエストをバッチAPI形式の JSON Lines に分割して書き出す関数
+def prepare(store, stage, out_dir, chunk_size=DEFAULT_CHUNK_SIZE, retry=False):
+    os.makedirs(out_dir, exist_ok=True)
+    joined = store.results()
+    done = {custom_id(item_id, s) for item_id, stages in joined.items() for s in stages}
+    # 送信済みで結果を待っているリクエストは、retry を指定しない限り書き出さない
+    skip = done if retry else done | store.requested()
+    prefix = datetime.now().strftime('%Y%m%d%H%M%S')
+
+    files = []
+    lines, size = [], 0
+
+    def write_chunk():
+        path = os.path.join(out_dir, f'batch-{stage}-{prefix}-{len(files) + 1:04d}.jsonl')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.writelines(line for _, line in lines)
+        store.record_requests([cid for cid, _ in lines], path)
+        files.append(path)
+
+    for cid, body in build_requests(stage, store.items(), joined):
+        if cid in skip:
+            continue
+        line = json.dumps({'custom_id': cid, 'method': 'POST', 'url': BATCH_ENDPOINT, 'body': body},
+                          ensure_ascii=False) + '\n'
+        if lines and (len(lines) >= chunk_size or size + len(line.encode('utf-8')) > MAX_FILE_BYTES):
+            write_chunk()
+            lines, size = [], 0
+        lines.append((cid, line))
+        size += len(line.encode('utf-8'))
+    if lines:
+        write_chunk()
+    return files
+
+
+# ---- 結果ファイルの取り込み ---------------------------------------------------
+
+# バッチAPIの結果1行を、ステージごとの値に変換する（失敗なら None）
+def parse_result(record):
+    response = record.get('response') or {}
+    if record.get('error') or response.get('status_code') != 200:
+        return None
+    body = response.get('body') or {}
+    message = (body.get('choices') or [{}])[0].get('message') or {}
+    result = {
+        'model': body.get('model'),
+        'content': message.get('content'),
+        'function_call': message.get('function_call'),
+        'usage': body.get('usage') or {},
+    }
+    _, stage = split_custom_id(record['custom_id'])
+    metrics.record_usage(result['model'], result['usage'], stage=stage)
+    if stage == 'enrich':
+        enrichment = parse_enrichment(result, CATEGORY_SCHEMA)
+        if enrichment:
+            enrichment.pop('usage', None)
+        return enrichment
+    if stage == 'category':
+        try:
+            arguments = json.loads((result['function_call'] or {}).get('arguments') or '')
+        except ValueError:
+            return None
+        categories = [
+            arguments[key].strip() for key in CATEGORY_SCHEMA['properties']
+            if isinstance(arguments.get(key), str) and arguments[key].strip()
+        ]
+        return categories or None
+    content = (result['content'] or '').strip()
+    return content or None
+
+
+# 結果ファイルを読み込み、custom_id ごとに保存する関数（何度取り込んでも同じ結果になる）
+def ingest(store, paths):
+    saved, failed = 0, []
+    for path in paths:
+        results = []
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                value = parse_result(record)
+                if value is None:
+                    failed.append(record.get('custom_id'))
+                    continue
+                results.append((record['custom_id'], value))
+        store.save_results(results)
+        saved += len(results)
+    return {'saved': saved, 'failed': len(failed), 'failed_ids': failed[:20]}
+
+
+# ---- 書き出し ----------------------------------------------------------------
+
+# ステージごとの結果を記事ごとの生成結果にまとめる関数
+def join_enrichment(stages):
+    if 'enrich' in stages:
+        return stages['enrich']
+    return {
+        'summary': stages.get('summarize'),
+        'opinion': stages.get('opinion'),
+        'lead': stages.get('lead'),
+        'categories': stages.get('category'),
+    }
+
+
+# 4項目が揃った未書き出しの記事の (ID, 生成結果) のリスト
+def completed_enrichments(store):
+    exported = store.exported()
+    completed = []
+    for item_id, stages in sorted(store.results().items()):
+        if item_id in exported:
+            continue
+        enrichment = join_enrichment(stages)
+        if is_complete(enrichment):
+            completed.append((item_id, enrichment))
+    return completed
+
+
+# 揃った記事を、スプレッドシートの行（日時・要約・意見・カテゴリ・リード文・ID）にする
+def completed_rows(completed):
+    from sheetwriter import format_categories
+
+    rows = []
+    for item_id, enrichment in completed:
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        rows.append([now, enrichment['summary'], enrichment['opinion'],
+                     format_categories(enrichment['categories']), enrichment['lead'], item_id])
+    return rows
+
+
+# 揃った記事をアーカイブ・スプレッドシート（1回の batchUpdate）・JSON Lines に書き出す関数
+def export(store, sheet=False, out=None, archive=False):
+    completed = completed_enrichments(store)
+    if not completed:
+        return {'exported': 0}
+    rows = completed_rows(completed)
+    if archive:
+        from archive import ArticleArchive, DEFAULT_ARCHIVE_DIR, archive_record
+
+        documents = {document['id']: document for document in store.items()}
+        ArticleArchive(os.getenv('ARCHIVE_DIR', DEFAULT_ARCHIVE_DIR)).extend(
+            archive_record(dict(documents.get(item_id, {}), **enrichment, id=archive_item_id(item_id)))
+            for item_id, enrichment in completed)
+    if sheet:
+        from maindeploy import get_service, SPREADSHEET_ID
+        from sheetwriter import BufferedSheetWriter
+
+        writer = BufferedSheetWriter(get_service(), SPREADSHEET_ID)
+        for row in rows:
+            writer.add_row(row)
+        writer.flush()
+    if out:
+        with open(out, 'a', encoding='utf-8') as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + '\n')
+    store.mark_exported(row[5] for row in rows)
+    return {'exported': len(rows)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='保存済みのコーパスをバッチAPIでまとめて処理する')
+    parser.add_argument('--db', default=os.getenv('BACKFILL_DB', DEFAULT_BACKFILL_PATH), help='状態の保存先')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    load = commands.add_parser('load', help='コーパスを読み込む')
+    load.add_argument('corpus', nargs='+', help='JSON Lines か backtest.py の出力ファイル')
+
+    prep = commands.add_parser('prepare', help='未処理のリクエストをバッチ用のファイルに書き出す')
+    prep.add_argument('--stage', choices=PREPARE_STAGES, default='enrich',
+                      help='enrich は1回で4項目、summarize の後に annotate で残りの3項目を生成する')
+    prep.add_argument('--out-dir', default='batch_requests')
+    prep.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='1ファイルのリクエスト数')
+    prep.add_argument('--retry', action='store_true', help='結果が返っていないリクエストも書き出す')
+
+    ing = commands.add_parser('ingest', help='バッチの結果ファイルを取り込む')
+    ing.add_argument('results', nargs='+')
+
+    exp = commands.add_parser('export', help='揃った記事を書き出す')
+    exp.add_argument('--sheet', action='store_true', help='スプレッドシートに書き込む')
+    exp.add_argument('--out', help='行を追記する JSON Lines ファイル')
+    exp.add_argument('--archive', action='store_true', help='ローカルのアーカイブに保存する（ARCHIVE_DIR）')
+
+    commands.add_parser('status', help='進捗を表示する')
+    args = parser.parse_args()
+
+    store = BackfillStore(args.db)
+    try:
+        if args.command == 'load':
+            documents = [d for path in args.corpus for d in load_corpus(path)]
+            store.add_items(documents)
+            report = {'loaded': len(documents)}
+        elif args.command == 'prepare':
+            report = {'files': prepare(store, args.stage, args.out_dir, args.chunk_size, args.retry)}
+        elif args.command == 'ingest':
+            report = ingest(store, args.results)
+        elif args.command == 'export':
+            if not args.sheet and not args.out and not args.archive:
+                parser.error('--archive・--sheet・--out のいずれかを指定してください')
+            report = export(store, args.sheet, args.out, args.archive)
+        else:
+            report = store.counts()
+        print(json.dumps(report, ensure_ascii=False))
+    finally:
+        store.close()
+        metrics.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,675 @@
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import shutil
+import atexit
+import asyncio
+import argparse
+import tempfile
+import threading
+import statistics
+from collections import Counter, defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# HN・OpenAI・Google Sheets をローカルの代替に置き換えて check_new_hn_content を計測するベンチマーク
+# 実際のAPIには一切アクセスしない
+
+BENCH_DIR = tempfile.mkdtemp(prefix='autonews-bench-')
+atexit.register(shutil.rmtree, BENCH_DIR, ignore_errors=True)
+
+# エントリポイントを読み込む前にオフライン用の設定をする
+os.environ['LLM_CACHE_PATH'] = ''
+os.environ['AUTONEWS_STATE_DB'] = os.path.join(BENCH_DIR, 'state.sqlite3')
+os.environ['DEDUP_PATH'] = os.path.join(BENCH_DIR, 'dedup.sqlite3')
+os.environ['ARTICLE_CACHE_PATH'] = os.path.join(BENCH_DIR, 'articles.sqlite3')
+os.environ['ARTICLE_ALLOW_PRIVATE'] = '1'
+os.environ.setdefault('OPENAI_API_KEY', 'sk-benchmark')
+os.environ.setdefault('YOUR_SPREADSHEET_ID', 'benchmark')
+os.environ.setdefault('GOOGLE_APPLICATION_CREDENTIALS_JSON', 'e30=')
+
+import openai
+from openai.openai_object import OpenAIObject
+
+from chunking import count_tokens
+from categorizer import CATEGORY_ENGINE, DEFAULT_TAXONOMY
+
+# 計測対象のステージ（各エントリポイントのモジュール関数）
+STAGES = [
+    'summarize_content', 'generate_opinion', 'generate_lead', 'generate_category',
+    'enrich_content', 'aenrich_content', 'write_to_sheet',
+]
+
+# ストーリーごとに1つずつ割り当てるトピック（埋め込みによるカテゴリ割り当てで一致するよう、カテゴリ名を使う）
+TOPICS = list(DEFAULT_TAXONOMY)
+
+LOREM = (
+    "The new release improves the scheduler and reduces tail latency for interactive workloads. "
+    "Maintainers describe the design trade-offs, benchmarks and the migration path for existing users. "
+)
+
+
+# ---- Hacker News API の代替 -------------------------------------------------
+
+class FakeHNServer:
+    def __init__(self, stories, paragraphs, first_id=40000000):
+        self.items = {}
+        self.paragraphs = paragraphs
+        self.first_id = first_id
+        self.root = None
+        # RSS フィードの記事の番号
+        self.feed_entries = []
+        self.add_stories(stories)
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.requests += 1
+                if self.path.startswith('/articles/'):
+                    return self.send_article(int(self.path.rsplit('/', 1)[-1]))
+                if self.path == '/feed.rss':
+                    return self.send_feed()
+                path = self.path.split('/v0/', 1)[-1]
+                if path == 'maxitem.json':
+                    body = max(server.items)
+                elif path == 'newstories.json':
+                    body = sorted(server.items, reverse=True)
+                elif path == 'topstories.json':
+                    body = sorted(server.items, key=lambda i: server.items[i]['score'], reverse=True)
+                elif path.startswith('item/'):
+                    body = server.items.get(int(path[5:].split('.')[0]))
+                else:
+                    body = None
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            # RSS フィード（ETag による条件付きリクエストに対応）
+            def send_feed(self):
+                etag = f'"feed-{len(server.feed_entries)}"'
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                data = server.feed_xml().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/rss+xml; charset=utf-8')
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            # リンク先の記事（ETag による条件付きリクエストに対応）
+            def send_article(self, item_id):
+                etag = f'"{item_id}"'
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                data = server.article_html(item_id).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        self.root = f'http://127.0.0.1:{self._httpd.server_port}'
+        self.base_url = self.root + '/v0'
+        for item_id, item in self.items.items():
+            item['url'] = f'{self.root}/articles/{item_id}'
+
+    # 新着ストーリーを追加する（常駐プロセスの計測で実行中に追加する）
+    def add_stories(self, count):
+        start = max(self.items) + 1 if self.items else self.first_id
+        for item_id in range(start, start + count):
+            self.items[item_id] = {
+                'id': item_id,
+                'type': 'story',
+                'by': 'benchmark',
+                'time': 1700000000 + item_id - self.first_id,
+                'score': random.randint(1, 500),
+                'title': f'Benchmark story {item_id} about {TOPICS[item_id % len(TOPICS)]}',
+                # 重複検出に引っかからないよう、記事ごとに異なる語を混ぜる
+                'text': '<p>'.join(
+                    LOREM * 4 + ' '.join(f'term{random.getrandbits(32)}' for _ in range(40))
+                    for _ in range(self.paragraphs)
+                ),
+            }
+            if self.root:
+                self.items[item_id]['url'] = f'{self.root}/articles/{item_id}'
+
+    # ナビゲーションなどの定型部分に本文の段落を挟んだ記事のHTML
+    def article_html(self, item_id):
+        paragraphs = ''.join(f'<p>{LOREM} term{item_id}x{i}</p>' for i in range(self.paragraphs * 4))
+        return (
+            '<html><head><title>Article</title><script>var x = 1;</script></head><body>'
+            '<nav><a href="/">Home</a> <a href="/about">About</a></nav>'
+            f'<article><h1>Benchmark story {item_id}</h1>{paragraphs}</article>'
+            '<footer>Copyright benchmark</footer></body></html>'
+        )
+
+    def add_feed_entries(self, count):
+        start = len(self.feed_entries)
+        self.feed_entries.extend(range(start, start + count))
+
+    # 新しい記事が先に並ぶ RSS 2.0 のフィード
+    def feed_xml(self):
+        items = ''.join(
+            f'<item><title>Feed story {n} about {TOPICS[n % len(TOPICS)]}</title><link>{self.root}/articles/{90000000 + n}</link>'
+            f'<guid>feed-{n}</guid><pubDate>Mon, 06 Nov 2023 10:00:00 GMT</pubDate>'
+            f'<description>&lt;p&gt;{LOREM} feed{n}x{random.getrandbits(32)}&lt;/p&gt;</description></item>'
+            for n in reversed(self.feed_entries)
+        )
+        return f'<?xml version="1.0"?><rss version="2.0"><channel><title>Benchmark</title>{items}</channel></rss>'
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+# ---- OpenAI Chat Completions API の代替 -------------------------------------
+
+# JSONスキーマから関数呼び出しのダミー引数を作る関数
+def fake_arguments(schema):
+    kind = schema.get('type')
+    if kind == 'object' or 'properties' in schema:
+        return {key: fake_arguments(value) for key, value in schema.get('properties', {}).items()}
+    if kind == 'array':
+        return [fake_arguments(schema.get('items', {}))]
+    if kind in ('integer', 'number'):
+        return 1
+    if kind == 'boolean':
+        return True
+    return 'これはベンチマーク用の応答です。'
+
+
+# 擬似的な埋め込みの次元数と、同じトピックのテキストに加えるばらつき
+EMBEDDING_DIMENSIONS = 64
+EMBEDDING_NOISE = 0.2
+# langchain の抽出チェーンが使う関数名
+EXTRACTION_FUNCTION = 'information_extraction'
+
+
+# テキストのトピックを返す関数（カテゴリの説明文は「名前: 説明」、ストーリーと要約はカテゴリ名を含む）
+def fake_topic(text):
+    for name in TOPICS:
+        if text.startswith(name + ':'):
+            return name
+    for name in TOPICS:
+        if name in text:
+            return name
+    return None
+
+
+class FakeOpenAI:
+    def __init__(self, latency, completion_tokens, jitter=0.2):
+        self.latency = latency
+        self.completion_tokens = completion_tokens
+        self.jitter = jitter
+        self.calls = Counter()
+        # カテゴリの抽出チェーンの呼び出し回数（埋め込みで割り当てられなかったストーリーの数）
+        self.extraction_calls = 0
+        self._lock = threading.Lock()
+
+    def _delay(self, model):
+        matches = [key for key in self.latency if model.startswith(key)]
+        base = self.latency[max(matches, key=len)] if matches else 0.05
+        return base * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _response(self, kwargs):
+        model = kwargs['model']
+        with self._lock:
+            self.calls[model] += 1
+        prompt_tokens = sum(count_tokens(str(m.get('content') or '')) for m in kwargs['messages'])
+        if kwargs.get('functions'):
+            function = kwargs['functions'][0]
+            if function['name'] == EXTRACTION_FUNCTION:
+                with self._lock:
+                    self.extraction_calls += 1
+            message = {
+                'role': 'assistant',
+                'content': None,
+                'function_call': {
+                    'name': function['name'],
+                    'arguments': json.dumps(fake_arguments(function['parameters']), ensure_ascii=False),
+                },
+            }
+        else:
+            # 要約などにもトピックを残し、要約からのカテゴリ割り当てで同じトピックに一致させる
+            topic = fake_topic(' '.join(str(m.get('content') or '') for m in kwargs['messages']))
+            content = 'これはベンチマーク用の応答です。' * (self.completion_tokens // 20)
+            message = {'role': 'assistant', 'content': content + (f'トピック: {topic}。' if topic else '')}
+        return OpenAIObject.construct_from({
+            'id': 'chatcmpl-benchmark',
+            'object': 'chat.completion',
+            'model': model,
+            'choices': [{'index': 0, 'message': message, 'finish_reason': 'stop'}],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': self.completion_tokens,
+                'total_tokens': prompt_tokens + self.completion_tokens,
+            },
+        })
+
+    def create(self, **kwargs):
+        time.sleep(self._delay(kwargs['model']))
+        return self._response(kwargs)
+
+    async def acreate(self, **kwargs):
+        await asyncio.sleep(self._delay(kwargs['model']))
+        return self._response(kwargs)
+
+    # 擬似的な埋め込みを返す
+    # トピックのあるテキストはトピックごとの中心のベクトルの近く（コサイン類似度がおよそ0.95以上）、
+    # トピックのないテキストはハッシュから決まる方向（どのカテゴリともほぼ無相関）になる
+    def embedding_create(self, **kwargs):
+        model = kwargs['model']
+        inputs = kwargs['input']
+        time.sleep(self._delay(model))
+        with self._lock:
+            self.calls[model] += 1
+        data = []
+        for index, text in enumerate(inputs):
+            rng = random.Random(hashlib.sha256(text.encode('utf-8')).digest())
+            topic = fake_topic(text)
+            if topic is None:
+                vector = [rng.uniform(-1, 1) for _ in range(EMBEDDING_DIMENSIONS)]
+            else:
+                center = random.Random(hashlib.sha256(topic.encode('utf-8')).digest())
+                vector = [center.uniform(-1, 1) + rng.uniform(-EMBEDDING_NOISE, EMBEDDING_NOISE)
+                          for _ in range(EMBEDDING_DIMENSIONS)]
+            data.append({'object': 'embedding', 'index': index, 'embedding': vector})
+        prompt_tokens = sum(count_tokens(text) for text in inputs)
+        return OpenAIObject.construct_from({
+            'object': 'list',
+            'model': model,
+            'data': data,
+            'usage': {'prompt_tokens': prompt_tokens, 'total_tokens': prompt_tokens},
+        })
+
+    def install(self):
+        openai.ChatCompletion.create = self.create
+        openai.ChatCompletion.acreate = self.acreate
+        openai.Embedding.create = self.embedding_create
+
+
+# ---- WordPress REST API の代替 ----------------------------------------------
+
+class FakeWordPressServer:
+    def __init__(self):
+        self.posts = {}
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, body, status=200):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                server.calls['GET posts'] += 1
+                slug = self.path.split('slug=', 1)[-1].split('&')[0] if 'slug=' in self.path else None
+                self.send_json([post for post in server.posts.values() if slug is None or post['slug'] == slug])
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                path = self.path.rstrip('/').split('/wp/v2/', 1)[-1]
+                with server._lock:
+                    if path == 'posts':
+                        server.calls['POST posts'] += 1
+                        post_id = len(server.posts) + 1
+                    else:
+                        server.calls['POST posts/<id>'] += 1
+                        post_id = int(path.rsplit('/', 1)[-1])
+                        if post_id not in server.posts:
+                            return self.send_json({'code': 'rest_post_invalid_id'}, 404)
+                    post = dict(server.posts.get(post_id, {}), **payload, id=post_id)
+                    server.posts[post_id] = post
+                self.send_json(post, 201 if path == 'posts' else 200)
+
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        self.api_url = f'http://127.0.0.1:{self._httpd.server_port}/wp-json/wp/v2'
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+# ---- Google Sheets API の代替 -----------------------------------------------
+
+class FakeRequest:
+    def __init__(self, sheets, method, result):
+        self.sheets = sheets
+        self.method = method
+        self.result = result
+
+    def execute(self):
+        with self.sheets.lock:
+            self.sheets.calls[self.method] += 1
+        time.sleep(self.sheets.latency)
+        return self.result() if callable(self.result) else self.result
+
+
+class FakeValues:
+    def __init__(self, sheets):
+        self.sheets = sheets
+
+    def get(self, spreadsheetId, range):
+        return FakeRequest(self.sheets, 'values.get', lambda: self.sheets.read(range))
+
+    def batchGet(self, spreadsheetId, ranges, **kwargs):
+        return FakeRequest(self.sheets, 'values.batchGet',
+                           lambda: {'valueRanges': [self.sheets.read(r) for r in ranges]})
+
+    def append(self, spreadsheetId, range, valueInputOption, body, **kwargs):
+        return FakeRequest(self.sheets, 'values.append', lambda: self.sheets.rows.extend(body['values']) or {})
+
+    def update(self, spreadsheetId, range, valueInputOption, body):
+        return FakeRequest(self.sheets, 'values.update', lambda: self.sheets.write(range, body['values']) or {})
+
+    def batchUpdate(self, spreadsheetId, body):
+        def apply():
+            for data in body['data']:
+                self.sheets.write(data['range'], data['values'])
+            return {}
+        return FakeRequest(self.sheets, 'values.batchUpdate', apply)
+
+
+class FakeSpreadsheets:
+    def __init__(self, sheets):
+        self.sheets = sheets
+
+    def values(self):
+        return FakeValues(self.sheets)
+
+    def get(self, spreadsheetId, ranges=(), **kwargs):
+        def read():
+            sheet = {'properties': {'sheetId': 0, 'title': 'Sheet1'}}
+            if 'J1' in ranges and self.sheets.watermark is not None:
+                sheet['data'] = [{'rowData': [{'values': [{'formattedValue': str(self.sheets.watermark)}]}]}]
+            return {'sheets': [sheet]}
+        return FakeRequest(self.sheets, 'get', read)
+
+    # appendCells（行の追加）と J1 への updateCells だけを反映する
+    def batchUpdate(self, spreadsheetId, body):
+        def apply():
+            for request in body['requests']:
+                if 'appendCells' in request:
+                    self.sheets.rows.extend(
+                        [[next(iter(cell.get('userEnteredValue', {'': None}).values())) for cell in row['values']]
+                         for row in request['appendCells']['rows']])
+                elif 'updateCells' in request:
+                    cell = request['updateCells']['rows'][0]['values'][0]['userEnteredValue']
+                    self.sheets.watermark = next(iter(cell.values()))
+            return {}
+        return FakeRequest(self.sheets, 'batchUpdate', apply)
+
+
+class FakeSheetsService:
+    def __init__(self, latency):
+        self.latency = latency
+        self.rows = []
+        self.watermark = None
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def spreadsheets(self):
+        return FakeSpreadsheets(self)
+
+    def read(self, range_name):
+        if range_name == 'J1':
+            return {'range': 'J1', 'values': [[self.watermark]] if self.watermark is not None else []}
+        return {'range': range_name, 'values': [row[:1] for row in self.rows]}
+
+    def write(self, range_name, values):
+        if range_name == 'J1':
+            self.watermark = values[0][0]
+        else:
+            self.rows.extend(values)
+
+
+# ---- 計測 ------------------------------------------------------------------
+
+# モジュールのステージ関数を所要時間を記録するラッパーに置き換える
+def instrument(module, timings):
+    def wrap(name, fn):
+        if asyncio.iscoroutinefunction(fn):
+            async def timed(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    timings[name].append(time.perf_counter() - started)
+        else:
+            def timed(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    timings[name].append(time.perf_counter() - started)
+        return timed
+
+    for name in STAGES:
+        if hasattr(module, name):
+            setattr(module, name, wrap(name, getattr(module, name)))
+    source = module.hn_source
+    source.fetch_new_ids = wrap('hn_fetch_new_ids', source.fetch_new_ids)
+    source.fetch_items = wrap('hn_fetch_items', source.fetch_items)
+    source.fetch_document = wrap('hn_fetch_document', source.fetch_document)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(q * len(values))) - 1))]
+
+
+# 条件が満たされるまで待つ
+def wait_for(condition, timeout=120):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+# 常駐プロセスを短い間隔で動かし、最初の新着を処理した後の変化のない確認と、
+# 後から追加した新着の処理を計測する
+def run_daemon(module, hn, args):
+    from daemon import NewsDaemon, AdaptiveInterval
+    from pipeline import shutdown
+
+    daemon = NewsDaemon(module, module.process_new_content, AdaptiveInterval(0.02, 0.2))
+    thread = threading.Thread(target=daemon.run, daemon=True)
+    shutdown.clear()
+    thread.start()
+    wait_for(lambda: daemon.stats['stories'] >= args.stories)
+    time.sleep(0.5)
+    hn.add_stories(args.stories)
+    wait_for(lambda: daemon.stats['stories'] >= args.stories * 2)
+    shutdown.set()
+    thread.join()
+    shutdown.clear()
+    return daemon.stats
+
+
+def run_variant(variant, args):
+    import ratelimit
+    from hnsource import HNItemSource
+    from statestore import StateStore
+    from dedup import DedupIndex
+    from wppublisher import WordPressPublisher, PublishState
+    from sources import IngestScheduler, HNNewestSource, HNTopSource, FeedSource, LLMBudget
+    from archive import ArticleArchive
+
+    hn = FakeHNServer(args.stories, args.paragraphs)
+    wordpress = FakeWordPressServer()
+    sheets = FakeSheetsService(args.sheets_latency)
+    fake_openai = FakeOpenAI(
+        {'gpt-4': args.gpt4_latency, 'gpt-3.5': args.gpt35_latency},
+        args.completion_tokens,
+    )
+    fake_openai.install()
+    # 前のバリアントで使ったレート制限の枠を持ち越さない
+    ratelimit.limiter._buckets.clear()
+
+    timings = defaultdict(list)
+    if variant == 'sync':
+        import main as module
+        module.build = lambda *a, **k: sheets
+        module.last_checked_id = None
+    elif variant == 'async':
+        import asyncmain as module
+        module.build = lambda *a, **k: sheets
+        module.last_checked_id = None
+    else:
+        import maindeploy as module
+        module.get_service = lambda: sheets
+        module.wp_publisher = WordPressPublisher(
+            wordpress.api_url, PublishState(os.path.join(BENCH_DIR, f'wordpress-{time.time_ns()}.sqlite3')))
+    module.MAX_ITEMS = args.stories
+    module.state_store = StateStore(os.path.join(BENCH_DIR, f'state-{time.time_ns()}.sqlite3'))
+    module.dedup_index = DedupIndex(os.path.join(BENCH_DIR, f'dedup-{time.time_ns()}.sqlite3'))
+    module.article_archive = ArticleArchive(os.path.join(BENCH_DIR, f'archive-{time.time_ns()}'))
+    # --no-sheet ではアーカイブだけに保存する
+    module.SHEET_EXPORT = not args.no_sheet
+    module.hn_source = HNItemSource(hn.base_url)
+    # --feed-items を指定すると、トップページ・新着・RSS フィードの3つのソースから取得する
+    sources = [HNNewestSource()]
+    if args.feed_items:
+        hn.add_feed_entries(args.feed_items)
+        sources = [HNTopSource(quota=args.top_quota), HNNewestSource(),
+                   FeedSource(hn.root + '/feed.rss', name='benchmark_feed', priority=0, quota=args.feed_items)]
+        module.MAX_ITEMS = args.stories + args.feed_items
+    module.ingest_scheduler = IngestScheduler(sources, LLMBudget() if args.llm_budget else None)
+    instrument(module, timings)
+
+    started = time.perf_counter()
+    daemon_stats = None
+    if variant == 'async':
+        asyncio.run(module.check_new_hn_content())
+    elif variant == 'daemon':
+        daemon_stats = run_daemon(module, hn, args)
+    else:
+        module.check_new_hn_content(None)
+    elapsed = time.perf_counter() - started
+    hn.close()
+    wordpress.close()
+
+    archived = len(module.article_archive)
+    stories = archived if args.no_sheet else len(sheets.rows)
+    per_story = max(stories, 1)
+    return {
+        'variant': variant,
+        'stories': stories,
+        'archived': archived,
+        'elapsed_s': round(elapsed, 3),
+        'stories_per_minute': round(stories / elapsed * 60, 1) if elapsed else 0,
+        'stage_latency_ms': {
+            name: {
+                'count': len(values),
+                'p50': round(statistics.median(values) * 1000, 1),
+                'p95': round(percentile(values, 0.95) * 1000, 1),
+            }
+            for name, values in sorted(timings.items())
+        },
+        'api_calls_per_story': {
+            'openai': round(sum(fake_openai.calls.values()) / per_story, 2),
+            'sheets': round(sum(sheets.calls.values()) / per_story, 2),
+            'hn': round(hn.requests / per_story, 2),
+            'wordpress': round(sum(wordpress.calls.values()) / per_story, 2),
+        },
+        'openai_calls_by_model': dict(fake_openai.calls),
+        'category_extraction_calls': fake_openai.extraction_calls,
+        'sheets_calls_by_method': dict(sheets.calls),
+        'daemon': daemon_stats,
+    }
+
+
+# しきい値を超えた項目を返す（CIでの回帰検出用）
+def check_thresholds(report, args):
+    failures = []
+    for result in report:
+        if result['stories'] < args.stories:
+            failures.append(f"{result['variant']}: only {result['stories']}/{args.stories} stories written")
+        if args.min_stories_per_minute and result['stories_per_minute'] < args.min_stories_per_minute:
+            failures.append(f"{result['variant']}: {result['stories_per_minute']} stories/min")
+        # どのストーリーもカテゴリ名のトピックを持つので、埋め込みで割り当てられ抽出チェーンは呼ばれない
+        if CATEGORY_ENGINE == 'embedding' and result['category_extraction_calls']:
+            failures.append(f"{result['variant']}: {result['category_extraction_calls']} stories fell back "
+                            "to the category extraction chain")
+        for limit in args.max_p95:
+            stage, value = limit.split('=')
+            latency = result['stage_latency_ms'].get(stage)
+            if latency and latency['p95'] > float(value):
+                failures.append(f"{result['variant']}: {stage} p95 {latency['p95']}ms > {value}ms")
+        for limit in args.max_calls:
+            api, value = limit.split('=')
+            if result['api_calls_per_story'].get(api, 0) > float(value):
+                failures.append(f"{result['variant']}: {api} calls/story {result['api_calls_per_story'][api]} > {value}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ローカルの代替APIでパイプラインの性能を計測します')
+    parser.add_argument('--variants', default='sync,async,deploy',
+                        help='計測するバリアント（カンマ区切り、daemon で常駐プロセスも計測する）')
+    parser.add_argument('--stories', type=int, default=20, help='新着ニュースの件数')
+    parser.add_argument('--paragraphs', type=int, default=5, help='1件あたりの段落数')
+    parser.add_argument('--gpt4-latency', type=float, default=0.2, help='gpt-4 の応答時間（秒）')
+    parser.add_argument('--gpt35-latency', type=float, default=0.05, help='gpt-3.5 系の応答時間（秒）')
+    parser.add_argument('--completion-tokens', type=int, default=200, help='1回の応答の出力トークン数')
+    parser.add_argument('--sheets-latency', type=float, default=0.05, help='Sheets API の応答時間（秒）')
+    parser.add_argument('--feed-items', type=int, default=0, help='RSS フィードの記事数（0ならHNの新着だけ）')
+    parser.add_argument('--top-quota', type=int, default=5, help='トップページから1回に処理する最大数')
+    parser.add_argument('--llm-budget', action='store_true', help='共有のレート制限の枠で1回の件数を制限する')
+    parser.add_argument('--no-sheet', action='store_true', help='スプレッドシートに書き出さず、アーカイブだけに保存する')
+    parser.add_argument('--max-p95', action='append', default=[], metavar='STAGE=MS',
+                        help='ステージのp95レイテンシの上限（ミリ秒）')
+    parser.add_argument('--max-calls', action='append', default=[], metavar='API=N',
+                        help='1件あたりのAPI呼び出し数の上限（openai, sheets, hn）')
+    parser.add_argument('--min-stories-per-minute', type=float, help='スループットの下限')
+    parser.add_argument('--output', help='結果をJSONで保存するファイル')
+    args = parser.parse_args()
+
+    report = [run_variant(variant, args) for variant in args.variants.split(',')]
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+    failures = check_thresholds(report, args)
+    for failure in failures:
+        print(f"FAIL {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
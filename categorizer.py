@@ -0,0 +1,113 @@
+import os
+import json
+import threading
+
+import numpy as np
+
+from llm import embed
+from metrics import metrics
+
+# 'embedding' ならベクトルの類似度でカテゴリを割り当て、'llm' なら従来どおり抽出チェーンだけを使う
+CATEGORY_ENGINE = os.getenv('CATEGORY_ENGINE', 'embedding')
+
+# 割り当てのしきい値
+# text-embedding-ada-002 のコサイン類似度は無関係な短い文どうしでも 0.7〜0.8 に集まるため、
+# 絶対値のしきい値（以前の 0.78）だけではほぼすべての記事が上位k件を通過し、LLMへの切り替えが起きない
+# そこで記事ごとに全カテゴリの類似度の中央値を「無関係」の水準とみなし、それを CATEGORY_MIN_MARGIN 以上
+# 上回るカテゴリだけを割り当てる（関連するカテゴリはこの水準から 0.05 前後離れるので、既定は 0.04）
+# CATEGORY_MIN_SCORE は明らかに関係のない記事を落とすための下限
+# 上位カテゴリの差は category_top_margin に記録するので、実際の記事の分布を見て調整する
+CATEGORY_MIN_SCORE = float(os.getenv('CATEGORY_MIN_SCORE', '0.8'))
+CATEGORY_MIN_MARGIN = float(os.getenv('CATEGORY_MIN_MARGIN', '0.04'))
+
+# デフォルトのカテゴリ一覧（カテゴリ名: 埋め込みに使う説明文）
+DEFAULT_TAXONOMY = {
+    "AI・機械学習": "人工知能、機械学習、大規模言語モデル、ニューラルネットワーク、AI研究",
+    "プログラミング": "プログラミング言語、ソフトウェア開発、コンパイラ、ライブラリ、開発ツール",
+    "Web開発": "Web開発、フロントエンド、ブラウザ、JavaScript、HTML、CSS、Webフレームワーク",
+    "セキュリティ": "サイバーセキュリティ、脆弱性、ハッキング、マルウェア、暗号技術",
+    "オープンソース": "オープンソースソフトウェア、ライセンス、コミュニティ、GitHub",
+    "クラウド・インフラ": "クラウド、サーバー、インフラ、DevOps、Kubernetes、ネットワーク",
+    "データベース": "データベース、SQL、データ処理、ストレージ、分析基盤",
+    "ハードウェア": "ハードウェア、半導体、CPU、GPU、電子工作、ガジェット",
+    "スタートアップ・ビジネス": "スタートアップ、起業、資金調達、企業経営、テック業界のビジネス",
+    "科学": "科学研究、物理学、化学、生物学、数学、論文",
+    "宇宙": "宇宙開発、ロケット、天文学、人工衛星、NASA",
+    "プライバシー・法律": "プライバシー、個人情報、規制、法律、著作権、裁判",
+    "ゲーム": "ビデオゲーム、ゲーム開発、ゲームエンジン",
+    "モバイル": "スマートフォン、iOS、Android、モバイルアプリ",
+    "暗号資産・ブロックチェーン": "暗号資産、ビットコイン、ブロックチェーン、Web3",
+    "キャリア・働き方": "キャリア、仕事、リモートワーク、採用、エンジニアの働き方",
+    "教育": "教育、学習、大学、オンライン講座",
+    "健康・医療": "健康、医療、医学、バイオテクノロジー",
+    "エネルギー・環境": "エネルギー、気候変動、環境、電気自動車、再生可能エネルギー",
+    "政治・社会": "政治、政府、社会問題、経済政策",
+}
+
+
+# カテゴリ一覧を読み込む関数（JSONファイルでカテゴリ名のリストか {名前: 説明文} を指定できる）
+def load_taxonomy(path=None):
+    if not path:
+        return dict(DEFAULT_TAXONOMY)
+    with open(path, encoding='utf-8') as f:
+        taxonomy = json.load(f)
+    if isinstance(taxonomy, list):
+        return {name: name for name in taxonomy}
+    return taxonomy
+
+
+# 固定のカテゴリ一覧から、記事の埋め込みとのコサイン類似度が高い上位k件を割り当てるクラス
+class CategoryEngine:
+    def __init__(self, taxonomy, top_k=3, min_score=CATEGORY_MIN_SCORE, min_margin=CATEGORY_MIN_MARGIN,
+                 embed_fn=embed):
+        self.names = list(taxonomy)
+        self.descriptions = [f"{name}: {taxonomy[name]}" for name in self.names]
+        self.top_k = min(top_k, len(self.names))
+        self.min_score = min_score
+        self.min_margin = min_margin
+        self.embed_fn = embed_fn
+        self._matrix = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            load_taxonomy(os.getenv('CATEGORY_TAXONOMY')),
+            top_k=int(os.getenv('CATEGORY_TOP_K', '3')),
+        )
+
+    @staticmethod
+    def _normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    # カテゴリの埋め込み行列（初回だけ作成し、以後は使い回す）
+    def matrix(self):
+        if self._matrix is None:
+            with self._lock:
+                if self._matrix is None:
+                    self._matrix = self._normalize(self.embed_fn(self.descriptions))
+        return self._matrix
+
+    # 各カテゴリとの類似度を返す
+    def scores(self, text):
+        vector = self._normalize(self.embed_fn([text]))[0]
+        return self.matrix() @ vector
+
+    # 類似度が下限以上で、全カテゴリの中央値を min_margin 以上上回る上位カテゴリを返す
+    # （1件もなければ None を返し、呼び出し側でLLMに切り替える）
+    def assign(self, text):
+        scores = self.scores(text)
+        top = np.argpartition(-scores, self.top_k - 1)[:self.top_k]
+        top = top[np.argsort(-scores[top])]
+        baseline = float(np.median(scores))
+        metrics.observe('category_top_margin', float(scores[top[0]]) - baseline)
+        categories = [self.names[i] for i in top
+                      if scores[i] >= self.min_score and scores[i] - baseline >= self.min_margin]
+        metrics.incr('category_assignments_total', engine='embedding' if categories else 'llm_fallback')
+        return categories or None
+
+
+# 全モジュールで共有するカテゴリエンジン（カテゴリの埋め込みは最初の利用時に取得する）
+category_engine = CategoryEngine.from_env() if CATEGORY_ENGINE == 'embedding' else None
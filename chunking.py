@@ -0,0 +1,138 @@
+import os
+import re
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken がない環境では文字数から概算する
+    tiktoken = None
+
+# 1回の要約リクエストに含める最大トークン数（16kモデルの出力分を残した値）
+CHUNK_TOKENS = int(os.getenv('SUMMARY_CHUNK_TOKENS', '6000'))
+# 1件のニュースで要約する最大チャンク数（これを超える部分は切り捨てる）
+MAX_CHUNKS = int(os.getenv('SUMMARY_MAX_CHUNKS', '4'))
+
+# ナビゲーションや定型文とみなす行のパターン
+# 本文の文（"Shares of Apple fell..." など）を消さないよう、行全体がボタンやリンクの文言の時だけ一致させる
+# 著作権表示は "©"・"Copyright 2024" などで始まる行と "All rights reserved" で終わる行だけ
+BOILERPLATE_PATTERNS = re.compile(
+    r'^(?:'
+    r'(?:accept all(?: cookies)?|cookie (?:settings|preferences|policy)|sign in|sign up|log in|log out|'
+    r'subscribe(?: now)?|share(?: this(?: article| story)?)?|share on \w+|follow us(?: on \w+)?|'
+    r'skip to(?: main)? content|advertisement|privacy policy|terms of (?:use|service))\W*'
+    r'|(?:©|copyright (?:©|\(c\)|\d{4})).*'
+    r'|.*all rights reserved\W*'
+    r')$',
+    re.IGNORECASE,
+)
+
+_encodings = {}
+
+
+def _encoding(model):
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _encodings[model] = tiktoken.get_encoding('cl100k_base')
+    return _encodings[model]
+
+
+# テキストのトークン数を数える関数
+def count_tokens(text, model='gpt-3.5-turbo'):
+    if not text:
+        return 0
+    if tiktoken is not None:
+        return len(_encoding(model).encode(text))
+    # 概算: 英数字は4文字で1トークン、日本語などはおよそ1文字1トークン
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return ascii_chars // 4 + (len(text) - ascii_chars) + 1
+
+
+# テキストを先頭から max_tokens トークン以内に切り詰める関数
+def truncate_tokens(text, max_tokens, model='gpt-3.5-turbo'):
+    if tiktoken is not None:
+        tokens = _encoding(model).encode(text)
+        return text if len(tokens) <= max_tokens else _encoding(model).decode(tokens[:max_tokens])
+    while count_tokens(text, model) > max_tokens:
+        text = text[:int(len(text) * 0.9)]
+    return text
+
+
+# 空行の連続・重複行・定型文の行を取り除く関数
+def strip_boilerplate(text):
+    lines = []
+    seen = set()
+    for line in (text or '').splitlines():
+        line = re.sub(r'[ \t]+', ' ', line).strip()
+        if not line:
+            if lines and lines[-1]:
+                lines.append('')
+            continue
+        if line in seen or (len(line) < 80 and BOILERPLATE_PATTERNS.match(line)):
+            continue
+        seen.add(line)
+        lines.append(line)
+    return '\n'.join(lines).strip()
+
+
+# テキストを段落・文の境界でトークン数の上限以内のチャンクに分割する関数
+def split_into_chunks(text, max_tokens=CHUNK_TOKENS, model='gpt-3.5-turbo'):
+    pieces = []
+    for paragraph in re.split(r'\n\s*\n', text):
+        if count_tokens(paragraph, model) <= max_tokens:
+            pieces.append(paragraph)
+            continue
+        # 長すぎる段落は文単位、それでも長い文はトークン数で分割
+        for sentence in re.split(r'(?<=[.!?。！？])\s+', paragraph):
+            while count_tokens(sentence, model) > max_tokens:
+                head = truncate_tokens(sentence, max_tokens, model)
+                pieces.append(head)
+                sentence = sentence[len(head):]
+            pieces.append(sentence)
+
+    chunks = []
+    current = []
+    current_tokens = 0
+    for piece in pieces:
+        piece_tokens = count_tokens(piece, model)
+        if current and current_tokens + piece_tokens > max_tokens:
+            chunks.append('\n\n'.join(current))
+            current, current_tokens = [], 0
+        current.append(piece)
+        current_tokens += piece_tokens
+    if current:
+        chunks.append('\n\n'.join(current))
+    return [chunk for chunk in chunks if chunk.strip()]
+
+
+# 要約の前処理: 定型文を除き、最大チャンク数以内に分割する関数
+def prepare_chunks(content, chunk_tokens=CHUNK_TOKENS, max_chunks=MAX_CHUNKS):
+    text = strip_boilerplate(content)
+    if count_tokens(text) <= chunk_tokens:
+        return [text]
+    return split_into_chunks(text, chunk_tokens)[:max_chunks]
+
+
+# 長い文章をチャンクごとに並行して要約し、最後にまとめて要約する関数（map-reduce）
+def map_reduce_summarize(content, summarize_fn, chunk_tokens=CHUNK_TOKENS, max_chunks=MAX_CHUNKS):
+    chunks = prepare_chunks(content, chunk_tokens, max_chunks)
+    if len(chunks) == 1:
+        return summarize_fn(chunks[0])
+    with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+        partials = [p for p in executor.map(summarize_fn, chunks) if p]
+    if not partials:
+        return None
+    return summarize_fn(truncate_tokens('\n\n'.join(partials), chunk_tokens))
+
+
+# map_reduce_summarize の非同期版
+async def amap_reduce_summarize(content, summarize_fn, chunk_tokens=CHUNK_TOKENS, max_chunks=MAX_CHUNKS):
+    chunks = prepare_chunks(content, chunk_tokens, max_chunks)
+    if len(chunks) == 1:
+        return await summarize_fn(chunks[0])
+    partials = [p for p in await asyncio.gather(*(summarize_fn(chunk) for chunk in chunks)) if p]
+    if not partials:
+        return None
+    return await summarize_fn(truncate_tokens('\n\n'.join(partials), chunk_tokens))
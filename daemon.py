@@ -0,0 +1,158 @@
+import os
+import time
+import random
+import signal
+import asyncio
+import argparse
+
+from metrics import metrics
+from pipeline import shutdown
+
+# 外部のスケジューラから毎回起動する代わりに、1つのプロセスで新着ニュースを確認し続ける常駐プロセス
+# クライアント・接続・状態ストア・キャッシュはメモリに残るので、確認のたびのコールドスタートがない
+
+# 確認の間隔（秒）の下限と上限
+DAEMON_MIN_INTERVAL = float(os.getenv('DAEMON_MIN_INTERVAL', '15'))
+DAEMON_MAX_INTERVAL = float(os.getenv('DAEMON_MAX_INTERVAL', '600'))
+# 新着がなかった時に間隔を伸ばす倍率と、新着があった時に縮める倍率
+DAEMON_BACKOFF = float(os.getenv('DAEMON_BACKOFF', '2'))
+DAEMON_SPEEDUP = float(os.getenv('DAEMON_SPEEDUP', '0.5'))
+# 複数のプロセスが同じ時刻に確認しないよう、間隔を前後に揺らす割合
+DAEMON_JITTER = 0.1
+
+
+# 新着の量に合わせて確認の間隔を変えるクラス
+# 新着がなければ間隔を伸ばし、新着があれば縮め、1回で処理しきれないほど溜まっていればすぐに確認する
+class AdaptiveInterval:
+    def __init__(self, min_interval=DAEMON_MIN_INTERVAL, max_interval=DAEMON_MAX_INTERVAL,
+                 backoff=DAEMON_BACKOFF, speedup=DAEMON_SPEEDUP):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.speedup = speedup
+        self.interval = min_interval
+
+    def update(self, processed, limit):
+        if limit and processed >= limit:
+            self.interval = self.min_interval
+        elif processed:
+            self.interval = max(self.min_interval, self.interval * self.speedup)
+        else:
+            self.interval = min(self.max_interval, self.interval * self.backoff)
+        return self.interval
+
+
+# エントリポイントのモジュールと、1回分の処理を実行する関数を返す
+# 非同期版は同じイベントループで実行し続け、ループに結びついた接続を使い回す
+def load_entry(name):
+    if name == 'deploy':
+        import maindeploy as module
+        return module, module.process_new_content
+    if name == 'async':
+        import asyncmain as module
+        loop = asyncio.new_event_loop()
+        return module, lambda: loop.run_until_complete(module.check_new_hn_content())
+    if name == 'main':
+        import main as module
+        return module, lambda: module.check_new_hn_content(None)
+    raise ValueError(f"エントリポイント '{name}' は使えません（'main'・'async'・'deploy'）。")
+
+
+# 新着ニュースを確認し続けるクラス
+# 毎回の確認では数バイトの maxitem.json だけを取得し、変化がなく再試行も待っていなければ
+# ニュース一覧の取得とパイプラインの起動を省く
+class NewsDaemon:
+    def __init__(self, module, run_once, interval=None):
+        self.module = module
+        self.run_once = run_once
+        self.interval = interval or AdaptiveInterval()
+        self.last_max_item = None
+        # 前回の処理で取りきれなかったニュースがあれば、変化の確認なしで続きを処理する
+        self.backlog = False
+        self.stats = {'polls': 0, 'unchanged': 0, 'runs': 0, 'stories': 0}
+
+    def has_work(self):
+        if self.backlog or self.module.state_store.due_retries(1):
+            return True
+        # フィードなどのソースは毎回、条件付きリクエストで確認する
+        scheduler = getattr(self.module, 'ingest_scheduler', None)
+        if scheduler is not None and scheduler.polls_always():
+            return True
+        max_item = self.module.hn_source.fetch_max_item()
+        if max_item == self.last_max_item:
+            return False
+        self.last_max_item = max_item
+        return True
+
+    def poll(self):
+        self.stats['polls'] += 1
+        try:
+            changed = self.has_work()
+        except Exception as e:
+            print(f"Error checking for new items: {e}")
+            changed = False
+        processed = 0
+        if changed:
+            processed = self.run_once() or 0
+            self.stats['runs'] += 1
+            self.stats['stories'] += processed
+        else:
+            self.stats['unchanged'] += 1
+        limit = self.module.MAX_ITEMS
+        self.backlog = bool(limit) and processed >= limit
+        interval = self.interval.update(processed, limit)
+        metrics.incr('daemon_polls_total', result='processed' if processed else 'changed' if changed else 'unchanged')
+        metrics.log('poll', changed=changed, processed=processed, next_interval=round(interval, 3))
+        return interval
+
+    # 停止の指示があるまで確認を繰り返す（処理中に指示があれば投入済みのニュースを処理してから戻る）
+    def run(self, max_polls=None):
+        while not shutdown.is_set():
+            interval = self.poll()
+            if max_polls is not None and self.stats['polls'] >= max_polls:
+                break
+            shutdown.wait(interval * random.uniform(1 - DAEMON_JITTER, 1 + DAEMON_JITTER))
+        self.close()
+        return self.stats
+
+    # 持ったままのリースを返し、状態を閉じる
+    def close(self):
+        work_claimer = getattr(self.module, 'work_claimer', None)
+        if work_claimer is not None:
+            work_claimer.close()
+        article_fetcher = getattr(self.module, 'article_fetcher', None)
+        if article_fetcher is not None:
+            article_fetcher.close()
+        metrics.flush()
+
+
+# 1回目の SIGTERM・SIGINT では新しいニュースの投入をやめて処理中のニュースを書き込んでから終了し、
+# 2回目ではすぐに終了する
+def install_signal_handlers():
+    def handle(signum, frame):
+        if shutdown.is_set():
+            raise KeyboardInterrupt
+        print(f"Received signal {signum}, finishing in-flight stories before exit")
+        shutdown.set()
+
+    signal.signal(signal.SIGTERM, handle)
+    signal.signal(signal.SIGINT, handle)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='新着ニュースを確認し続ける常駐プロセス')
+    parser.add_argument('--entry', default=os.getenv('DAEMON_ENTRY', 'deploy'), choices=['main', 'async', 'deploy'],
+                        help='使うエントリポイント')
+    parser.add_argument('--min-interval', type=float, default=DAEMON_MIN_INTERVAL, help='確認の間隔の下限（秒）')
+    parser.add_argument('--max-interval', type=float, default=DAEMON_MAX_INTERVAL, help='確認の間隔の上限（秒）')
+    args = parser.parse_args()
+
+    module, run_once = load_entry(args.entry)
+    install_signal_handlers()
+    started = time.time()
+    stats = NewsDaemon(module, run_once, AdaptiveInterval(args.min_interval, args.max_interval)).run()
+    print(f"Daemon stopped after {round(time.time() - started)}s: {stats}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import tempfile
+import threading
+
+# 重複判定用インデックスのデフォルトの保存先
+DEFAULT_DEDUP_PATH = os.path.join(tempfile.gettempdir(), 'autonews_dedup.sqlite3')
+# 同じ記事とみなすSimHashのハミング距離の上限
+DEFAULT_MAX_DISTANCE = 3
+# 指紋を保持する秒数
+DEFAULT_MAX_AGE = 30 * 24 * 60 * 60
+# 登録の時に期限切れの指紋を削除する間隔（秒）。常駐プロセスでもインデックスが増え続けないようにする
+COMPACT_INTERVAL = 60 * 60
+
+FINGERPRINT_BITS = 64
+# 64ビットを16ビットずつ4つのバンドに分ける。距離3以下なら少なくとも1つのバンドが完全に一致する
+BANDS = 4
+BAND_BITS = FINGERPRINT_BITS // BANDS
+BAND_MASK = (1 << BAND_BITS) - 1
+
+
+# 文章をシングル（連続する語や文字の組）に分解する関数
+def shingles(text, size=3):
+    text = (text or '').lower()
+    words = re.findall(r'\w+', text)
+    # 空白で区切られない日本語などは文字単位のシングルにする
+    if len(words) < size * 4:
+        chars = re.sub(r'\W+', '', text)
+        return {chars[i:i + 4] for i in range(max(len(chars) - 3, 1))} if chars else set()
+    return {' '.join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+# 64ビットのSimHash指紋を計算する関数
+def simhash(text):
+    weights = [0] * FINGERPRINT_BITS
+    for shingle in shingles(text):
+        value = int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'big')
+        for bit in range(FINGERPRINT_BITS):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    fingerprint = 0
+    for bit, weight in enumerate(weights):
+        if weight > 0:
+            fingerprint |= 1 << bit
+    return fingerprint
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+# SQLiteのINTEGER（符号付き64ビット）との相互変換
+def _to_signed(value):
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _to_unsigned(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+# 最近処理した記事の指紋を保存し、ほぼ同じ記事の過去の生成結果を探すインデックス
+# 検索はメモリ上のバンド索引で行うので、数万件でも1ミリ秒未満で終わる
+# 保持期間を過ぎた指紋は検索で使わず、compact（登録の時にも定期的に呼ぶ）でファイルと索引から削除する
+class DedupIndex:
+    def __init__(self, path=DEFAULT_DEDUP_PATH, max_distance=DEFAULT_MAX_DISTANCE, max_age=DEFAULT_MAX_AGE,
+                 compact_interval=COMPACT_INTERVAL):
+        self.max_distance = max_distance
+        self.max_age = max_age
+        self.compact_interval = compact_interval
+        self._lock = threading.Lock()
+        # item_id -> (指紋, 登録時刻)
+        self._entries = {}
+        # バンドの値 -> item_id のリスト
+        self._bands = [dict() for _ in range(BANDS)]
+        self._last_compacted = time.time()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS fingerprints ('
+            ' item_id INTEGER PRIMARY KEY,'
+            ' fingerprint INTEGER NOT NULL,'
+            ' created_at REAL NOT NULL,'
+            ' enrichment TEXT NOT NULL)'
+        )
+        self._load()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            path=os.getenv('DEDUP_PATH', DEFAULT_DEDUP_PATH),
+            max_distance=int(os.getenv('DEDUP_MAX_DISTANCE', DEFAULT_MAX_DISTANCE)),
+            max_age=float(os.getenv('DEDUP_MAX_AGE', DEFAULT_MAX_AGE)),
+        )
+
+    # 期限切れの指紋を削除し、残りをバンド索引に読み込む
+    def _load(self):
+        if self.max_age:
+            self._conn.execute('DELETE FROM fingerprints WHERE created_at < ?', (time.time() - self.max_age,))
+        for item_id, fingerprint, created_at in self._conn.execute(
+                'SELECT item_id, fingerprint, created_at FROM fingerprints'):
+            self._index(item_id, _to_unsigned(fingerprint), created_at)
+
+    # 指紋を索引に登録する（同じ記事の指紋が変わっていれば古い方を外す）
+    def _index(self, item_id, fingerprint, created_at):
+        previous = self._entries.get(item_id)
+        self._entries[item_id] = (fingerprint, created_at)
+        if previous is not None:
+            if previous[0] == fingerprint:
+                return
+            self._unindex(item_id, previous[0])
+        for band, table in enumerate(self._bands):
+            key = fingerprint >> (band * BAND_BITS) & BAND_MASK
+            table.setdefault(key, []).append(item_id)
+
+    def _unindex(self, item_id, fingerprint):
+        for band, table in enumerate(self._bands):
+            key = fingerprint >> (band * BAND_BITS) & BAND_MASK
+            item_ids = table.get(key, [])
+            if item_id in item_ids:
+                item_ids.remove(item_id)
+            if not item_ids:
+                table.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+    # 最も近い指紋の (item_id, 距離) を返す（しきい値を超える場合と、保持期間を過ぎた指紋は使わない）
+    def nearest(self, fingerprint):
+        best = None
+        cutoff = time.time() - self.max_age if self.max_age else None
+        with self._lock:
+            for band, table in enumerate(self._bands):
+                key = fingerprint >> (band * BAND_BITS) & BAND_MASK
+                for item_id in table.get(key, ()):
+                    candidate, created_at = self._entries[item_id]
+                    if cutoff is not None and created_at < cutoff:
+                        continue
+                    distance = hamming_distance(fingerprint, candidate)
+                    if distance <= self.max_distance and (best is None or distance < best[1]):
+                        best = (item_id, distance)
+        return best
+
+    # ほぼ同じ記事があれば、その生成結果を返す
+    def find(self, text):
+        match = self.nearest(simhash(text))
+        if match is None:
+            return None
+        item_id, distance = match
+        row = self._conn.execute('SELECT enrichment FROM fingerprints WHERE item_id = ?', (item_id,)).fetchone()
+        if row is None:
+            return None
+        return {'item_id': item_id, 'distance': distance, 'enrichment': json.loads(row[0])}
+
+    # 記事の指紋と生成結果を登録する
+    def add(self, item_id, text, enrichment):
+        fingerprint = simhash(text)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO fingerprints (item_id, fingerprint, created_at, enrichment) '
+                'VALUES (?, ?, ?, ?)',
+                (item_id, _to_signed(fingerprint), now, json.dumps(enrichment, ensure_ascii=False)),
+            )
+            self._index(item_id, fingerprint, now)
+        if self.compact_interval is not None and now - self._last_compacted >= self.compact_interval:
+            self.compact()
+        return fingerprint
+
+    # 保持期間を過ぎた指紋をファイルと索引から削除し、削除した件数を返す
+    def compact(self):
+        self._last_compacted = time.time()
+        if not self.max_age:
+            return 0
+        cutoff = self._last_compacted - self.max_age
+        with self._lock:
+            expired = [item_id for item_id, (_, created_at) in self._entries.items() if created_at < cutoff]
+            for item_id in expired:
+                self._unindex(item_id, self._entries.pop(item_id)[0])
+            self._conn.execute('DELETE FROM fingerprints WHERE created_at < ?', (cutoff,))
+        return len(expired)
+
+    def close(self):
+        self._conn.close()
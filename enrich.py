@@ -0,0 +1,137 @@
+import os
+import json
+
+from llm import chat_completion, achat_completion
+from chunking import count_tokens, CHUNK_TOKENS
+from metrics import timed
+
+# 'combined' を指定すると1回のAPI呼び出しで要約・意見・リード文・カテゴリを生成する
+ENRICH_MODE = os.getenv('ENRICH_MODE', 'stages')
+# まとめて生成する時に使うモデル
+ENRICH_MODEL = os.getenv('ENRICH_MODEL', 'gpt-3.5-turbo-16k-0613')
+ENRICH_TEMPERATURE = float(os.getenv('ENRICH_TEMPERATURE', '0'))
+
+# 各ステージが失敗した時に返すメッセージ
+FAILURE_MESSAGES = {
+    "要約できませんでした",
+    "意見を生成できませんでした",
+    "リード文を生成できませんでした",
+    "カテゴリを生成できませんでした",
+}
+
+ENRICH_SYSTEM_PROMPT = (
+    "あなたは優秀なニュース編集アシスタントです。提供された文章をもとに、"
+    "できる限り正確な日本語の要約、日本語のリード文、文章に関する感想や意見、"
+    "カテゴリ(2個から3個)を生成し、enrich 関数の引数として返してください。"
+)
+
+
+# カテゴリ用のスキーマに要約・意見・リード文を加えた関数定義を作る
+def build_enrich_function(schema):
+    properties = {
+        "summary": {"type": "string", "description": "文章の正確な要約"},
+        "lead": {"type": "string", "description": "日本語のリード文"},
+        "opinion": {"type": "string", "description": "文章に関する感想や意見"},
+    }
+    properties.update(schema["properties"])
+    return {
+        "name": "enrich",
+        "description": "ニュース記事の要約・リード文・意見・カテゴリを記録する",
+        "parameters": {
+            "type": "object",
+            "properties": properties,
+            "required": ["summary", "lead", "opinion"] + list(schema.get("required", [])),
+        },
+    }
+
+
+# 生成結果の4項目
+ENRICHMENT_FIELDS = ('summary', 'opinion', 'lead', 'categories')
+
+
+# 生成に失敗した項目（空やエラーメッセージ）があった時に送出する例外
+class GenerationFailed(Exception):
+    pass
+
+
+def is_failed(value):
+    return not value or (isinstance(value, str) and value in FAILURE_MESSAGES)
+
+
+# 生成結果を検証し、失敗していれば GenerationFailed を送出する関数
+def require(value, field):
+    if is_failed(value):
+        raise GenerationFailed(f"{field}: {value!r}")
+    return value
+
+
+# 4項目すべてが生成できているか判定する関数
+def is_complete(enrichment):
+    return not any(is_failed(enrichment.get(key)) for key in ENRICHMENT_FIELDS)
+
+
+# 関数呼び出しの結果を検証し、問題があれば None を返す
+def parse_enrichment(result, schema):
+    function_call = (result or {}).get('function_call')
+    if not function_call:
+        return None
+    try:
+        arguments = json.loads(function_call.get('arguments') or '')
+    except ValueError:
+        return None
+    required = ["summary", "lead", "opinion"] + list(schema.get("required", []))
+    for key in required:
+        value = arguments.get(key)
+        if not isinstance(value, str) or not value.strip():
+            return None
+    categories = [
+        arguments[key].strip() for key in schema["properties"]
+        if isinstance(arguments.get(key), str) and arguments[key].strip()
+    ]
+    return {
+        'summary': arguments['summary'].strip(),
+        'opinion': arguments['opinion'].strip(),
+        'lead': arguments['lead'].strip(),
+        'categories': categories,
+        'usage': result.get('usage', {}),
+    }
+
+
+# まとめて生成するリクエストの引数を作る関数（バッチAPI用のファイルにも使う）
+def enrich_request(content, schema):
+    function = build_enrich_function(schema)
+    return dict(
+        model=ENRICH_MODEL,
+        temperature=ENRICH_TEMPERATURE,
+        messages=[
+            {"role": "system", "content": ENRICH_SYSTEM_PROMPT},
+            {"role": "user", "content": content},
+        ],
+        functions=[function],
+        function_call={"name": function["name"]},
+    )
+
+
+# 1回の呼び出しで4項目を生成する関数
+# 1チャンクに収まらない長文や検証に失敗した場合は None を返すので、呼び出し側で個別のステージに切り替える
+@timed('enrich')
+def enrich_content(content, schema):
+    if count_tokens(content) > CHUNK_TOKENS:
+        return None
+    try:
+        return parse_enrichment(chat_completion(**enrich_request(content, schema)), schema)
+    except Exception as e:
+        print(f"Error in combined enrichment: {e}")
+        return None
+
+
+# enrich_content の非同期版
+@timed('enrich')
+async def aenrich_content(content, schema):
+    if count_tokens(content) > CHUNK_TOKENS:
+        return None
+    try:
+        return parse_enrichment(await achat_completion(**enrich_request(content, schema)), schema)
+    except Exception as e:
+        print(f"Error in combined enrichment: {e}")
+        return None
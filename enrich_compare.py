@@ -0,0 +1,116 @@
+import os
+import json
+import time
+import argparse
+import statistics
+
+# 比較のためキャッシュを無効にしてから読み込む
+os.environ['LLM_CACHE_PATH'] = ''
+
+import main as sync_main
+import enrich
+from hnsource import HNItemSource
+
+
+# API呼び出しの回数とトークン数を記録するクラス
+class UsageRecorder:
+    def __init__(self, chat_completion):
+        self._chat_completion = chat_completion
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def add(self, calls, prompt_tokens, completion_tokens):
+        self.calls += calls
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+
+    def __call__(self, *args, **kwargs):
+        result = self._chat_completion(*args, **kwargs)
+        usage = result.get('usage') or {}
+        self.add(1, usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0))
+        return result
+
+
+# 個別のステージで4項目を生成する
+def run_stages(content):
+    from langchain.callbacks import get_openai_callback
+
+    summary = sync_main.summarize_content(content)
+    sync_main.generate_opinion(summary)
+    sync_main.generate_lead(summary)
+    # 抽出チェーンは langchain 経由なのでコールバックでトークン数を数える
+    with get_openai_callback() as callback:
+        sync_main.generate_category(summary)
+    return callback.successful_requests, callback.prompt_tokens, callback.completion_tokens
+
+
+# 1回の呼び出しで4項目を生成する
+def run_combined(content):
+    if enrich.enrich_content(content, sync_main.schema) is None:
+        # 検証に失敗した場合は実運用と同じく個別のステージに切り替える
+        return run_stages(content)
+    return 0, 0, 0
+
+
+def measure(mode, items, recorder):
+    latencies = []
+    for item in items:
+        recorder.reset()
+        started = time.perf_counter()
+        run = run_combined if mode == 'combined' else run_stages
+        recorder.add(*run(item['page_content']))
+        latencies.append(time.perf_counter() - started)
+        yield {
+            'mode': mode,
+            'id': item['id'],
+            'latency_s': latencies[-1],
+            'calls': recorder.calls,
+            'prompt_tokens': recorder.prompt_tokens,
+            'completion_tokens': recorder.completion_tokens,
+        }
+
+
+def summarize(rows):
+    latencies = sorted(r['latency_s'] for r in rows)
+    return {
+        'stories': len(rows),
+        'latency_p50_s': statistics.median(latencies),
+        'latency_p95_s': latencies[max(0, int(len(latencies) * 0.95) - 1)],
+        'calls_per_story': statistics.mean(r['calls'] for r in rows),
+        'prompt_tokens_per_story': statistics.mean(r['prompt_tokens'] for r in rows),
+        'completion_tokens_per_story': statistics.mean(r['completion_tokens'] for r in rows),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='個別ステージとまとめて生成するモードのレイテンシとトークン数を比較します')
+    parser.add_argument('--count', type=int, default=5, help='比較に使う新着ニュースの件数')
+    parser.add_argument('--corpus', help='id と page_content を持つJSONLファイル（省略時はHNから取得）')
+    args = parser.parse_args()
+
+    if args.corpus:
+        with open(args.corpus, encoding='utf-8') as f:
+            items = [json.loads(line) for line in f if line.strip()][:args.count]
+    else:
+        items = HNItemSource().fetch_new(None, args.count)
+
+    # 実際のAPI呼び出しを記録するラッパーに差し替える
+    recorder = UsageRecorder(sync_main.chat_completion)
+    sync_main.chat_completion = recorder
+    enrich.chat_completion = recorder
+
+    report = {}
+    for mode in ('stages', 'combined'):
+        rows = list(measure(mode, items, recorder))
+        for row in rows:
+            print(json.dumps(row, ensure_ascii=False))
+        report[mode] = summarize(rows)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+import re
+import html
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import timed
+
+# Hacker News 公式APIのURL
+HN_API_URL = 'https://hacker-news.firebaseio.com/v0'
+
+
+# HNのHTML形式のテキストをプレーンテキストに変換する関数
+def html_to_text(value):
+    if not value:
+        return ''
+    value = re.sub(r'<p>', '\n\n', value)
+    value = re.sub(r'<[^>]+>', '', value)
+    return html.unescape(value).strip()
+
+
+# HNのアイテムを HNLoader と同じく 'id' と 'page_content' を持つ辞書に変換する関数
+def item_to_document(item):
+    parts = [item.get('title', ''), item.get('url', ''), html_to_text(item.get('text'))]
+    return {
+        'id': item['id'],
+        'title': item.get('title', ''),
+        'url': item.get('url'),
+        'by': item.get('by'),
+        'time': item.get('time'),
+        'score': item.get('score', 0),
+        'page_content': '\n\n'.join(part for part in parts if part),
+    }
+
+
+# アイテムIDの最大値（ウォーターマーク）を基準に、未確認の新着ストーリーだけを取得するクラス
+class HNItemSource:
+    def __init__(self, base_url=HN_API_URL, max_workers=8, timeout=10, session=None):
+        self.base_url = base_url.rstrip('/')
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.request_count = 0
+        # 前回取得した新着一覧の最小のID（これより古いIDは新着一覧から外れている）
+        self.oldest_new_id = None
+        # パス -> (ETag, 前回の値)。条件付きリクエストで変化がなければ前回の値を使う
+        self._etags = {}
+        # キープアライブ接続をプールして使い回すセッション
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+
+    # conditional=True なら前回の ETag を If-None-Match で送り、304 の時は本文を受け取らずに前回の値を返す
+    # （Firebase は X-Firebase-ETag を付けたリクエストにだけ ETag を返す）
+    def _get_json(self, path, conditional=False):
+        headers = {}
+        cached = self._etags.get(path) if conditional else None
+        if conditional:
+            headers['X-Firebase-ETag'] = 'true'
+        if cached:
+            headers['If-None-Match'] = cached[0]
+        response = self.session.get(f'{self.base_url}/{path}', timeout=self.timeout, headers=headers)
+        self.request_count += 1
+        if response.status_code == 304 and cached:
+            return cached[1]
+        response.raise_for_status()
+        value = response.json()
+        if conditional and response.headers.get('ETag'):
+            self._etags[path] = (response.headers['ETag'], value)
+        return value
+
+    # 現在の最大アイテムIDを取得する（数バイトのレスポンスで変化の有無を確認できる）
+    def fetch_max_item(self):
+        return self._get_json('maxitem.json')
+
+    # ウォーターマークより新しいストーリーのIDを古い順に返す
+    # limit を超える場合、初回は最新の limit 件、それ以外は古い方から limit 件を返す
+    # filter_unseen（IDのリストから未処理のものを返す関数）を渡すと、処理済みのIDを除いてから件数を絞る
+    @timed('hn_fetch_ids')
+    def fetch_new_ids(self, watermark=None, limit=None, filter_unseen=None):
+        if watermark is not None and self.fetch_max_item() <= watermark:
+            return []
+        story_ids = self._get_json('newstories.json', conditional=True) or []
+        if story_ids:
+            self.oldest_new_id = min(story_ids)
+        new_ids = sorted(i for i in story_ids if watermark is None or i > watermark)
+        if filter_unseen is not None:
+            new_ids = filter_unseen(new_ids)
+        if limit and len(new_ids) > limit:
+            new_ids = new_ids[-limit:] if watermark is None else new_ids[:limit]
+        return new_ids
+
+    # トップページのストーリーのIDを順位の順に返す
+    def fetch_top_ids(self, limit=None):
+        story_ids = self._get_json('topstories.json', conditional=True) or []
+        return story_ids[:limit] if limit else story_ids
+
+    def fetch_item(self, item_id):
+        return self._get_json(f'item/{item_id}.json')
+
+    # 1件のアイテムを取得して辞書に変換する（削除済みなら None を返す）
+    def fetch_document(self, item_id):
+        item = self.fetch_item(item_id)
+        if not item or item.get('deleted') or item.get('dead'):
+            return None
+        return item_to_document(item)
+
+    # 複数のアイテムを並行に取得し、削除済みのものを除いてID順に返す
+    @timed('hn_fetch_items')
+    def fetch_items(self, item_ids):
+        if not item_ids:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(item_ids))) as executor:
+            documents = list(executor.map(self.fetch_document, item_ids))
+        return [document for document in documents if document]
+
+    # 未確認の新着ストーリーを取得する
+    def fetch_new(self, watermark=None, limit=None):
+        return self.fetch_items(self.fetch_new_ids(watermark, limit))
@@ -0,0 +1,136 @@
+import openai
+from llmcache import LLMCache
+from ratelimit import limiter, estimate_tokens, call_with_retries, acall_with_retries
+from metrics import metrics
+from chunking import truncate_tokens
+
+# 全エントリポイントで共有するLLM出力キャッシュ
+cache = LLMCache.from_env()
+
+# Embeddings API に渡す1テキストあたりの最大トークン数
+EMBEDDING_MAX_TOKENS = 8000
+
+
+# OpenAIのレスポンスをキャッシュ可能な辞書に変換する関数
+def _to_result(response):
+    message = response.choices[0].message
+    function_call = message.get('function_call')
+    return {
+        'model': response.get('model'),
+        'content': message.get('content'),
+        'function_call': dict(function_call) if function_call else None,
+        'usage': dict(response.get('usage') or {}),
+    }
+
+
+# Chat Completions API を呼び出す関数（キャッシュ・レート制限・再試行付き）
+def chat_completion(model, temperature, messages, **params):
+    def call():
+        return openai.ChatCompletion.create(
+            model=model,
+            temperature=temperature,
+            messages=messages,
+            **params
+        )
+
+    computed = []
+
+    def compute():
+        computed.append(True)
+        result = _to_result(call_with_retries(model, messages, call, params.get('max_tokens')))
+        metrics.record_usage(model, result['usage'])
+        return result
+
+    key = cache.make_key(model, temperature, messages, **params)
+    result = cache.get_or_compute(key, temperature, compute)
+    if not computed:
+        metrics.incr('llm_cache_hits_total', model=model)
+    return result
+
+
+# chat_completion の非同期版
+async def achat_completion(model, temperature, messages, **params):
+    async def call():
+        return await openai.ChatCompletion.acreate(
+            model=model,
+            temperature=temperature,
+            messages=messages,
+            **params
+        )
+
+    computed = []
+
+    async def compute():
+        computed.append(True)
+        result = _to_result(await acall_with_retries(model, messages, call, params.get('max_tokens')))
+        metrics.record_usage(model, result['usage'])
+        return result
+
+    key = cache.make_key(model, temperature, messages, **params)
+    result = await cache.aget_or_compute(key, temperature, compute)
+    if not computed:
+        metrics.incr('llm_cache_hits_total', model=model)
+    return result
+
+
+# langchain のコールバックで集計したトークン数を usage の形式に変換する
+def _callback_usage(callback):
+    return {'prompt_tokens': callback.prompt_tokens, 'completion_tokens': callback.completion_tokens}
+
+
+# langchain の抽出チェーンの結果をキャッシュする関数
+# チェーン内の再試行は langchain に任せ、呼び出し前にレート制限の枠だけ確保する
+def cached_extraction(model, schema, prompt, run):
+    messages = [{'role': 'user', 'content': prompt}]
+
+    def compute():
+        limiter.acquire(model, estimate_tokens(messages))
+        if not metrics.enabled:
+            return run()
+        from langchain.callbacks import get_openai_callback
+        with get_openai_callback() as callback:
+            result = run()
+        metrics.record_usage(model, _callback_usage(callback), stage='category')
+        return result
+
+    key = cache.make_key('extraction:' + model, 0, messages, schema=schema)
+    return cache.get_or_compute(key, 0, compute)
+
+
+# cached_extraction の非同期版
+async def acached_extraction(model, schema, prompt, run):
+    messages = [{'role': 'user', 'content': prompt}]
+
+    async def compute():
+        await limiter.aacquire(model, estimate_tokens(messages))
+        if not metrics.enabled:
+            return await run()
+        from langchain.callbacks import get_openai_callback
+        with get_openai_callback() as callback:
+            result = await run()
+        metrics.record_usage(model, _callback_usage(callback), stage='category')
+        return result
+
+    key = cache.make_key('extraction:' + model, 0, messages, schema=schema)
+    return await cache.aget_or_compute(key, 0, compute)
+
+
+# Embeddings API でベクトルを取得する関数（テキストごとにキャッシュし、未取得の分だけ1回でまとめて取得）
+def embed(texts, model='text-embedding-ada-002'):
+    keys = [cache.make_key('embedding:' + model, 0, [{'role': 'user', 'content': text}]) for text in texts]
+    vectors = [cache.get(key) if cache.enabled_for(0) else None for key in keys]
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    if missing:
+        inputs = [truncate_tokens(texts[i], EMBEDDING_MAX_TOKENS) for i in missing]
+
+        def call():
+            return openai.Embedding.create(model=model, input=inputs)
+
+        response = call_with_retries(model, [{'content': text} for text in inputs], call, max_tokens=1)
+        metrics.record_usage(model, dict(response.get('usage') or {}), stage='embedding')
+        for i, data in zip(missing, sorted(response['data'], key=lambda d: d['index'])):
+            vectors[i] = list(data['embedding'])
+            cache.set(keys[i], vectors[i])
+    if len(missing) < len(texts):
+        metrics.incr('llm_cache_hits_total', len(texts) - len(missing), model=model)
+    return vectors
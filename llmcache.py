@@ -0,0 +1,155 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import tempfile
+import threading
+
+# キャッシュのデフォルト設定
+DEFAULT_CACHE_PATH = os.path.join(tempfile.gettempdir(), 'autonews_llm_cache.sqlite3')
+DEFAULT_TTL = 7 * 24 * 60 * 60  # 7日間
+DEFAULT_MAX_ENTRIES = 10000
+
+
+# 文字列のハッシュを計算する関数
+def content_hash(text):
+    return hashlib.sha256((text or '').encode('utf-8')).hexdigest()
+
+
+# LLMの出力を (モデル, 温度, プロンプト, 本文ハッシュ) をキーに保存するキャッシュ
+class LLMCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES,
+                 cache_nondeterministic=False):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # temperature > 0 の結果をキャッシュするかどうか（オプトイン）
+        self.cache_nondeterministic = cache_nondeterministic
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                ' key TEXT PRIMARY KEY,'
+                ' value TEXT NOT NULL,'
+                ' created_at REAL NOT NULL,'
+                ' accessed_at REAL NOT NULL)'
+            )
+            self._conn.execute('CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)')
+
+    # 環境変数から設定を読み込んでキャッシュを作成する
+    @classmethod
+    def from_env(cls):
+        return cls(
+            path=os.getenv('LLM_CACHE_PATH', DEFAULT_CACHE_PATH),
+            ttl=float(os.getenv('LLM_CACHE_TTL', DEFAULT_TTL)),
+            max_entries=int(os.getenv('LLM_CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES)),
+            cache_nondeterministic=os.getenv('LLM_CACHE_NONDETERMINISTIC') == '1',
+        )
+
+    # この温度の呼び出しをキャッシュしてよいか判定する
+    def enabled_for(self, temperature):
+        if self._conn is None:
+            return False
+        return temperature == 0 or self.cache_nondeterministic
+
+    # キャッシュキーを作成する（最後のメッセージを本文、それ以外をプロンプトとして扱う）
+    def make_key(self, model, temperature, messages, **params):
+        prompt = [dict(m) for m in messages[:-1]]
+        last = dict(messages[-1]) if messages else {}
+        body = last.pop('content', '')
+        key_source = json.dumps(
+            [model, temperature, prompt, last, content_hash(body), params],
+            sort_keys=True, ensure_ascii=False, default=str,
+        )
+        return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        if self._conn is None:
+            return None
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value, created_at FROM entries WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            value, created_at = row
+            # 有効期限切れのエントリは削除してミス扱いにする
+            if self.ttl and now - created_at > self.ttl:
+                self._conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self._conn.execute('UPDATE entries SET accessed_at = ? WHERE key = ?', (now, key))
+            self.hits += 1
+        return json.loads(value)
+
+    def set(self, key, value):
+        if self._conn is None:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO entries (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)',
+                (key, json.dumps(value, ensure_ascii=False), now, now),
+            )
+            self._evict()
+
+    # 上限を超えた分を最終アクセスが古い順に削除する（LRU）
+    def _evict(self):
+        if not self.max_entries:
+            return
+        (count,) = self._conn.execute('SELECT COUNT(*) FROM entries').fetchone()
+        overflow = count - self.max_entries
+        if overflow > 0:
+            self._conn.execute(
+                'DELETE FROM entries WHERE key IN '
+                '(SELECT key FROM entries ORDER BY accessed_at ASC LIMIT ?)',
+                (overflow,),
+            )
+            self.evictions += overflow
+
+    # キャッシュにあればそれを返し、なければ compute() の結果を保存して返す
+    def get_or_compute(self, key, temperature, compute):
+        if not self.enabled_for(temperature):
+            return compute()
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        value = compute()
+        if value is not None:
+            self.set(key, value)
+        return value
+
+    # get_or_compute の非同期版
+    async def aget_or_compute(self, key, temperature, compute):
+        if not self.enabled_for(temperature):
+            return await compute()
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        value = await compute()
+        if value is not None:
+            self.set(key, value)
+        return value
+
+    # ヒット・ミスの統計を返す
+    def stats(self):
+        size = 0
+        if self._conn is not None:
+            with self._lock:
+                (size,) = self._conn.execute('SELECT COUNT(*) FROM entries').fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': size}
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -1,14 +1,27 @@
 import os
 import requests
 import traceback
-from langchain.document_loaders import HNLoader
 from langchain.chat_models import ChatOpenAI
 from langchain.chains import create_extraction_chain
 import openai
+from llm import chat_completion, cached_extraction
+from hnsource import HNItemSource
+from metrics import metrics, timed
+from sheetwriter import format_categories
+from chunking import map_reduce_summarize
+from enrich import ENRICH_MODE, ENRICHMENT_FIELDS, enrich_content, require
+from dedup import DedupIndex
+from statestore import StateStore, RETRY_MAX_ATTEMPTS
+from categorizer import category_engine
+from articlefetch import ARTICLE_FETCH, ArticleFetcher, with_article_text
+from routing import model_router
+from sources import IngestScheduler
+from archive import ArticleArchive, archive_record
+from pipeline import ThreadPipeline, Stage, stage_workers, shutdown
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 from google.auth.transport.requests import Request
-import datetime
+from datetime import datetime
 
 # 環境変数から認証情報を取得
 client_id = os.getenv('GOOGLE_CLIENT_ID')
@@ -19,6 +32,25 @@ project_id = os.getenv('GOOGLE_PROJECT_ID')
 
 # 最後に確認したニュースのID
 last_checked_id = None
+# 1回の実行で処理するニュースの最大数
+MAX_ITEMS = int(os.getenv('HN_MAX_ITEMS', '30'))
+# 新着ニュースの取得元（接続を使い回すためモジュールで共有）
+hn_source = HNItemSource()
+# HNの新着・トップページ・RSS/Atom フィードから処理するニュースを選ぶスケジューラ（INGEST_SOURCES で設定する）
+ingest_scheduler = IngestScheduler.from_env()
+# ほぼ同じ記事を検出するための指紋インデックス
+dedup_index = DedupIndex.from_env()
+
+# ステージの出力と再試行キューを保存するローカルの状態ストア
+state_store = StateStore.from_env()
+
+# 生成結果を保存するローカルのアーカイブ（ARCHIVE=0 で無効）
+article_archive = ArticleArchive.from_env()
+# スプレッドシートにも書き出すかどうか（'0' ならアーカイブだけに保存する）
+SHEET_EXPORT = os.getenv('SHEET_EXPORT', '1') == '1'
+
+# リンク先の記事本文の取得元（接続とレスポンスキャッシュを共有する）
+article_fetcher = ArticleFetcher.from_env() if ARTICLE_FETCH else None
 # OpenAI APIキーの取得
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
@@ -34,43 +66,56 @@ schema = {
 
 def openai_api_call(model, temperature, messages):
     try:
-        response = openai.ChatCompletion.create(
-            model=model,
-            temperature=temperature,
-            messages=messages
-        )
-        return response.choices[0].message['content']
+        response = chat_completion(model, temperature, messages)
+        return response['content']
     except Exception as e:
         print(f"Error in OpenAI API call: {e}")
         traceback.print_exc()
         return None
 
 # カテゴリー作成関数
+@timed('category')
 def generate_category(content):
+    # 埋め込みで十分な確信度が得られれば、LLMを呼ばずに固定のカテゴリ一覧から割り当てる
+    if category_engine is not None:
+        try:
+            categories = category_engine.assign(content)
+            if categories:
+                return categories
+        except Exception as e:
+            print(f"Error in embedding category assignment: {e}")
     try:
-        # LLM (Language Model) を初期化
-        llm = ChatOpenAI(temperature=0, model="gpt-3.5-turbo")
-        # 抽出チェーンを作成
-        chain = create_extraction_chain(schema, llm)
-        # チェーンを実行
-        extracted_categories = chain.run(f"あなたは優秀なカテゴリ生成アシスタントです。提供された文章をもとに、カテゴリ(2個から3個)を生成してください。\n\n{content}")
+        prompt = f"あなたは優秀なカテゴリ生成アシスタントです。提供された文章をもとに、カテゴリ(2個から3個)を生成してください。\n\n{content}"
+
+        def run():
+            # LLM (Language Model) を初期化
+            llm = ChatOpenAI(temperature=0, model="gpt-3.5-turbo")
+            # 抽出チェーンを作成
+            chain = create_extraction_chain(schema, llm)
+            # チェーンを実行
+            return chain.run(prompt)
+
+        # 同じ内容なら前回の抽出結果をキャッシュから再利用
+        extracted_categories = cached_extraction("gpt-3.5-turbo", schema, prompt, run)
         return extracted_categories
     except Exception as e:
         print(f"Error in category generation: {e}")
         traceback.print_exc()
         return "カテゴリを生成できませんでした"
     
-# リード文作成関数
+# リード文作成関数（意見と同じく、品質チェックに通らなければ大きなモデルに切り替える）
+@timed('lead')
 def generate_lead(content):
     try:
-        lead = openai_api_call(
-        "gpt-3.5-turbo-0613",
+        lead = model_router.complete(
+        'lead',
         0.6,
         [
             {"role": "system", "content": "あなたは優秀なリード文生成アシスタントです。提供された文章をもとに、日本語のリード文を生成してください。"},
             {"role": "user", "content": content}
-        ]
-    )
+        ],
+        openai_api_call,
+        )
         return lead
     except Exception as e:
         print(f"Error in lead generation: {e}")
@@ -78,17 +123,25 @@ def generate_lead(content):
         return "リード文を生成できませんでした"
 
 
-# 要約用の関数
-def summarize_content(content):
-    try:
-        summary = openai_api_call(
-        "gpt-3.5-turbo-16k-0613",
+# 文章の一部（チャンク）を要約する関数（トークン数がコンテキストに収まる最も速いモデルを使う）
+@timed('summarize_chunk')
+def summarize_chunk(content):
+    return model_router.complete(
+        'summarize',
         0,
         [
             {"role": "system", "content": "あなたは優秀な要約アシスタントです。提供された文章をもとに、できる限り正確な内容にすることを意識して要約してください。"},
             {"role": "user", "content": content}
-        ]
-        )
+        ],
+        openai_api_call,
+    )
+
+
+# 要約用の関数（長い文章はトークン数で分割して並行に要約し、最後にまとめる）
+@timed('summarize')
+def summarize_content(content):
+    try:
+        summary = map_reduce_summarize(content, summarize_chunk)
         return summary
     except Exception as e:
         print(f"Error in summarization: {e}")
@@ -96,16 +149,18 @@ def summarize_content(content):
         return "要約できませんでした"
 
 
-# 意見生成用の関数
+# 意見生成用の関数（速いモデルから試し、短すぎる・日本語でない場合は gpt-4 に切り替える）
+@timed('opinion')
 def generate_opinion(content):
     try:
-        opinion = openai_api_call(
-        "gpt-4",
+        opinion = model_router.complete(
+        'opinion',
         0.6,
         [
             {"role": "system", "content": "あなたは優秀な意見生成アシスタントです。提供された文章をもとに、文章に関する感想や意見を生成してください。"},
             {"role": "user", "content": content}
-        ]
+        ],
+        openai_api_call,
         )
         return opinion
     except Exception as e:
@@ -115,7 +170,8 @@ def generate_opinion(content):
 
 
 # スプレッドシートへの書き込み関数
-def write_to_sheet(summary, opinion, categories, lead):
+@timed('sheets_write')
+def write_to_sheet(summary, opinion, categories, lead, item_id=None):
     creds = Credentials(
     None,  # アクセストークンは最初はNoneに設定
     refresh_token=refresh_token,
@@ -140,50 +196,161 @@ def write_to_sheet(summary, opinion, categories, lead):
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
     # データの書き込み
-    values = [[now, summary, opinion, ", ".join(categories), lead]]
+    values = [[now, summary, opinion, format_categories(categories), lead, item_id]]
     body = {'values': values}
     result = service.spreadsheets().values().append(
         spreadsheetId=SPREADSHEET_ID, range=RANGE_NAME,
         valueInputOption='RAW', body=body).execute()
 
 
-# 新しいHacker Newsのコンテンツを確認する関数
-def check_new_hn_content(request):
-    global last_checked_id
-    try:
-        # Hacker Newsのトップページをロード
-        loader = HNLoader("https://news.ycombinator.com/")
-        data = loader.load()
+# ---- パイプラインのステージ ----
+# 各ステージは1件のニュース（辞書）を受け取り、生成した項目を追加して次のステージに渡す
+# 各ステージの出力は状態ストアに保存し、失敗したニュースは次回、保存済みの続きから処理する
+
+# 生成結果を検証してチェックポイントに保存する（失敗していれば例外で再試行キューに回す）
+def checkpoint(item, field, value):
+    item[field] = require(value, field)
+    state_store.save_checkpoint(item['id'], field, item[field])
+
+
+# 取得ステージ：IDからニュースの内容を取得する（削除済みなら除外、フィードの記事は内容が渡される）
+# 途中まで処理したニュースは、保存済みの内容と生成結果から再開する
+def fetch_stage(value):
+    item_id = value['id'] if isinstance(value, dict) else value
+    saved = state_store.checkpoints(item_id)
+    if 'document' in saved:
+        item = saved.pop('document')
+        item.update(saved)
+        item['resumed'] = True
+        return item
+    # フィードの記事は取得済みの内容をそのまま使う（内容を保存する前に失敗したフィードの記事は再取得できない）
+    if isinstance(value, dict):
+        return value
+    if item_id < 0:
+        return None
+    return hn_source.fetch_document(item_id)
+
+
+# 記事ステージ：リンク先の記事本文を取得して要約の材料に加える（取得できなければHNの内容だけを使う）
+def article_stage(item):
+    if item.get('resumed'):
+        return item
+    if article_fetcher is not None and item.get('url'):
+        with_article_text(item, article_fetcher.fetch(item['url']))
+    state_store.save_checkpoint(item['id'], 'document', item)
+    return item
+
+
+# 要約ステージ：重複記事の再利用・まとめて生成・要約のいずれかを行う
+def summarize_stage(item):
+    if 'summary' in item:
+        return item
+    full_content = item['page_content']
+
+    # ほぼ同じ記事を処理済みなら、その生成結果を再利用してLLMの呼び出しを省く
+    duplicate = dedup_index.find(full_content)
+    if duplicate:
+        enriched = duplicate['enrichment']
+    # まとめて生成するモードなら1回の呼び出しで全項目を生成
+    elif ENRICH_MODE == 'combined':
+        enriched = enrich_content(full_content, schema)
+    else:
+        enriched = None
+    item['duplicate'] = bool(duplicate)
+    if enriched:
+        for field in ENRICHMENT_FIELDS:
+            checkpoint(item, field, enriched[field])
+    else:
+        # 内容を要約
+        checkpoint(item, 'summary', summarize_content(full_content))
+    return item
+
+
+# 意見ステージ（gpt-4 に切り替わることがあり最も遅いので、ワーカー数を個別に調整できる）
+def opinion_stage(item):
+    if 'opinion' not in item:
+        checkpoint(item, 'opinion', generate_opinion(item['summary']))
+    return item
+
+
+# リード文ステージ
+def lead_stage(item):
+    if 'lead' not in item:
+        checkpoint(item, 'lead', generate_lead(item['summary']))
+    return item
 
-        # トップニュースのIDを取得
-        new_id = data[0]['id']
 
-        # 新しいニュースがあるか確認
-        if new_id != last_checked_id:
-            # 新しいニュースの内容をすべて取得
-            full_content = data[0]['page_content']
+# カテゴリステージ：要約済みのテキストからカテゴリを生成し、生成結果を重複判定用に登録する
+def category_stage(item):
+    if 'categories' not in item:
+        checkpoint(item, 'categories', generate_category(item['summary']))
+    # 次に同じ記事が来た時のために生成結果を登録
+    if not item.get('duplicate'):
+        dedup_index.add(item['id'], item['page_content'], {field: item[field] for field in ENRICHMENT_FIELDS})
+    return item
 
-            # 内容を要約
-            summary = summarize_content(full_content)
 
-            # 意見を生成
-            opinion = generate_opinion(summary)
+# 書き込みステージ：アーカイブに保存し、スプレッドシートにも要約と意見を書き込む
+def sink_stage(item):
+    if article_archive is not None:
+        article_archive.append(archive_record(item))
+    if SHEET_EXPORT:
+        write_to_sheet(item['summary'], item['opinion'], item['categories'], item['lead'], item['id'])
+    return item['id']
 
-            # リード文を生成
-            lead = generate_lead(summary)
-            
-            # カテゴリを生成
-            categories = generate_category(full_content)
 
-            # スプレッドシートに要約と意見を書き込む
-            write_to_sheet(summary, opinion, lead, categories)
+# ステージとワーカー数（PIPELINE_<NAME>_WORKERS で変更できる）
+# 書き込みは1行ずつ追加するので既定では1ワーカー（行はIDではなく完了順に並ぶ）
+def build_pipeline():
+    return ThreadPipeline([
+        Stage('fetch', fetch_stage, stage_workers('fetch', hn_source.max_workers)),
+        Stage('article', article_stage, stage_workers('article', 8)),
+        Stage('summarize', summarize_stage, stage_workers('summarize', 4)),
+        Stage('opinion', opinion_stage, stage_workers('opinion', 4)),
+        Stage('lead', lead_stage, stage_workers('lead', 2)),
+        Stage('category', category_stage, stage_workers('category', 2)),
+        Stage('sink', sink_stage, stage_workers('sink', 1)),
+    ])
 
-            # 最後に確認したニュースのIDを更新
-            last_checked_id = new_id
+
+# 失敗したニュースを再試行キューに入れる関数
+def retry_failures(failed):
+    for item_id, (stage, error) in failed.items():
+        if not state_store.enqueue_retry(item_id, stage, error):
+            print(f"Giving up on item {item_id} after {RETRY_MAX_ATTEMPTS} attempts: {error}")
+
+
+# 新しいHacker Newsのコンテンツを確認する関数（処理したニュースの件数を返す）
+def check_new_hn_content(request):
+    global last_checked_id
+    try:
+        # 再試行の時刻になった失敗済みのニュースと、各ソースの未処理のニュースを優先度順に取得
+        retry_ids = state_store.due_retries(MAX_ITEMS)
+        batch = ingest_scheduler.next_batch(hn_source, state_store, last_checked_id, retry_ids, MAX_ITEMS)
+
+        # 取得・生成・書き込みの各ステージを並行に流す（停止の指示があれば投入済みのニュースだけを処理する）
+        result = build_pipeline().run(batch.items, stop=shutdown)
+
+        # 書き込めたニュースは完了、失敗したニュースは再試行キューに回す（スプレッドシートには書かない）
+        state_store.mark_done(*result.completed)
+        retry_failures(result.failed)
+
+        # 失敗したニュースは再試行キューから処理するので、取得したIDはすべて確認済みにする
+        # 上限や予算、停止の指示で処理しなかった新着があれば、その手前までを確認済みにする
+        held_back = batch.held_back + [item_id for item_id in batch.polled if item_id in result.skipped]
+        if held_back:
+            last_checked_id = min(held_back) - 1
+        elif batch.polled:
+            last_checked_id = max(batch.polled)
+        return len(batch.items) - len(result.skipped)
     except requests.exceptions.RequestException as e:
         print(f"Request error: {e}")
     except openai.Error as e:
         print(f"OpenAI API error: {e}")
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
-        traceback.print_exc()
\ No newline at end of file
+        traceback.print_exc()
+    finally:
+        # 実行ごとの計測結果を出力
+        metrics.flush()
+    return 0
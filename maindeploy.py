@@ -2,57 +2,108 @@ import os
 import json
 import requests
 import traceback
-from langchain.document_loaders import HNLoader
-from langchain.chat_models import ChatOpenAI
-from langchain.chains import create_extraction_chain
 import openai
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from google.auth.transport.requests import Request
+from llm import chat_completion, cached_extraction
 from datetime import datetime
 import time
 import base64
-from bs4 import BeautifulSoup
-
-# スプレッドシートから前回のニュースIDを取得する関数
-def get_last_checked_id_from_sheet(service, SPREADSHEET_ID):
-    RANGE_NAME = 'J1'  # 最新記事IDが保存されるセル
-    result = service.spreadsheets().values().get(spreadsheetId=SPREADSHEET_ID, range=RANGE_NAME).execute()
-    values = result.get('values', [])
-    if not values:
-        return None
-    return values[0][0]
-
-# スプレッドシートに最新のニュースIDを保存する関数
-def update_last_checked_id_on_sheet(service, SPREADSHEET_ID, new_id):
-    RANGE_NAME = 'J1'  # 最新記事IDを保存するセル
-    values = [[new_id]]
-    body = {'values': values}
-    service.spreadsheets().values().update(
-        spreadsheetId=SPREADSHEET_ID, range=RANGE_NAME,
-        valueInputOption='RAW', body=body).execute()
+from sheetwriter import BufferedSheetWriter, format_categories
+from hnsource import HNItemSource
+from metrics import metrics, timed
+from chunking import map_reduce_summarize
+from enrich import ENRICH_MODE, ENRICHMENT_FIELDS, enrich_content, require
+from dedup import DedupIndex
+from statestore import StateStore, RETRY_MAX_ATTEMPTS
+from workclaim import WorkClaimer
+from articlefetch import ARTICLE_FETCH, ArticleFetcher, with_article_text
+from wppublisher import WordPressPublisher
+from routing import model_router
+from sources import IngestScheduler
+from archive import ArticleArchive, archive_record, record_to_row
+from pipeline import ThreadPipeline, Stage, stage_workers, shutdown
+
+# コールドスタートを速くするため、langchain・googleapiclient などの重いモジュールは
+# 実際に使う関数の中でインポートする
 
 # エンコードされた認証情報を取得
 encoded_creds = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS_JSON')
 if not encoded_creds:
     raise ValueError("環境変数 'GOOGLE_APPLICATION_CREDENTIALS_JSON' が設定されていません。")
-# base64デコード  
-decoded_creds = base64.b64decode(encoded_creds)
-
-# JSONロード
-service_account_info = json.loads(decoded_creds)
-
-# Credentialsインスタンス作成
-credentials = service_account.Credentials.from_service_account_info(
-  service_account_info,
-  scopes=[
-    'https://www.googleapis.com/auth/spreadsheets',
-    'https://www.googleapis.com/auth/drive'
-  ]
-)
 
-# Sheets APIのserviceインスタンスを作成
-service = build('sheets', 'v4', credentials=credentials)
+# Sheets APIのディスカバリドキュメントを保存したファイル（任意）
+DISCOVERY_DOC_PATH = os.getenv('SHEETS_DISCOVERY_DOC')
+
+# ウォームなコンテナで使い回す Credentials と service インスタンス
+_credentials = None
+_service = None
+
+# 1回の実行で処理するニュースの最大数
+MAX_ITEMS = int(os.getenv('HN_MAX_ITEMS', '30'))
+# 新着ニュースの取得元（接続を使い回すためモジュールで共有）
+hn_source = HNItemSource()
+# HNの新着・トップページ・RSS/Atom フィードから処理するニュースを選ぶスケジューラ（INGEST_SOURCES で設定する）
+ingest_scheduler = IngestScheduler.from_env()
+
+# ほぼ同じ記事を検出するための指紋インデックス
+dedup_index = DedupIndex.from_env()
+
+# リンク先の記事本文の取得元（接続とレスポンスキャッシュを共有する）
+article_fetcher = ArticleFetcher.from_env() if ARTICLE_FETCH else None
+
+# 処理済みのニュースIDを記録するローカルの状態ストア
+state_store = StateStore.from_env()
+# 状態ストアのエントリを残す秒数
+STATE_RETENTION_SECONDS = float(os.getenv('STATE_RETENTION_SECONDS', 7 * 24 * 60 * 60))
+# 最新記事IDをJ1セルにも同期するかどうか（ローカルの状態が消えた時の復元に使う）
+STATE_SYNC_SHEET = os.getenv('STATE_SYNC_SHEET', '1') == '1'
+
+# 複数のインスタンスで同じニュースを処理しないよう、ニュースごとにリースを取る（LEASE_BACKEND が設定されている場合のみ）
+work_claimer = WorkClaimer.from_env()
+# 1回の実行でリースを取るニュースの最大数（インスタンス数に合わせて小さくすると各インスタンスに分散する）
+CLAIM_BATCH = int(os.getenv('LEASE_BATCH', MAX_ITEMS))
+
+# 生成結果を保存するローカルのアーカイブ（ARCHIVE=0 で無効）
+article_archive = ArticleArchive.from_env()
+# スプレッドシートにも書き出すかどうか（'0' ならアーカイブだけに保存し、J1セルへの同期もしない）
+SHEET_EXPORT = os.getenv('SHEET_EXPORT', '1') == '1'
+
+# 処理した行をWordPressに公開する（WP_API_URL が設定されている場合のみ）
+wp_publisher = WordPressPublisher.from_env()
+
+
+# Credentialsインスタンスを作成する関数（初回のみ作成）
+def get_credentials():
+    global _credentials
+    if _credentials is None:
+        from google.oauth2 import service_account
+
+        # base64デコードしてJSONロード
+        service_account_info = json.loads(base64.b64decode(encoded_creds))
+        _credentials = service_account.Credentials.from_service_account_info(
+          service_account_info,
+          scopes=[
+            'https://www.googleapis.com/auth/spreadsheets',
+            'https://www.googleapis.com/auth/drive'
+          ]
+        )
+    return _credentials
+
+
+# Sheets APIのserviceインスタンスを取得する関数
+# ディスカバリドキュメントはネットワークから取得せず、保存済みのファイルか
+# ライブラリ同梱のものを使い、作成したserviceとHTTP接続はインスタンス内で使い回す
+def get_service():
+    global _service
+    if _service is None:
+        if DISCOVERY_DOC_PATH and os.path.exists(DISCOVERY_DOC_PATH):
+            from googleapiclient.discovery import build_from_document
+            with open(DISCOVERY_DOC_PATH, encoding='utf-8') as f:
+                _service = build_from_document(f.read(), credentials=get_credentials())
+        else:
+            from googleapiclient.discovery import build
+            _service = build('sheets', 'v4', credentials=get_credentials(),
+                             static_discovery=True, cache_discovery=False)
+    return _service
 
 # スプレッドシートのIDを取得
 SPREADSHEET_ID = os.getenv('YOUR_SPREADSHEET_ID')
@@ -78,12 +129,8 @@ schema = {
 
 def openai_api_call(model, temperature, messages):
     try:
-        response = openai.ChatCompletion.create(
-            model=model,
-            temperature=temperature,
-            messages=messages
-        )
-        return response.choices[0].message['content']
+        response = chat_completion(model, temperature, messages)
+        return response['content']
     except openai.OpenAIError as e:  
         print(f"OpenAI API error: {e}")
         traceback.print_exc()
@@ -95,31 +142,56 @@ def openai_api_call(model, temperature, messages):
 
 
 # カテゴリー作成関数
+@timed('category')
 def generate_category(content):
     try:
-        # LLM (Language Model) を初期化
-        llm = ChatOpenAI(temperature=0, model="gpt-3.5-turbo")
-        # 抽出チェーンを作成
-        chain = create_extraction_chain(schema, llm)
-        # チェーンを実行
-        extracted_categories = chain.run(f"あなたは優秀なカテゴリ生成アシスタントです。提供された文章をもとに、カテゴリ(2個から3個)を生成してください。\n\n{content}")
+        # NumPy の読み込みはコールドスタートを遅くするので、最初の呼び出しまで遅らせる
+        from categorizer import category_engine
+    except ImportError:
+        category_engine = None
+    # 埋め込みで十分な確信度が得られれば、LLMを呼ばずに固定のカテゴリ一覧から割り当てる
+    if category_engine is not None:
+        try:
+            categories = category_engine.assign(content)
+            if categories:
+                return categories
+        except Exception as e:
+            print(f"Error in embedding category assignment: {e}")
+    try:
+        prompt = f"あなたは優秀なカテゴリ生成アシスタントです。提供された文章をもとに、カテゴリ(2個から3個)を生成してください。\n\n{content}"
+
+        def run():
+            from langchain.chat_models import ChatOpenAI
+            from langchain.chains import create_extraction_chain
+
+            # LLM (Language Model) を初期化
+            llm = ChatOpenAI(temperature=0, model="gpt-3.5-turbo")
+            # 抽出チェーンを作成
+            chain = create_extraction_chain(schema, llm)
+            # チェーンを実行
+            return chain.run(prompt)
+
+        # 同じ内容なら前回の抽出結果をキャッシュから再利用
+        extracted_categories = cached_extraction("gpt-3.5-turbo", schema, prompt, run)
         return extracted_categories
     except Exception as e:
         print(f"Error in category generation: {e}")
         traceback.print_exc()
         return "カテゴリを生成できませんでした"
 
-# リード文作成関数
+# リード文作成関数（意見と同じく、品質チェックに通らなければ大きなモデルに切り替える）
+@timed('lead')
 def generate_lead(content):
     try:
-        lead = openai_api_call(
-        "gpt-3.5-turbo-0613",
+        lead = model_router.complete(
+        'lead',
         0.6,
         [
             {"role": "system", "content": "あなたは優秀なリード文生成アシスタントです。提供された文章をもとに、日本語のリード文を生成してください。"},
             {"role": "user", "content": content}
-        ]
-    )
+        ],
+        openai_api_call,
+        )
         return lead
     except Exception as e:
         print(f"Error in lead generation: {e}")
@@ -127,17 +199,25 @@ def generate_lead(content):
         return "リード文を生成できませんでした"
 
 
-# 要約用の関数
-def summarize_content(content):
-    try:
-        summary = openai_api_call(
-        "gpt-3.5-turbo-16k-0613",
+# 文章の一部（チャンク）を要約する関数（トークン数がコンテキストに収まる最も速いモデルを使う）
+@timed('summarize_chunk')
+def summarize_chunk(content):
+    return model_router.complete(
+        'summarize',
         0,
         [
             {"role": "system", "content": "あなたは優秀な要約アシスタントです。提供された文章をもとに、できる限り正確な内容にすることを意識して要約してください。"},
             {"role": "user", "content": content}
-        ]
-        )
+        ],
+        openai_api_call,
+    )
+
+
+# 要約用の関数（長い文章はトークン数で分割して並行に要約し、最後にまとめる）
+@timed('summarize')
+def summarize_content(content):
+    try:
+        summary = map_reduce_summarize(content, summarize_chunk)
         return summary
     except Exception as e:
         print(f"Error in summarization: {e}")
@@ -145,16 +225,18 @@ def summarize_content(content):
         return "要約できませんでした"
 
 
-# 意見生成用の関数
+# 意見生成用の関数（速いモデルから試し、短すぎる・日本語でない場合は gpt-4 に切り替える）
+@timed('opinion')
 def generate_opinion(content):
     try:
-        opinion = openai_api_call(
-        "gpt-4",
+        opinion = model_router.complete(
+        'opinion',
         0.6,
         [
             {"role": "system", "content": "あなたは優秀な意見生成アシスタントです。提供された文章をもとに、文章に関する感想や意見を生成してください。"},
             {"role": "user", "content": content}
-        ]
+        ],
+        openai_api_call,
         )
         return opinion
     except Exception as e:
@@ -163,60 +245,222 @@ def generate_opinion(content):
         return "意見を生成できませんでした"
 
 
-# スプレッドシートへの書き込み関数
-def write_to_sheet(service, SPREADSHEET_ID, summary, opinion, categories, lead, new_id):
-    RANGE_NAME = 'A1'  # 要約と意見が書き込まれる範囲の開始セル
+# スプレッドシートへの書き込み関数（実行の最後にまとめて書き込むためバッファに追加する）
+def write_to_sheet(writer, summary, opinion, categories, lead, new_id):
     # 現在の時刻を取得
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    # データの書き込み
-    values = [[now, summary, opinion, ", ".join(categories), lead]]
-    body = {'values': values}
-    # 要約と意見をスプレッドシートに追記
-    service.spreadsheets().values().append(
-        spreadsheetId=SPREADSHEET_ID, range=RANGE_NAME,
-        valueInputOption='RAW', body=body).execute()
-    # 最新の記事IDをJ1セルに書き込む
-    update_last_checked_id_on_sheet(service, SPREADSHEET_ID, new_id)
+    # 要約と意見をバッファに追加
+    writer.add_row([now, summary, opinion, format_categories(categories), lead, new_id])
+    # 同期が有効なら最新の記事IDもJ1セルに同じリクエストで書き込む
+    if STATE_SYNC_SHEET:
+        writer.set_watermark(new_id)
+
+
+# ---- パイプラインのステージ ----
+# 各ステージは1件のニュース（辞書）を受け取り、生成した項目を追加して次のステージに渡す
+# 各ステージの出力は状態ストアに保存し、失敗したニュースは次回、保存済みの続きから処理する
+
+# 生成結果を検証してチェックポイントに保存する（失敗していれば例外で再試行キューに回す）
+def checkpoint(item, field, value):
+    item[field] = require(value, field)
+    state_store.save_checkpoint(item['id'], field, item[field])
+
+
+# 取得ステージ：IDからニュースの内容を取得する（削除済みなら除外、フィードの記事は内容が渡される）
+# 途中まで処理したニュースは、保存済みの内容と生成結果から再開する
+def fetch_stage(value):
+    item_id = value['id'] if isinstance(value, dict) else value
+    saved = state_store.checkpoints(item_id)
+    if 'document' in saved:
+        item = saved.pop('document')
+        item.update(saved)
+        item['resumed'] = True
+        return item
+    # フィードの記事は取得済みの内容をそのまま使う（内容を保存する前に失敗したフィードの記事は再取得できない）
+    if isinstance(value, dict):
+        return value
+    if item_id < 0:
+        return None
+    return hn_source.fetch_document(item_id)
+
+
+# 記事ステージ：リンク先の記事本文を取得して要約の材料に加える（取得できなければHNの内容だけを使う）
+def article_stage(item):
+    if item.get('resumed'):
+        return item
+    if article_fetcher is not None and item.get('url'):
+        with_article_text(item, article_fetcher.fetch(item['url']))
+    state_store.save_checkpoint(item['id'], 'document', item)
+    return item
+
+
+# 要約ステージ：重複記事の再利用・まとめて生成・要約のいずれかを行う
+def summarize_stage(item):
+    if 'summary' in item:
+        return item
+    full_content = item['page_content']
+
+    # ほぼ同じ記事を処理済みなら、その生成結果を再利用してLLMの呼び出しを省く
+    duplicate = dedup_index.find(full_content)
+    if duplicate:
+        enriched = duplicate['enrichment']
+    # まとめて生成するモードなら1回の呼び出しで全項目を生成
+    elif ENRICH_MODE == 'combined':
+        enriched = enrich_content(full_content, schema)
+    else:
+        enriched = None
+    item['duplicate'] = bool(duplicate)
+    if enriched:
+        for field in ENRICHMENT_FIELDS:
+            checkpoint(item, field, enriched[field])
+    else:
+        # 内容を要約
+        checkpoint(item, 'summary', summarize_content(full_content))
+    return item
+
+
+# 意見ステージ（gpt-4 に切り替わることがあり最も遅いので、ワーカー数を個別に調整できる）
+def opinion_stage(item):
+    if 'opinion' not in item:
+        checkpoint(item, 'opinion', generate_opinion(item['summary']))
+    return item
+
+
+# リード文ステージ
+def lead_stage(item):
+    if 'lead' not in item:
+        checkpoint(item, 'lead', generate_lead(item['summary']))
+    return item
+
+
+# カテゴリステージ：要約済みのテキストからカテゴリを生成し、生成結果を重複判定用に登録する
+def category_stage(item):
+    if 'categories' not in item:
+        checkpoint(item, 'categories', generate_category(item['summary']))
+    # 次に同じ記事が来た時のために生成結果を登録
+    if not item.get('duplicate'):
+        dedup_index.add(item['id'], item['page_content'], {field: item[field] for field in ENRICHMENT_FIELDS})
+    return item
+
+
+# ステージとワーカー数（PIPELINE_<NAME>_WORKERS で変更できる）
+# 書き込みはバッファへの追加だけなので1ワーカー（行は完了順に追加され、書き込む前にID順に並べ直す）
+def build_pipeline(writer, records):
+    # 書き込みステージ：行をバッファに追加し、アーカイブに保存する記録を作る
+    def sink_stage(item):
+        write_to_sheet(writer, item['summary'], item['opinion'], item['categories'], item['lead'], item['id'])
+        records[item['id']] = archive_record(item)
+        return item['id']
+
+    return ThreadPipeline([
+        Stage('fetch', fetch_stage, stage_workers('fetch', hn_source.max_workers)),
+        Stage('article', article_stage, stage_workers('article', 8)),
+        Stage('summarize', summarize_stage, stage_workers('summarize', 4)),
+        Stage('opinion', opinion_stage, stage_workers('opinion', 4)),
+        Stage('lead', lead_stage, stage_workers('lead', 2)),
+        Stage('category', category_stage, stage_workers('category', 2)),
+        Stage('sink', sink_stage, 1),
+    ])
+
+
+# 処理するニュース（(ID, 値) のリスト）のリースを取る関数（リースを使わない設定ならすべてを処理する）
+# 他のインスタンスが完了したニュースは完了として記録し、処理中のニュースは未完了として記録して
+# 最新記事IDがそれを越えないようにする（そのインスタンスが落ちても次回以降に取り直せる）
+def claim_items(items):
+    if work_claimer is None or not items:
+        return items
+    item_ids = [item_id for item_id, _ in items]
+    claimed, finished = work_claimer.claim(item_ids, CLAIM_BATCH)
+    state_store.mark_done(*finished)
+    state_store.mark_pending(*[item_id for item_id in item_ids if item_id not in claimed and item_id not in finished])
+    return [(item_id, value) for item_id, value in items if item_id in claimed]
+
+
+# 失敗したニュースを再試行キューに入れる関数（リースは返して他のインスタンスも再試行できるようにする）
+def retry_failures(failed):
+    if work_claimer is not None:
+        work_claimer.release(list(failed))
+    for item_id, (stage, error) in failed.items():
+        if not state_store.enqueue_retry(item_id, stage, error):
+            print(f"Giving up on item {item_id} after {RETRY_MAX_ATTEMPTS} attempts: {error}")
 
 
 # 新しいHacker Newsのコンテンツを確認する関数
 def check_new_hn_content(request):
-    # service インスタンスと SPREADSHEET_ID を取得
-    service = build('sheets', 'v4', credentials=credentials)
-    SPREADSHEET_ID = os.getenv('YOUR_SPREADSHEET_ID')
-
-    # 最後にチェックしたIDを取得
-    last_checked_id = get_last_checked_id_from_sheet(service, SPREADSHEET_ID)
-    try:
-        # Hacker Newsのトップページをロード
-        loader = HNLoader("https://news.ycombinator.com/")
-        data = loader.load()
-
-        # トップニュースのIDを取得
-        new_id = data[0]['id']
-
-        # 新しいニュースがあるか確認
-        if new_id != last_checked_id:
-            # 新しいニュースの内容をすべて取得
-            full_content = data[0]['page_content']
-
-            # 内容を要約
-            summary = summarize_content(full_content)
+    process_new_content()
 
-            # 意見を生成
-            opinion = generate_opinion(summary)
 
-            # リード文を生成
-            lead = generate_lead(summary)
+# 新着と再試行のニュースを1回処理し、処理したニュースの件数を返す関数（常駐プロセスからも呼ぶ）
+def process_new_content():
+    # ウォームなコンテナでは前回の service インスタンスを再利用
+    service = get_service()
 
-            # カテゴリを生成
-            categories = generate_category(full_content)
-
-            # スプレッドシートに要約と意見を書き込む
-            write_to_sheet(service, SPREADSHEET_ID, summary, opinion, categories, lead, new_id)
-
-            # 最後に確認したニュースのIDを更新
-            update_last_checked_id_on_sheet(service, SPREADSHEET_ID, new_id)
+    # 書き込みをまとめるライターを作成
+    writer = BufferedSheetWriter(service, SPREADSHEET_ID)
+    try:
+        # 最後にチェックしたIDはローカルの状態ストアから取得し、
+        # ストアが空（コールドスタート直後など）の場合だけJ1セルを読む
+        last_checked_id = state_store.watermark()
+        if last_checked_id is None and STATE_SYNC_SHEET and SHEET_EXPORT:
+            sheet_watermark = writer.fetch_watermark()
+            if sheet_watermark is not None:
+                last_checked_id = int(sheet_watermark)
+
+        # 再試行の時刻になった失敗済みのニュースと、各ソースの未完了のニュースを優先度順に取得
+        retry_ids = state_store.due_retries(MAX_ITEMS)
+        batch = ingest_scheduler.next_batch(hn_source, state_store, last_checked_id, retry_ids, MAX_ITEMS)
+        # 上限や予算で今回は処理しない新着は未完了として記録し、最新記事IDがそれを越えないようにする
+        state_store.mark_pending(*batch.held_back)
+        items = claim_items(batch.items)
+
+        # 取得・生成・書き込みの各ステージを並行に流す
+        # 停止の指示があれば投入済みのニュースだけを処理する
+        records = {}
+        result = build_pipeline(writer, records).run(items, stop=shutdown)
+        # 投入しなかったニュースは未完了のまま次回に回す
+        state_store.mark_pending(*result.skipped)
+        if work_claimer is not None:
+            work_claimer.release(result.skipped)
+        written_ids = [item_id for item_id, value in result.completed.items() if value is not None]
+        # 削除済みで除外されたニュースは再取得しないよう完了扱いにする
+        state_store.mark_done(*[item_id for item_id, value in result.completed.items() if value is None])
+        # 失敗したニュースは再試行キューに回す（スプレッドシートには書かない）
+        retry_failures(result.failed)
+
+        # 処理中にリースを失ったニュース（期限切れの後に別のインスタンスが取り直したもの）は書き込まない
+        if work_claimer is not None:
+            held_ids = work_claimer.fence(written_ids)
+            lost_ids = [item_id for item_id in written_ids if item_id not in held_ids]
+            writer.discard_rows(lost_ids)
+            written_ids = held_ids
+
+        # 処理済みの記録をアーカイブに保存し、行は1回の batchUpdate で書き込み、書き込めたものだけを完了として記録
+        try:
+            if article_archive is not None:
+                article_archive.extend(records[item_id] for item_id in written_ids)
+            if SHEET_EXPORT:
+                writer.sort_rows()
+                writer.flush()
+        except Exception as e:
+            # 生成結果は保存済みなので、次回は書き込みだけをやり直す
+            # （アーカイブに保存し直した記録は後のものが有効になる）
+            retry_failures({item_id: ('sink', e) for item_id in written_ids})
+            raise
+        if work_claimer is not None:
+            work_claimer.complete(written_ids)
+        state_store.mark_done(*written_ids)
+
+        # WordPressへの公開が設定されていれば、今回書き込んだ行だけを送る
+        rows = writer.flushed_rows if SHEET_EXPORT else [record_to_row(records[item_id]) for item_id in written_ids]
+        if wp_publisher is not None and rows:
+            print(f"WordPress: {wp_publisher.publish(rows)}")
+
+        # 古い処理済みエントリを整理
+        state_store.compact(STATE_RETENTION_SECONDS)
+        dedup_index.compact()
+        if work_claimer is not None:
+            work_claimer.compact(STATE_RETENTION_SECONDS)
+        return len(items) - len(result.skipped)
     except requests.exceptions.RequestException as e:
         print(f"Request error: {e}")
     except openai.OpenAIError as e: 
@@ -224,3 +468,10 @@ def check_new_hn_content(request):
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
         traceback.print_exc()
+    finally:
+        # 途中で止まった場合も、持ったままのリースを返す
+        if work_claimer is not None:
+            work_claimer.release()
+        # 実行ごとの計測結果を出力
+        metrics.flush()
+    return 0
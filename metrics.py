@@ -0,0 +1,189 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import functools
+import threading
+from contextlib import contextmanager
+
+# モデルごとの料金（USD / 1Kトークン、入力と出力）
+# キーはモデル名の前方一致で選ばれる
+MODEL_PRICES = {
+    'gpt-4-32k': (0.06, 0.12),
+    'gpt-4': (0.03, 0.06),
+    'gpt-3.5-turbo-16k': (0.003, 0.004),
+    'gpt-3.5-turbo': (0.0015, 0.002),
+    'text-embedding-ada-002': (0.0001, 0.0),
+}
+
+METRIC_PREFIX = 'autonews_'
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key):
+    if not key:
+        return ''
+    body = ','.join('{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"')) for k, v in key)
+    return '{' + body + '}'
+
+
+# ステージごとの所要時間・トークン数・推定コスト・再試行回数などを集計するクラス
+# 無効時は各メソッドがすぐに戻るので、計測のオーバーヘッドはほぼない
+class Metrics:
+    def __init__(self, enabled=False, log_stream=None, openmetrics_path=None, prices=None):
+        self.enabled = enabled
+        self.log_stream = log_stream
+        self.openmetrics_path = openmetrics_path
+        self.prices = prices or MODEL_PRICES
+        self._counters = {}
+        self._summaries = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        prices = dict(MODEL_PRICES)
+        if os.getenv('METRICS_MODEL_PRICES'):
+            prices.update({k: tuple(v) for k, v in json.loads(os.getenv('METRICS_MODEL_PRICES')).items()})
+        return cls(
+            enabled=os.getenv('METRICS_ENABLED') == '1',
+            log_stream=sys.stderr if os.getenv('METRICS_JSON_LOGS', '1') == '1' else None,
+            openmetrics_path=os.getenv('METRICS_OPENMETRICS_PATH'),
+            prices=prices,
+        )
+
+    # 構造化ログ（1行1JSON）を出力する
+    def log(self, event, **fields):
+        if not self.enabled or self.log_stream is None:
+            return
+        record = {'ts': round(time.time(), 3), 'event': event}
+        record.update(fields)
+        self.log_stream.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+
+    def incr(self, name, amount=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, _label_key(labels))
+        with self._lock:
+            count, total = self._summaries.get(key, (0, 0.0))
+            self._summaries[key] = (count + 1, total + value)
+
+    # 処理時間を計測するコンテキストマネージャ
+    @contextmanager
+    def timer(self, stage, **labels):
+        if not self.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        status = 'ok'
+        try:
+            yield
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            self.observe('stage_seconds', elapsed, stage=stage, **labels)
+            self.log('stage', stage=stage, seconds=round(elapsed, 4), status=status, **labels)
+
+    def price(self, model):
+        matches = [key for key in self.prices if model and model.startswith(key)]
+        return self.prices[max(matches, key=len)] if matches else (0.0, 0.0)
+
+    # APIレスポンスの usage を記録し、推定コストを返す
+    def record_usage(self, model, usage, stage=None):
+        if not self.enabled or not usage:
+            return 0.0
+        prompt_tokens = usage.get('prompt_tokens', 0)
+        completion_tokens = usage.get('completion_tokens', 0)
+        prompt_price, completion_price = self.price(model)
+        cost = (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+        self.incr('tokens_total', prompt_tokens, model=model, kind='prompt')
+        self.incr('tokens_total', completion_tokens, model=model, kind='completion')
+        self.incr('cost_usd_total', cost, model=model)
+        self.incr('openai_requests_total', model=model)
+        self.log('usage', model=model, stage=stage, prompt_tokens=prompt_tokens,
+                 completion_tokens=completion_tokens, cost_usd=round(cost, 6))
+        return cost
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': {name + _format_labels(key): value for (name, key), value in self._counters.items()},
+                'summaries': {
+                    name + _format_labels(key): {'count': count, 'sum': total}
+                    for (name, key), (count, total) in self._summaries.items()
+                },
+            }
+
+    # OpenMetrics（Prometheus）のテキスト形式で出力する
+    def to_openmetrics(self):
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            summaries = sorted(self._summaries.items())
+        declared = set()
+        for (name, key), value in counters:
+            metric = METRIC_PREFIX + name[:-len('_total')] if name.endswith('_total') else METRIC_PREFIX + name
+            if metric not in declared:
+                lines.append(f'# TYPE {metric} counter')
+                declared.add(metric)
+            lines.append(f'{metric}_total{_format_labels(key)} {value}')
+        for (name, key), (count, total) in summaries:
+            metric = METRIC_PREFIX + name
+            if metric not in declared:
+                lines.append(f'# TYPE {metric} summary')
+                declared.add(metric)
+            lines.append(f'{metric}_count{_format_labels(key)} {count}')
+            lines.append(f'{metric}_sum{_format_labels(key)} {total}')
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    # 実行の最後に集計結果をログとファイルに書き出す
+    def flush(self):
+        if not self.enabled:
+            return
+        self.log('summary', **self.snapshot())
+        if self.openmetrics_path:
+            with open(self.openmetrics_path, 'w', encoding='utf-8') as f:
+                f.write(self.to_openmetrics())
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._summaries.clear()
+
+
+# 全モジュールで共有するメトリクス
+metrics = Metrics.from_env()
+
+
+# 関数（同期・非同期）の処理時間をステージとして計測するデコレータ
+def timed(stage):
+    def decorator(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                if not metrics.enabled:
+                    return await fn(*args, **kwargs)
+                with metrics.timer(stage):
+                    return await fn(*args, **kwargs)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not metrics.enabled:
+                    return fn(*args, **kwargs)
+                with metrics.timer(stage):
+                    return fn(*args, **kwargs)
+        return wrapper
+    return decorator
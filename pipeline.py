@@ -0,0 +1,158 @@
+import os
+import time
+import queue
+import asyncio
+import threading
+
+from metrics import metrics
+
+# ステージ間キューのデフォルトの長さ（満杯になると上流のステージが待たされる）
+DEFAULT_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', '8'))
+
+# ワーカーの終了を知らせる目印
+_DONE = object()
+
+# 設定されるとパイプラインは新しい件の投入をやめ、投入済みの件だけを最後まで処理する（常駐プロセスの終了用）
+shutdown = threading.Event()
+
+
+# ステージのワーカー数を環境変数 PIPELINE_<NAME>_WORKERS から取得する関数
+def stage_workers(name, default):
+    return max(1, int(os.getenv(f'PIPELINE_{name.upper()}_WORKERS', default)))
+
+
+# パイプラインの1ステージ
+# fn は1件を受け取って次のステージに渡す値を返す。None を返すとその件はここで完了（除外）になる
+class Stage:
+    def __init__(self, name, fn, workers=1, queue_size=None):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.queue_size = queue_size or DEFAULT_QUEUE_SIZE
+
+
+# パイプラインの実行結果
+class PipelineResult:
+    def __init__(self):
+        # キー -> 最終ステージの戻り値（途中で除外された件は None）
+        self.completed = {}
+        # キー -> (ステージ名, 例外)
+        self.failed = {}
+        # 停止の指示で投入しなかったキー（次回に処理する）
+        self.skipped = []
+
+
+def _report_failure(result, key, stage, error):
+    print(f"Error in pipeline stage '{stage.name}' for item {key}: {error}")
+    result.failed[key] = (stage.name, error)
+    metrics.incr('pipeline_failures_total', stage=stage.name)
+
+
+# スレッドで動くストリーミングパイプライン
+# ステージ同士を長さ制限付きのキューでつなぎ、遅いステージ（gpt-4 の意見生成や書き込みなど）の
+# 手前でキューが満杯になると、上流のステージと投入側が自動的に待つ（バックプレッシャー）
+class ThreadPipeline:
+    def __init__(self, stages):
+        self.stages = stages
+
+    def _worker(self, stage, inbox, outbox, result):
+        while True:
+            envelope = inbox.get()
+            if envelope is _DONE:
+                return
+            key, value = envelope
+            try:
+                value = stage.fn(value)
+            except Exception as e:
+                _report_failure(result, key, stage, e)
+                continue
+            if value is None or outbox is None:
+                result.completed[key] = value
+                continue
+            started = time.perf_counter()
+            outbox.put((key, value))
+            metrics.observe('pipeline_backpressure_seconds', time.perf_counter() - started, stage=stage.name)
+
+    # (キー, 値) の列を流し、すべての件が完了するか失敗するまで待つ
+    # stop（threading.Event）が設定されたら残りの件は投入せず、result.skipped に入れる
+    def run(self, items, stop=None):
+        result = PipelineResult()
+        queues = [queue.Queue(maxsize=stage.queue_size) for stage in self.stages]
+        threads = []
+        for index, stage in enumerate(self.stages):
+            outbox = queues[index + 1] if index + 1 < len(queues) else None
+            threads.append([
+                threading.Thread(target=self._worker, args=(stage, queues[index], outbox, result),
+                                 name=f'pipeline-{stage.name}-{n}', daemon=True)
+                for n in range(stage.workers)
+            ])
+        for workers in threads:
+            for thread in workers:
+                thread.start()
+
+        for key, value in items:
+            if stop is not None and stop.is_set():
+                result.skipped.append(key)
+                continue
+            queues[0].put((key, value))
+
+        # 上流のステージから順に終了させる（全ワーカーが終われば、その出力はすべて次のキューに入っている）
+        for inbox, workers in zip(queues, threads):
+            for _ in workers:
+                inbox.put(_DONE)
+            for thread in workers:
+                thread.join()
+        return result
+
+
+# asyncio で動くストリーミングパイプライン（各ステージの fn はコルーチン関数）
+class AsyncPipeline:
+    def __init__(self, stages):
+        self.stages = stages
+
+    async def _worker(self, stage, inbox, outbox, result):
+        while True:
+            envelope = await inbox.get()
+            if envelope is _DONE:
+                return
+            key, value = envelope
+            try:
+                value = await stage.fn(value)
+            except Exception as e:
+                _report_failure(result, key, stage, e)
+                continue
+            if value is None or outbox is None:
+                result.completed[key] = value
+                continue
+            started = time.perf_counter()
+            await outbox.put((key, value))
+            metrics.observe('pipeline_backpressure_seconds', time.perf_counter() - started, stage=stage.name)
+
+    async def run(self, items, stop=None):
+        result = PipelineResult()
+        queues = [asyncio.Queue(maxsize=stage.queue_size) for stage in self.stages]
+        tasks = []
+        for index, stage in enumerate(self.stages):
+            outbox = queues[index + 1] if index + 1 < len(queues) else None
+            tasks.append([
+                asyncio.create_task(self._worker(stage, queues[index], outbox, result))
+                for _ in range(stage.workers)
+            ])
+
+        try:
+            for key, value in items:
+                if stop is not None and stop.is_set():
+                    result.skipped.append(key)
+                    continue
+                await queues[0].put((key, value))
+
+            for inbox, workers in zip(queues, tasks):
+                for _ in workers:
+                    await inbox.put(_DONE)
+                await asyncio.gather(*workers)
+        finally:
+            # 途中でキャンセルされた場合も残ったワーカーを止める
+            for workers in tasks:
+                for task in workers:
+                    task.cancel()
+        return result
@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import random
+import asyncio
+import threading
+
+import openai
+
+from chunking import count_tokens
+from metrics import metrics
+
+# モデルごとの1分あたりのリクエスト数(RPM)とトークン数(TPM)の上限
+# キーはモデル名の前方一致で選ばれる（gpt-3.5 系のモデルは同じ枠を共有する）
+DEFAULT_LIMITS = {
+    'gpt-4': {'rpm': 200, 'tpm': 40000},
+    'gpt-3.5': {'rpm': 3500, 'tpm': 90000},
+    'text-embedding': {'rpm': 3000, 'tpm': 1000000},
+}
+# どのキーにも一致しないモデルの上限
+FALLBACK_LIMIT = {'rpm': 3500, 'tpm': 90000}
+# 出力トークン数の見積もり（実際の使用量で後から補正する）
+DEFAULT_COMPLETION_TOKENS = 500
+
+MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', '5'))
+BACKOFF_BASE = float(os.getenv('OPENAI_BACKOFF_BASE', '1'))
+BACKOFF_MAX = float(os.getenv('OPENAI_BACKOFF_MAX', '60'))
+
+
+# 一時的なエラーかどうかを判定する関数
+def is_retryable(error):
+    if isinstance(error, (openai.error.RateLimitError, openai.error.Timeout,
+                          openai.error.ServiceUnavailableError, openai.error.APIConnectionError)):
+        return True
+    if isinstance(error, openai.error.APIError):
+        return error.http_status is None or error.http_status >= 500
+    return False
+
+
+# 再試行までの待ち時間を返す関数（Retry-After があればそれに従い、なければ指数バックオフ＋ジッター）
+def backoff_delay(attempt, error=None):
+    headers = getattr(error, 'headers', None) or {}
+    retry_after = headers.get('retry-after') or headers.get('Retry-After')
+    if retry_after:
+        try:
+            return min(float(retry_after), BACKOFF_MAX)
+        except ValueError:
+            pass
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+# トークンバケット。残量が足りない分は予約として差し引き、必要な待ち時間を返す
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount):
+        with self._lock:
+            self._refill()
+            self.tokens -= min(amount, self.capacity)
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    # 現在の残量（予約で負になっていることもある）
+    def available(self):
+        with self._lock:
+            self._refill()
+            return self.tokens
+
+    # 見積もりとの差分を戻す（負の値なら追加で差し引く）
+    def adjust(self, amount):
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+# モデルごとのRPM・TPMのバケットを全ワーカーで共有するリミッター
+class ModelLimiter:
+    def __init__(self, limits=None):
+        self.limits = limits or DEFAULT_LIMITS
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        limits = dict(DEFAULT_LIMITS)
+        if os.getenv('OPENAI_RATE_LIMITS'):
+            limits.update(json.loads(os.getenv('OPENAI_RATE_LIMITS')))
+        return cls(limits)
+
+    def _key(self, model):
+        matches = [key for key in self.limits if model.startswith(key)]
+        return max(matches, key=len) if matches else model
+
+    def buckets(self, model):
+        key = self._key(model)
+        with self._lock:
+            if key not in self._buckets:
+                limit = self.limits.get(key, FALLBACK_LIMIT)
+                self._buckets[key] = (TokenBucket(limit['rpm']), TokenBucket(limit['tpm']))
+            return self._buckets[key]
+
+    def _reserve(self, model, tokens):
+        requests_bucket, tokens_bucket = self.buckets(model)
+        return max(requests_bucket.reserve(1), tokens_bucket.reserve(tokens))
+
+    # 枠が空くまで待つ
+    def acquire(self, model, tokens):
+        wait = self._reserve(model, tokens)
+        if wait:
+            metrics.observe('ratelimit_wait_seconds', wait, model=model)
+            time.sleep(wait)
+        return wait
+
+    # acquire の非同期版
+    async def aacquire(self, model, tokens):
+        wait = self._reserve(model, tokens)
+        if wait:
+            metrics.observe('ratelimit_wait_seconds', wait, model=model)
+            await asyncio.sleep(wait)
+        return wait
+
+    # 実際の使用トークン数で見積もりを補正する
+    def settle(self, model, estimated, actual):
+        if actual:
+            self.buckets(model)[1].adjust(estimated - actual)
+
+
+# プロンプトと出力のトークン数を見積もる関数
+def estimate_tokens(messages, max_tokens=None):
+    prompt = sum(count_tokens(str(m.get('content') or '')) + 4 for m in messages)
+    return prompt + (max_tokens or DEFAULT_COMPLETION_TOKENS)
+
+
+# 全ワーカーで共有するリミッター
+limiter = ModelLimiter.from_env()
+
+
+# リミッターで待ってから呼び出し、一時的なエラーは再試行する関数
+# call は OpenAI のレスポンスを返し、使用量は response['usage'] から読み取る
+def call_with_retries(model, messages, call, max_tokens=None):
+    estimated = estimate_tokens(messages, max_tokens)
+    for attempt in range(MAX_RETRIES + 1):
+        limiter.acquire(model, estimated)
+        try:
+            response = call()
+        except Exception as e:
+            if attempt == MAX_RETRIES or not is_retryable(e):
+                raise
+            delay = backoff_delay(attempt, e)
+            print(f"Retrying OpenAI API call in {delay:.1f}s ({attempt + 1}/{MAX_RETRIES}): {e}")
+            metrics.incr('openai_retries_total', model=model, error=type(e).__name__)
+            time.sleep(delay)
+            continue
+        limiter.settle(model, estimated, (response.get('usage') or {}).get('total_tokens'))
+        return response
+
+
+# call_with_retries の非同期版
+async def acall_with_retries(model, messages, call, max_tokens=None):
+    estimated = estimate_tokens(messages, max_tokens)
+    for attempt in range(MAX_RETRIES + 1):
+        await limiter.aacquire(model, estimated)
+        try:
+            response = await call()
+        except Exception as e:
+            if attempt == MAX_RETRIES or not is_retryable(e):
+                raise
+            delay = backoff_delay(attempt, e)
+            print(f"Retrying OpenAI API call in {delay:.1f}s ({attempt + 1}/{MAX_RETRIES}): {e}")
+            metrics.incr('openai_retries_total', model=model, error=type(e).__name__)
+            await asyncio.sleep(delay)
+            continue
+        limiter.settle(model, estimated, (response.get('usage') or {}).get('total_tokens'))
+        return response
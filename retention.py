@@ -0,0 +1,141 @@
+import os
+import json
+import gzip
+import argparse
+from datetime import datetime, timedelta
+
+from metrics import metrics
+from sheetwriter import WATERMARK_ROW, WATERMARK_COLUMN, watermark_request
+
+# 出力シートの期限切れの行を削除するジョブ
+# 行ごとに deleteRow を呼んでいた Apps Script の deleteOldRows とそのトリガーは廃止した
+# 代わりに `python retention.py` か Cloud Functions の delete_old_rows を1日1回などの間隔で定期実行する
+
+# 行を残す日数
+RETENTION_DAYS = float(os.getenv('RETENTION_DAYS', '7'))
+# 期限切れの行を削除前に保存するディレクトリ（空なら保存しない）
+RETENTION_ARCHIVE_DIR = os.getenv('RETENTION_ARCHIVE_DIR', '')
+# 読み込む範囲（A列の日時から期限切れを判定し、J1の最新記事IDは削除後に書き戻す）
+READ_RANGE = 'A:J'
+# 行の日時の書式（write_to_sheet と同じ）
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+# 保存する列数（日時・要約・意見・カテゴリ・リード文・ニュースID）
+ARCHIVE_COLUMNS = 6
+
+
+def _parse_timestamp(value):
+    try:
+        return datetime.strptime(str(value).strip(), TIMESTAMP_FORMAT)
+    except ValueError:
+        return None
+
+
+# 1回の spreadsheets.get でシートIDと全行の値を取得する関数
+def read_sheet(service, spreadsheet_id):
+    with metrics.timer('sheets_get'):
+        result = service.spreadsheets().get(
+            spreadsheetId=spreadsheet_id,
+            ranges=[READ_RANGE],
+            includeGridData=True,
+            fields='sheets(properties(sheetId),data(rowData(values(formattedValue))))',
+        ).execute()
+    sheet = result['sheets'][0]
+    row_data = (sheet.get('data') or [{}])[0].get('rowData', [])
+    rows = [[cell.get('formattedValue', '') for cell in row.get('values', [])] for row in row_data]
+    return sheet['properties']['sheetId'], rows
+
+
+# 期限切れの行を連続した範囲 [(開始, 終了)]（0始まり、終了は含まない）にまとめる関数
+def expired_ranges(rows, cutoff):
+    ranges = []
+    for index, row in enumerate(rows):
+        timestamp = _parse_timestamp(row[0]) if row else None
+        if timestamp is None or timestamp >= cutoff:
+            continue
+        if ranges and ranges[-1][1] == index:
+            ranges[-1][1] = index + 1
+        else:
+            ranges.append([index, index + 1])
+    return [tuple(r) for r in ranges]
+
+
+# 削除する範囲から deleteDimension のリクエストを作る関数
+# 後ろの範囲から削除するので、前の範囲の行番号はずれない
+def delete_requests(sheet_id, ranges):
+    return [
+        {'deleteDimension': {'range': {
+            'sheetId': sheet_id, 'dimension': 'ROWS', 'startIndex': start, 'endIndex': end,
+        }}}
+        for start, end in sorted(ranges, reverse=True)
+    ]
+
+
+# 期限切れの行を gzip 圧縮した JSON Lines で保存する関数
+def archive_rows(rows, ranges, archive_dir):
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"sheet-archive-{datetime.now().strftime('%Y%m%d%H%M%S')}.jsonl.gz")
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        for start, end in ranges:
+            for row in rows[start:end]:
+                f.write(json.dumps(row[:ARCHIVE_COLUMNS], ensure_ascii=False) + '\n')
+    return path
+
+
+# 期限切れの行を1回の読み込みと1回の batchUpdate で削除する関数
+def compact_sheet(service, spreadsheet_id, days=RETENTION_DAYS, archive_dir=RETENTION_ARCHIVE_DIR,
+                  dry_run=False, now=None):
+    cutoff = (now or datetime.now()) - timedelta(days=days)
+    sheet_id, rows = read_sheet(service, spreadsheet_id)
+    ranges = expired_ranges(rows, cutoff)
+    deleted = sum(end - start for start, end in ranges)
+    report = {'rows': len(rows), 'deleted': deleted, 'ranges': len(ranges), 'archive': None}
+    if not ranges or dry_run:
+        return report
+
+    if archive_dir:
+        report['archive'] = archive_rows(rows, ranges, archive_dir)
+
+    batch = delete_requests(sheet_id, ranges)
+    # J1 の最新記事IDは1行目と一緒に消えるので書き戻す
+    first = rows[WATERMARK_ROW] if rows else []
+    watermark = first[WATERMARK_COLUMN] if len(first) > WATERMARK_COLUMN else ''
+    if ranges[0][0] == WATERMARK_ROW and watermark:
+        batch.append(watermark_request(sheet_id, watermark))
+
+    with metrics.timer('sheets_batch_update'):
+        service.spreadsheets().batchUpdate(
+            spreadsheetId=spreadsheet_id, body={'requests': batch}).execute()
+    metrics.incr('sheet_rows_deleted_total', deleted)
+    return report
+
+
+# Cloud Functions から定期実行するエントリポイント
+def delete_old_rows(request):
+    from maindeploy import get_service, SPREADSHEET_ID
+
+    try:
+        report = compact_sheet(get_service(), SPREADSHEET_ID)
+        print(f"Retention: {report}")
+        return json.dumps(report)
+    finally:
+        metrics.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='出力シートの期限切れの行をまとめて削除する')
+    parser.add_argument('--days', type=float, default=RETENTION_DAYS, help='行を残す日数')
+    parser.add_argument('--archive-dir', default=RETENTION_ARCHIVE_DIR, help='削除前に行を保存するディレクトリ')
+    parser.add_argument('--dry-run', action='store_true', help='削除せずに件数だけを表示する')
+    args = parser.parse_args()
+
+    from maindeploy import get_service, SPREADSHEET_ID
+
+    try:
+        report = compact_sheet(get_service(), SPREADSHEET_ID, args.days, args.archive_dir, args.dry_run)
+        print(json.dumps(report, ensure_ascii=False))
+    finally:
+        metrics.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+import os
+import re
+import json
+import time
+
+from chunking import count_tokens
+from enrich import FAILURE_MESSAGES
+from metrics import metrics
+
+# '0' にすると各ステージで従来の固定モデルだけを使う
+MODEL_ROUTING = os.getenv('MODEL_ROUTING', '1') == '1'
+
+# モデルごとのコンテキスト長（キーはモデル名の前方一致で選ばれる）
+MODEL_CONTEXT = {
+    'gpt-4-32k': 32768,
+    'gpt-4': 8192,
+    'gpt-3.5-turbo-16k': 16384,
+    'gpt-3.5-turbo': 4096,
+}
+# 出力用に残すトークン数
+COMPLETION_RESERVE = 1000
+
+# ステージごとのルート
+# cascade: 速いモデルから順に試し、品質チェックに通らなければ次のモデルに切り替える
+# direct_tokens: 入力がこのトークン数以上なら最初から最後のモデルを使う
+# min_chars: 出力の最小文字数、language: 出力に期待する言語（'ja' なら日本語の文字の割合を見る）
+DEFAULT_ROUTES = {
+    'summarize': {'cascade': ['gpt-3.5-turbo-0613', 'gpt-3.5-turbo-16k-0613'], 'min_chars': 20},
+    'opinion': {'cascade': ['gpt-3.5-turbo-0613', 'gpt-4'], 'min_chars': 80, 'language': 'ja',
+                'direct_tokens': 3000},
+    'lead': {'cascade': ['gpt-3.5-turbo-0613', 'gpt-4'], 'min_chars': 20, 'language': 'ja'},
+}
+# MODEL_ROUTING=0 の時のルート（変更前と同じモデル）
+FIXED_ROUTES = {
+    'summarize': {'cascade': ['gpt-3.5-turbo-16k-0613']},
+    'opinion': {'cascade': ['gpt-4']},
+    'lead': {'cascade': ['gpt-3.5-turbo-0613']},
+}
+
+# 日本語として扱う文字（ひらがな・カタカナ・漢字）
+JAPANESE_CHARS = re.compile(r'[\u3040-\u30ff\u3400-\u9fff]')
+# 言語の判定に使う文字（空白・数字・記号を除く）
+LETTER_CHARS = re.compile(r'[^\W\d_]')
+# 日本語の文字がこの割合未満なら別の言語とみなす
+MIN_JAPANESE_RATIO = 0.3
+
+
+def context_length(model):
+    matches = [key for key in MODEL_CONTEXT if model.startswith(key)]
+    return MODEL_CONTEXT[max(matches, key=len)] if matches else None
+
+
+# 出力の品質を安価に確認し、問題があれば理由を返す関数（問題がなければ None）
+def check_output(text, route):
+    if not text or not text.strip():
+        return 'empty'
+    if text in FAILURE_MESSAGES:
+        return 'failed'
+    if len(text.strip()) < route.get('min_chars', 0):
+        return 'too_short'
+    if route.get('language') == 'ja':
+        letters = LETTER_CHARS.findall(text)
+        if letters and len(JAPANESE_CHARS.findall(text)) / len(letters) < MIN_JAPANESE_RATIO:
+            return 'wrong_language'
+    return None
+
+
+# ステージと入力の長さからモデルを選び、品質チェックに通らなければ大きなモデルに切り替えるクラス
+# 切り替えの判断は構造化ログと model_route_total に記録するので、レイテンシとコストの調整に使える
+class ModelRouter:
+    def __init__(self, routes):
+        self.routes = routes
+
+    # MODEL_ROUTES にJSON（またはJSONファイルのパス）を指定すると、ステージごとにルートを上書きできる
+    @classmethod
+    def from_env(cls):
+        routes = dict(DEFAULT_ROUTES if MODEL_ROUTING else FIXED_ROUTES)
+        override = os.getenv('MODEL_ROUTES')
+        if MODEL_ROUTING and override:
+            if os.path.exists(override):
+                with open(override, encoding='utf-8') as f:
+                    override = f.read()
+            routes.update(json.loads(override))
+        return cls(routes)
+
+    # 試すモデルの (モデル, 理由) のリストと入力のトークン数を返す
+    def candidates(self, stage, messages):
+        route = self.routes[stage]
+        cascade = list(route['cascade'])
+        tokens = sum(count_tokens(str(message.get('content') or '')) for message in messages)
+        # コンテキストに収まらないモデルは飛ばす（最後のモデルは収まらなくても残す）
+        fitting = [model for model in cascade
+                   if (context_length(model) or float('inf')) >= tokens + COMPLETION_RESERVE]
+        if not fitting:
+            return [(cascade[-1], 'too_long')], tokens
+        if route.get('direct_tokens') and tokens >= route['direct_tokens']:
+            return [(fitting[-1], 'long_input')], tokens
+        reasons = ['first'] + ['escalated'] * (len(fitting) - 1)
+        return list(zip(fitting, reasons)), tokens
+
+    def _record(self, stage, model, reason, tokens, problem, elapsed):
+        result = problem or 'ok'
+        metrics.incr('model_route_total', stage=stage, model=model, result=result)
+        metrics.observe('model_route_seconds', elapsed, stage=stage, model=model)
+        metrics.log('route', stage=stage, model=model, reason=reason, input_tokens=tokens, result=result,
+                    seconds=round(elapsed, 4))
+
+    # call(model, temperature, messages) でモデルを呼び出し、品質チェックに通った出力を返す
+    # すべてのモデルで通らなければ、最後に得られた空でない出力を返す
+    def complete(self, stage, temperature, messages, call):
+        route = self.routes[stage]
+        candidates, tokens = self.candidates(stage, messages)
+        best = None
+        for model, reason in candidates:
+            started = time.perf_counter()
+            text = call(model, temperature, messages)
+            problem = check_output(text, route)
+            self._record(stage, model, reason, tokens, problem, time.perf_counter() - started)
+            if problem is None:
+                return text
+            if problem not in ('empty', 'failed'):
+                best = text
+        return best
+
+    # complete の非同期版（call はコルーチン関数）
+    async def acomplete(self, stage, temperature, messages, call):
+        route = self.routes[stage]
+        candidates, tokens = self.candidates(stage, messages)
+        best = None
+        for model, reason in candidates:
+            started = time.perf_counter()
+            text = await call(model, temperature, messages)
+            problem = check_output(text, route)
+            self._record(stage, model, reason, tokens, problem, time.perf_counter() - started)
+            if problem is None:
+                return text
+            if problem not in ('empty', 'failed'):
+                best = text
+        return best
+
+
+# 全エントリポイントで共有するルーター
+model_router = ModelRouter.from_env()
@@ -0,0 +1,147 @@
+from metrics import metrics
+
+# 最新記事IDが保存されるセルと、その行・列（0始まり）
+WATERMARK_RANGE = 'J1'
+WATERMARK_ROW = 0
+WATERMARK_COLUMN = ord(WATERMARK_RANGE[0]) - ord('A')
+# 行のニュースIDの列（0始まり、F列）
+ITEM_ID_COLUMN = 5
+
+
+# セルの値を CellData に変換する関数（valueInputOption=RAW と同じく、文字列は数式などとして解釈しない）
+def cell_data(value):
+    if value is None:
+        return {}
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {'userEnteredValue': {'numberValue': value}}
+    return {'userEnteredValue': {'stringValue': str(value)}}
+
+
+# 最新記事ID（J1）を書き込む updateCells リクエスト
+def watermark_request(sheet_id, watermark):
+    value = {'numberValue': int(watermark)} if str(watermark).isdigit() else {'stringValue': str(watermark)}
+    return {'updateCells': {
+        'start': {'sheetId': sheet_id, 'rowIndex': WATERMARK_ROW, 'columnIndex': WATERMARK_COLUMN},
+        'rows': [{'values': [{'userEnteredValue': value}]}],
+        'fields': 'userEnteredValue',
+    }}
+
+
+# カテゴリ名のリストを返す関数
+# 抽出チェーンの結果（辞書のリスト）・文字列のリストに対応する（エラーメッセージなどの文字列は空のリスト）
+def category_names(categories):
+    if isinstance(categories, str):
+        return []
+    names = []
+    for category in categories or []:
+        if isinstance(category, dict):
+            names.extend(str(value) for value in category.values() if value)
+        elif category:
+            names.append(str(category))
+    return names
+
+
+# カテゴリをセルに書き込む文字列に変換する関数（エラーメッセージはそのまま書き込む）
+def format_categories(categories):
+    if isinstance(categories, str):
+        return categories
+    return ", ".join(category_names(categories))
+
+
+# 1回の実行で書き込む行をバッファし、まとめて1回のAPI呼び出しで書き込むクラス
+# 行は appendCells でシートの末尾に追加するので、複数のインスタンスが同時に書き込んでも行は上書きされない
+class BufferedSheetWriter:
+    def __init__(self, service, spreadsheet_id):
+        self.service = service
+        self.spreadsheet_id = spreadsheet_id
+        self.sheet_id = None
+        self.watermark = None
+        self.request_count = 0
+        # 書き込みが完了した行（WordPressへの公開などに使う）
+        self.flushed_rows = []
+        self._rows = []
+        self._new_watermark = None
+
+    # 書き込むシートのIDと最新記事IDを1回の spreadsheets.get で取得する
+    def fetch_metadata(self):
+        with metrics.timer('sheets_get'):
+            result = self.service.spreadsheets().get(
+                spreadsheetId=self.spreadsheet_id,
+                ranges=[WATERMARK_RANGE],
+                includeGridData=True,
+                fields='sheets(properties(sheetId),data(rowData(values(formattedValue))))',
+            ).execute()
+        self.request_count += 1
+        sheet = result['sheets'][0]
+        row_data = (sheet.get('data') or [{}])[0].get('rowData', [])
+        values = row_data[0].get('values', []) if row_data else []
+        self.sheet_id = sheet['properties']['sheetId']
+        self.watermark = values[0].get('formattedValue') if values else None
+        return self.watermark
+
+    # 前回のニュースIDを返す（未取得なら取得する）
+    def fetch_watermark(self):
+        if self.sheet_id is None:
+            self.fetch_metadata()
+        return self.watermark
+
+    def add_row(self, values):
+        self._rows.append(list(values))
+
+    # 指定したニュースIDの行をバッファから取り除き、取り除いた行数を返す
+    def discard_rows(self, item_ids):
+        item_ids = set(item_ids)
+        rows = [row for row in self._rows if len(row) <= ITEM_ID_COLUMN or row[ITEM_ID_COLUMN] not in item_ids]
+        discarded = len(self._rows) - len(rows)
+        self._rows = rows
+        return discarded
+
+    # バッファの行をニュースIDの昇順に並べる（パイプラインは完了順に行を追加するため）
+    # フィードの記事など正のIDを持たない行は、完了順のままHNの行の後に置く
+    def sort_rows(self):
+        def key(row):
+            item_id = row[ITEM_ID_COLUMN] if len(row) > ITEM_ID_COLUMN else None
+            if isinstance(item_id, int) and item_id > 0:
+                return (0, item_id)
+            return (1, 0)
+
+        self._rows.sort(key=key)
+
+    # 最新記事IDは大きい方を残す（フィードの記事の負のIDや、優先度順で後に書く古いIDでは戻さない）
+    def set_watermark(self, new_id):
+        if new_id > 0 and (self._new_watermark is None or new_id > self._new_watermark):
+            self._new_watermark = new_id
+
+    def pending(self):
+        return len(self._rows)
+
+    # バッファした行の追加と最新記事IDの更新を1回の batchUpdate で行う
+    def flush(self):
+        if not self._rows and self._new_watermark is None:
+            return None
+        if self.sheet_id is None:
+            self.fetch_metadata()
+
+        requests = []
+        if self._rows:
+            requests.append({'appendCells': {
+                'sheetId': self.sheet_id,
+                'rows': [{'values': [cell_data(value) for value in row]} for row in self._rows],
+                'fields': 'userEnteredValue',
+            }})
+        if self._new_watermark is not None:
+            requests.append(watermark_request(self.sheet_id, self._new_watermark))
+
+        with metrics.timer('sheets_batch_update'):
+            result = self.service.spreadsheets().batchUpdate(
+                spreadsheetId=self.spreadsheet_id,
+                body={'requests': requests},
+            ).execute()
+        self.request_count += 1
+
+        self.flushed_rows.extend(self._rows)
+        if self._new_watermark is not None:
+            self.watermark = self._new_watermark
+        self._rows = []
+        self._new_watermark = None
+        return result
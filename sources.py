@@ -0,0 +1,314 @@
+import os
+import json
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from hnsource import html_to_text
+from llmcache import content_hash
+from ratelimit import limiter
+from metrics import metrics
+
+# ニュースの取得元（ソース）と、全ソースの候補を優先度順に並べて1回分の処理対象を決めるスケジューラ
+# lxml はフィードを取得する時にインポートする
+
+# フィードから読む最大件数（これを読んだら残りはダウンロードしない）
+FEED_MAX_ENTRIES = int(os.getenv('FEED_MAX_ENTRIES', '50'))
+# トップストーリーから候補にする件数（処理済みを除く前）
+TOP_STORIES_WINDOW = 100
+
+# 1件の処理に使うトークン数とリクエスト数の見積もり（共有のレート制限の枠から処理できる件数を求める）
+INGEST_BUDGET_MODEL = os.getenv('INGEST_BUDGET_MODEL', 'gpt-3.5-turbo')
+INGEST_STORY_TOKENS = int(os.getenv('INGEST_STORY_TOKENS', '4000'))
+INGEST_STORY_REQUESTS = int(os.getenv('INGEST_STORY_REQUESTS', '5'))
+# 1回の処理にかかる秒数の見積もり（この間に回復する枠も数える）
+INGEST_BUDGET_SECONDS = float(os.getenv('INGEST_BUDGET_SECONDS', '60'))
+
+# ソースを指定しなければ、これまでどおりHNの新着だけを取得する
+DEFAULT_SOURCES = [{'type': 'hn_newest', 'priority': 10}]
+
+RSS_CONTENT = '{http://purl.org/rss/1.0/modules/content/}encoded'
+DC_CREATOR = '{http://purl.org/dc/elements/1.1/}creator'
+RDF_ITEM = '{http://purl.org/rss/1.0/}item'
+ATOM = '{http://www.w3.org/2005/Atom}'
+FEED_ENTRY_TAGS = ('item', RDF_ITEM, ATOM + 'entry')
+
+
+# フィードの記事のID（HNのIDと重ならないよう、GUIDかリンクのハッシュから負の整数を作る）
+def feed_item_id(key):
+    return -(int(content_hash(key)[:15], 16) + 1)
+
+
+def _parse_time(value):
+    if not value:
+        return None
+    try:
+        return int(parsedate_to_datetime(value).timestamp())
+    except (TypeError, ValueError, IndexError):
+        pass
+    try:
+        return int(datetime.fromisoformat(value.strip().replace('Z', '+00:00')).timestamp())
+    except ValueError:
+        return None
+
+
+def _find_text(element, *tags):
+    for tag in tags:
+        value = element.findtext(tag)
+        if value and value.strip():
+            return value.strip()
+    return ''
+
+
+# RSS の item・Atom の entry を HNのアイテムと同じ形の辞書に変換する関数
+def entry_to_document(element, source_name):
+    if element.tag == ATOM + 'entry':
+        link = ''
+        for link_element in element.iterfind(ATOM + 'link'):
+            if link_element.get('rel', 'alternate') == 'alternate':
+                link = link_element.get('href', '')
+                break
+        title = _find_text(element, ATOM + 'title')
+        body = _find_text(element, ATOM + 'content', ATOM + 'summary')
+        key = _find_text(element, ATOM + 'id') or link
+        author = _find_text(element, f'{ATOM}author/{ATOM}name')
+        published = _find_text(element, ATOM + 'published', ATOM + 'updated')
+    else:
+        namespace = RDF_ITEM[:-len('item')] if element.tag == RDF_ITEM else ''
+        title = _find_text(element, namespace + 'title')
+        link = _find_text(element, namespace + 'link')
+        body = _find_text(element, RSS_CONTENT, namespace + 'description')
+        key = _find_text(element, 'guid') or link
+        author = _find_text(element, 'author', DC_CREATOR)
+        published = _find_text(element, 'pubDate', '{http://purl.org/dc/elements/1.1/}date')
+    if not key or not (title or body):
+        return None
+    parts = [title, link, html_to_text(body)]
+    return {
+        'id': feed_item_id(key),
+        'title': title,
+        'url': link or None,
+        'by': author or None,
+        'time': _parse_time(published),
+        'score': 0,
+        'source': source_name,
+        'page_content': '\n\n'.join(part for part in parts if part),
+    }
+
+
+# フィードを少しずつ読みながら記事を取り出す関数（読み終えた要素は解放してメモリを一定に保つ）
+def parse_feed(stream, source_name, max_entries=FEED_MAX_ENTRIES):
+    from lxml import etree
+
+    documents = []
+    for _, element in etree.iterparse(stream, events=('end',), tag=FEED_ENTRY_TAGS, recover=True,
+                                      resolve_entities=False, no_network=True):
+        document = entry_to_document(element, source_name)
+        if document:
+            documents.append(document)
+        element.clear(keep_tail=False)
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+        if len(documents) >= max_entries:
+            break
+    return documents
+
+
+# 処理対象の候補
+# value はパイプラインに流す値（HNのアイテムはID、フィードの記事は取得済みの内容）
+class Candidate:
+    def __init__(self, key, source, priority, score=0, document=None):
+        self.key = key
+        self.source = source
+        self.priority = priority
+        self.score = score
+        self.value = document if document is not None else key
+
+
+# HNの新着（最新記事IDより新しいものを古い順に取得する。最新記事IDを進めるのはこのソースだけ）
+class HNNewestSource:
+    follows_watermark = True
+
+    def __init__(self, name='hn_newest', priority=10, quota=None):
+        self.name = name
+        self.priority = priority
+        self.quota = quota
+
+    def fetch(self, hn_source, state_store, watermark, limit):
+        # 処理済みのIDを除いてから件数を絞る（先に絞ると、止まった未完了のIDの後ろの処理済みの範囲だけを毎回取得する）
+        item_ids = hn_source.fetch_new_ids(watermark, limit, state_store.filter_unseen)
+        # 新着一覧から外れた未完了のIDは二度と取得されず最新記事IDを止め続けるので、失敗として記録する
+        if hn_source.oldest_new_id is not None:
+            expired = state_store.expire_pending_before(hn_source.oldest_new_id)
+            if expired:
+                print(f"Giving up on {len(expired)} pending stories that left newstories.json: {expired}")
+                metrics.incr('ingest_items_total', len(expired), source=self.name, result='expired')
+        return [Candidate(item_id, self.name, self.priority) for item_id in item_ids]
+
+
+# HNのトップページ（順位が高いほどスコアを高くする）
+class HNTopSource:
+    follows_watermark = False
+
+    def __init__(self, name='hn_top', priority=20, quota=10, window=TOP_STORIES_WINDOW):
+        self.name = name
+        self.priority = priority
+        self.quota = quota
+        self.window = window
+
+    def fetch(self, hn_source, state_store, watermark, limit):
+        item_ids = hn_source.fetch_top_ids(self.window)
+        return [Candidate(item_id, self.name, self.priority, score=len(item_ids) - rank)
+                for rank, item_id in enumerate(item_ids)]
+
+
+# RSS・Atom のフィード
+# ETag・Last-Modified で条件付きリクエストを送り、変化がなければ前回の候補を使う
+class FeedSource:
+    follows_watermark = False
+
+    def __init__(self, url, name=None, priority=0, quota=5, max_entries=FEED_MAX_ENTRIES, timeout=10,
+                 session=None):
+        self.url = url
+        self.name = name or url
+        self.priority = priority
+        self.quota = quota
+        self.max_entries = max_entries
+        self.timeout = timeout
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=2)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+        self._etag = None
+        self._last_modified = None
+        self._documents = []
+
+    def fetch(self, hn_source, state_store, watermark, limit):
+        headers = {'Accept': 'application/rss+xml, application/atom+xml, application/xml;q=0.9, */*;q=0.5'}
+        if self._etag:
+            headers['If-None-Match'] = self._etag
+        if self._last_modified:
+            headers['If-Modified-Since'] = self._last_modified
+        with self.session.get(self.url, headers=headers, timeout=self.timeout, stream=True) as response:
+            if response.status_code == 304:
+                metrics.incr('feed_requests_total', source=self.name, result='not_modified')
+            else:
+                response.raise_for_status()
+                response.raw.decode_content = True
+                self._documents = parse_feed(response.raw, self.name, self.max_entries)
+                self._etag = response.headers.get('ETag')
+                self._last_modified = response.headers.get('Last-Modified')
+                metrics.incr('feed_requests_total', source=self.name, result='fetched')
+        # パイプラインで書き換えられても前回の候補が変わらないよう、コピーを渡す
+        return [Candidate(document['id'], self.name, self.priority, document=dict(document))
+                for document in self._documents]
+
+
+# 設定からソースを作る関数
+def build_source(config):
+    config = dict(config)
+    kind = config.pop('type')
+    if kind == 'hn_newest':
+        return HNNewestSource(**config)
+    if kind == 'hn_top':
+        return HNTopSource(**config)
+    if kind == 'feed':
+        return FeedSource(**config)
+    raise ValueError(f"ソースの種類 '{kind}' は使えません（'hn_newest'・'hn_top'・'feed'）。")
+
+
+# 共有のレート制限の枠から、1回で処理できる件数を見積もるクラス
+class LLMBudget:
+    def __init__(self, model=INGEST_BUDGET_MODEL, story_tokens=INGEST_STORY_TOKENS,
+                 story_requests=INGEST_STORY_REQUESTS, horizon=INGEST_BUDGET_SECONDS):
+        self.model = model
+        self.story_tokens = story_tokens
+        self.story_requests = story_requests
+        self.horizon = horizon
+
+    def stories(self):
+        requests_bucket, tokens_bucket = limiter.buckets(self.model)
+        tokens = tokens_bucket.available() + tokens_bucket.rate * self.horizon
+        request_count = requests_bucket.available() + requests_bucket.rate * self.horizon
+        return max(0, int(min(tokens / self.story_tokens, request_count / self.story_requests)))
+
+
+# 1回分の処理対象
+class IngestBatch:
+    def __init__(self):
+        # (キー, 値) のリスト（パイプラインにそのまま流す）
+        self.items = []
+        # 最新記事IDを進める対象として取得したID
+        self.polled = []
+        # 取得したが上限や予算で今回は処理しないID（最新記事IDはこの手前で止める）
+        self.held_back = []
+
+
+# 全ソースの候補を優先度・スコアの順に並べ、ソースごとの上限と共有のLLMの予算の範囲で処理対象を決めるクラス
+# 優先度の高いソース（トップページなど）から枠を使うので、ソースを増やしても見出しの処理は押し出されない
+class IngestScheduler:
+    def __init__(self, sources, budget=None):
+        self.sources = sources
+        self.budget = budget
+
+    # INGEST_SOURCES にJSON（またはJSONファイルのパス）でソースの一覧を指定する
+    @classmethod
+    def from_env(cls):
+        config = os.getenv('INGEST_SOURCES')
+        if config and os.path.exists(config):
+            with open(config, encoding='utf-8') as f:
+                config = f.read()
+        sources = [build_source(source) for source in (json.loads(config) if config else DEFAULT_SOURCES)]
+        budget = LLMBudget() if os.getenv('INGEST_BUDGET', '1') == '1' else None
+        return cls(sources, budget)
+
+    # 最新記事IDに頼らず、毎回取得し直す必要があるソース（フィードなど）があるか
+    def polls_always(self):
+        return any(not source.follows_watermark for source in self.sources)
+
+    # 再試行のIDを先頭に、各ソースの未処理の候補を優先度順に並べて最大 limit 件を返す
+    def next_batch(self, hn_source, state_store, watermark, retry_ids, limit):
+        batch = IngestBatch()
+        capacity = limit if self.budget is None else min(limit, self.budget.stories())
+        candidates = []
+        for source in self.sources:
+            quota = source.quota or limit
+            try:
+                found = source.fetch(hn_source, state_store, watermark, quota)
+            except Exception as e:
+                print(f"Error fetching source {source.name}: {e}")
+                metrics.incr('ingest_source_errors_total', source=source.name)
+                continue
+            if source.follows_watermark:
+                batch.polled.extend(candidate.key for candidate in found)
+            unseen = set(state_store.filter_unseen([candidate.key for candidate in found]))
+            candidates.extend([candidate for candidate in found if candidate.key in unseen][:quota])
+
+        # 最新記事IDを進めたり止めたりできるのは新着として取得したIDだけ（トップページの記事などは飛び越えない）
+        if batch.polled:
+            state_store.mark_polled(*batch.polled)
+
+        admitted = set()
+        for item_id in retry_ids[:capacity]:
+            batch.items.append((item_id, item_id))
+            admitted.add(item_id)
+        # 同じ優先度・スコアの中では各ソースの順序（新着は古い順）を保つ
+        candidates.sort(key=lambda candidate: (-candidate.priority, -candidate.score))
+        for candidate in candidates:
+            if candidate.key in admitted:
+                continue
+            if len(batch.items) >= capacity:
+                if candidate.key in batch.polled:
+                    batch.held_back.append(candidate.key)
+                metrics.incr('ingest_items_total', source=candidate.source, result='deferred')
+                continue
+            admitted.add(candidate.key)
+            batch.items.append((candidate.key, candidate.value))
+            metrics.incr('ingest_items_total', source=candidate.source, result='scheduled')
+        metrics.log('ingest', capacity=capacity, candidates=len(candidates), scheduled=len(batch.items),
+                    held_back=len(batch.held_back))
+        return batch
@@ -0,0 +1,70 @@
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+# 新しいプロセス（コールドスタート相当）で maindeploy の起動時間を計測するスクリプト
+SNIPPET = '''
+import json, sys, time
+t0 = time.perf_counter()
+import maindeploy
+t1 = time.perf_counter()
+heavy = [m for m in ('langchain', 'googleapiclient', 'bs4', 'aiohttp', 'lxml', 'numpy') if m in sys.modules]
+if LIVE:
+    # 実際のAPIに対して最初のリクエストを処理
+    maindeploy.check_new_hn_content(None)
+else:
+    # 認証情報なしで service を作成し、最初のリクエストを組み立てるまでを計測
+    from google.auth.credentials import AnonymousCredentials
+    maindeploy.get_credentials = lambda: AnonymousCredentials()
+    service = maindeploy.get_service()
+    service.spreadsheets().values().batchGet(spreadsheetId='benchmark', ranges=['J1', 'A:A'])
+t2 = time.perf_counter()
+# 2回目はウォームなコンテナで service が再利用されることを確認
+maindeploy.get_service()
+t3 = time.perf_counter()
+print(json.dumps({
+    'import_ms': (t1 - t0) * 1000,
+    'first_request_ms': (t2 - t1) * 1000,
+    'warm_service_ms': (t3 - t2) * 1000,
+    'heavy_modules_after_import': heavy,
+}))
+'''
+
+
+def run_once(live):
+    env = dict(os.environ)
+    if not live:
+        # オフライン計測用のダミー設定
+        env.setdefault('GOOGLE_APPLICATION_CREDENTIALS_JSON', 'e30=')
+        env.setdefault('YOUR_SPREADSHEET_ID', 'benchmark')
+        env.setdefault('OPENAI_API_KEY', 'sk-benchmark')
+    code = f'LIVE = {live!r}\n' + SNIPPET
+    output = subprocess.run(
+        [sys.executable, '-c', code],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env, check=True, capture_output=True, text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='maindeploy のコールドスタート時間を計測します')
+    parser.add_argument('--runs', type=int, default=5, help='計測回数')
+    parser.add_argument('--live', action='store_true', help='実際のAPIに対して最初のリクエストを実行する')
+    args = parser.parse_args()
+
+    results = [run_once(args.live) for _ in range(args.runs)]
+    report = {
+        key: statistics.median(r[key] for r in results)
+        for key in ('import_ms', 'first_request_ms', 'warm_service_ms')
+    }
+    report['runs'] = args.runs
+    report['heavy_modules_after_import'] = results[-1]['heavy_modules_after_import']
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
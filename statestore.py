@@ -0,0 +1,239 @@
+import os
+import json
+import time
+import sqlite3
+import tempfile
+import threading
+
+# 状態ファイルのデフォルトの保存先
+DEFAULT_STATE_PATH = os.path.join(tempfile.gettempdir(), 'autonews_state.sqlite3')
+
+# 処理状態
+STATUS_PENDING = 'pending'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+# 失敗したニュースを再試行するまでの秒数（試行ごとに倍になる）と最大試行回数
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', '300'))
+RETRY_MAX_ATTEMPTS = int(os.getenv('RETRY_MAX_ATTEMPTS', '5'))
+
+
+# 処理済みのニュースIDとステージごとの状態をローカルに保存するクラス
+class StateStore:
+    def __init__(self, path=DEFAULT_STATE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(
+            'CREATE TABLE IF NOT EXISTS items ('
+            ' id INTEGER PRIMARY KEY,'
+            ' status TEXT NOT NULL,'
+            ' updated_at REAL NOT NULL);'
+            'CREATE INDEX IF NOT EXISTS items_status ON items (status);'
+            'CREATE INDEX IF NOT EXISTS items_updated_at ON items (updated_at);'
+            'CREATE TABLE IF NOT EXISTS stages ('
+            ' item_id INTEGER NOT NULL,'
+            ' stage TEXT NOT NULL,'
+            ' status TEXT NOT NULL,'
+            ' updated_at REAL NOT NULL,'
+            ' PRIMARY KEY (item_id, stage)) WITHOUT ROWID;'
+            'CREATE TABLE IF NOT EXISTS meta ('
+            ' key TEXT PRIMARY KEY,'
+            ' value TEXT NOT NULL);'
+            'CREATE TABLE IF NOT EXISTS checkpoints ('
+            ' item_id INTEGER NOT NULL,'
+            ' field TEXT NOT NULL,'
+            ' value TEXT NOT NULL,'
+            ' updated_at REAL NOT NULL,'
+            ' PRIMARY KEY (item_id, field)) WITHOUT ROWID;'
+            'CREATE TABLE IF NOT EXISTS retries ('
+            ' item_id INTEGER PRIMARY KEY,'
+            ' attempts INTEGER NOT NULL,'
+            ' next_attempt_at REAL NOT NULL,'
+            ' stage TEXT,'
+            ' error TEXT);'
+            # 最新記事IDを基準に取得したニュース（HNの新着）。最新記事IDはこのIDだけで決める
+            'CREATE TABLE IF NOT EXISTS polled ('
+            ' id INTEGER PRIMARY KEY);'
+        )
+
+    @classmethod
+    def from_env(cls):
+        return cls(os.getenv('AUTONEWS_STATE_DB', DEFAULT_STATE_PATH))
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def status(self, item_id):
+        rows = self._execute('SELECT status FROM items WHERE id = ?', (item_id,))
+        return rows[0][0] if rows else None
+
+    def is_processed(self, item_id):
+        return self.status(item_id) == STATUS_DONE
+
+    def __contains__(self, item_id):
+        return self.is_processed(item_id)
+
+    # 取得したIDのうち、まだ処理が完了していないものを元の順序で返す
+    def filter_unseen(self, item_ids):
+        item_ids = list(item_ids)
+        if not item_ids:
+            return []
+        rows = self._execute(
+            'SELECT value FROM json_each(?) WHERE value IN '
+            '(SELECT id FROM items WHERE status = ?)',
+            (json.dumps(item_ids), STATUS_DONE),
+        )
+        done = {row[0] for row in rows}
+        return [item_id for item_id in item_ids if item_id not in done]
+
+    # 再取得を始めるべきID（処理中のまま止まったニュースがあればその直前、なければ処理済みの最大ID）
+    # 失敗したニュースは再試行キューから取り出すので、ここでは待たない
+    # トップページやフィードの記事は新着の順序と関係ないので、新着として取得したニュースだけを見る
+    def watermark(self):
+        rows = self._execute(
+            'SELECT MIN(id) FROM items WHERE status = ? AND id IN (SELECT id FROM polled)', (STATUS_PENDING,))
+        if rows[0][0] is not None:
+            return rows[0][0] - 1
+        rows = self._execute("SELECT value FROM meta WHERE key = 'watermark'")
+        return int(rows[0][0]) if rows else None
+
+    # ステージの状態を記録する（ニュース自体は未完了として登録）
+    def mark_stage(self, item_id, stage, status=STATUS_DONE):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute('BEGIN')
+            self._conn.execute(
+                'INSERT INTO items (id, status, updated_at) VALUES (?, ?, ?) '
+                'ON CONFLICT (id) DO UPDATE SET updated_at = excluded.updated_at',
+                (item_id, STATUS_PENDING, now),
+            )
+            self._conn.execute(
+                'INSERT OR REPLACE INTO stages (item_id, stage, status, updated_at) VALUES (?, ?, ?, ?)',
+                (item_id, stage, status, now),
+            )
+
+    # 新着として取得したIDを記録する（このIDだけが最新記事IDを進めたり止めたりする）
+    def mark_polled(self, *item_ids):
+        with self._lock, self._conn:
+            self._conn.execute('BEGIN')
+            self._conn.executemany('INSERT OR IGNORE INTO polled (id) VALUES (?)', [(item_id,) for item_id in item_ids])
+
+    # ニュースを未完了として登録する（新着なら最新記事IDがこれを越えないようにする）
+    def mark_pending(self, *item_ids):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute('BEGIN')
+            self._conn.executemany(
+                'INSERT INTO items (id, status, updated_at) VALUES (?, ?, ?) '
+                'ON CONFLICT (id) DO UPDATE SET updated_at = excluded.updated_at',
+                [(item_id, STATUS_PENDING, now) for item_id in item_ids],
+            )
+
+    # 新着として取得したIDのうち、指定したIDより古い未完了のものを失敗として記録し、そのIDを返す
+    # （新着一覧から外れたIDは二度と取得されないので、最新記事IDを止め続けないようにする）
+    def expire_pending_before(self, item_id):
+        rows = self._execute(
+            'SELECT id FROM items WHERE status = ? AND id < ? AND id IN (SELECT id FROM polled) ORDER BY id',
+            (STATUS_PENDING, item_id),
+        )
+        expired = [row[0] for row in rows]
+        self.mark_failed(*expired)
+        return expired
+
+    # ステージの出力を保存する（再実行時はこの続きから処理する）
+    def save_checkpoint(self, item_id, field, value):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO checkpoints (item_id, field, value, updated_at) VALUES (?, ?, ?, ?)',
+                (item_id, field, json.dumps(value, ensure_ascii=False), time.time()),
+            )
+        self.mark_stage(item_id, field)
+
+    # 保存済みのステージの出力を {項目: 値} で返す
+    def checkpoints(self, item_id):
+        rows = self._execute('SELECT field, value FROM checkpoints WHERE item_id = ?', (item_id,))
+        return {field: json.loads(value) for field, value in rows}
+
+    # 失敗したニュースを再試行キューに入れる（最大試行回数を超えたら諦めて False を返す）
+    def enqueue_retry(self, item_id, stage=None, error=None, base_delay=RETRY_BASE_DELAY,
+                      max_attempts=RETRY_MAX_ATTEMPTS):
+        rows = self._execute('SELECT attempts FROM retries WHERE item_id = ?', (item_id,))
+        attempts = (rows[0][0] if rows else 0) + 1
+        self.mark_failed(item_id)
+        with self._lock:
+            if attempts > max_attempts:
+                self._conn.execute('DELETE FROM retries WHERE item_id = ?', (item_id,))
+                return False
+            self._conn.execute(
+                'INSERT OR REPLACE INTO retries (item_id, attempts, next_attempt_at, stage, error) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (item_id, attempts, time.time() + base_delay * 2 ** (attempts - 1), stage, str(error)[:500]),
+            )
+        return True
+
+    # 再試行の時刻になったニュースのIDを古い順に返す
+    def due_retries(self, limit=None):
+        rows = self._execute(
+            'SELECT item_id FROM retries WHERE next_attempt_at <= ? ORDER BY item_id LIMIT ?',
+            (time.time(), -1 if limit is None else limit),
+        )
+        return [row[0] for row in rows]
+
+    def stage_statuses(self, item_id):
+        rows = self._execute('SELECT stage, status FROM stages WHERE item_id = ?', (item_id,))
+        return dict(rows)
+
+    # 複数のニュースの状態をまとめて更新する
+    def mark_items(self, item_ids, status):
+        item_ids = list(item_ids)
+        if not item_ids:
+            return
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute('BEGIN')
+            self._conn.executemany(
+                'INSERT INTO items (id, status, updated_at) VALUES (?, ?, ?) '
+                'ON CONFLICT (id) DO UPDATE SET status = excluded.status, updated_at = excluded.updated_at',
+                [(item_id, status, now) for item_id in item_ids],
+            )
+            if status == STATUS_DONE:
+                # 書き込みが終わったニュースのチェックポイントと再試行は不要になる
+                self._conn.executemany(
+                    'DELETE FROM checkpoints WHERE item_id = ?', [(item_id,) for item_id in item_ids])
+                self._conn.executemany(
+                    'DELETE FROM retries WHERE item_id = ?', [(item_id,) for item_id in item_ids])
+            if status in (STATUS_DONE, STATUS_FAILED):
+                # 古いエントリを整理しても再処理しないよう、新着として取得して処理済みになった最大IDを別に保存
+                # （失敗したニュースは再試行キューから処理する。トップページの記事などでは進めない）
+                self._conn.execute(
+                    "INSERT INTO meta (key, value) "
+                    "SELECT 'watermark', top FROM (SELECT MAX(id) AS top FROM polled "
+                    "WHERE id IN (SELECT value FROM json_each(?))) WHERE top IS NOT NULL "
+                    "ON CONFLICT (key) DO UPDATE SET value = MAX(CAST(value AS INTEGER), CAST(excluded.value AS INTEGER))",
+                    (json.dumps(item_ids),),
+                )
+
+    def mark_done(self, *item_ids):
+        self.mark_items(item_ids, STATUS_DONE)
+
+    def mark_failed(self, *item_ids):
+        self.mark_items(item_ids, STATUS_FAILED)
+
+    # 指定した秒数より古いエントリを削除する
+    def compact(self, max_age):
+        cutoff = time.time() - max_age
+        with self._lock, self._conn:
+            self._conn.execute('BEGIN')
+            for table in ('stages', 'checkpoints', 'retries'):
+                self._conn.execute(
+                    f'DELETE FROM {table} WHERE item_id IN (SELECT id FROM items WHERE updated_at < ?)', (cutoff,)
+                )
+            self._conn.execute('DELETE FROM polled WHERE id IN (SELECT id FROM items WHERE updated_at < ?)', (cutoff,))
+            removed = self._conn.execute('DELETE FROM items WHERE updated_at < ?', (cutoff,)).rowcount
+        return removed
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,77 @@
+import os
+import sys
+import json
+import threading
+from urllib.parse import urlsplit
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+# テストはリポジトリ直下のモジュールをそのままインポートする
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# 外部APIの代わりにテストの中で応答を決めるローカルのHTTPサーバー
+# routes[パス] に request を受け取って (ステータス, ヘッダ, 本文) を返す関数を登録する
+# （本文は bytes・文字列・JSONにする値のいずれか）
+class StubServer:
+    def __init__(self):
+        self.routes = {}
+        self.requests = []
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def handle_request(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                parts = urlsplit(self.path)
+                request = {'method': self.command, 'path': parts.path, 'query': parts.query,
+                           'headers': dict(self.headers), 'body': body}
+                with server._lock:
+                    server.requests.append(request)
+                route = server.routes.get(parts.path)
+                status, headers, data = route(request) if route else (404, {}, {'code': 'not_found'})
+                if not isinstance(data, (bytes, str)):
+                    data = json.dumps(data)
+                    headers = dict({'Content-Type': 'application/json'}, **headers)
+                if isinstance(data, str):
+                    data = data.encode('utf-8')
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                try:
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            do_GET = handle_request
+            do_POST = handle_request
+
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._httpd.daemon_threads = True
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self._httpd.server_port}'
+
+    # 指定したパスへのリクエスト
+    def requests_to(self, path):
+        with self._lock:
+            return [request for request in self.requests if request['path'] == path]
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+@pytest.fixture
+def stub_server():
+    server = StubServer()
+    yield server
+    server.close()
@@ -0,0 +1,164 @@
+import time
+import asyncio
+import threading
+
+import pytest
+
+import articlefetch
+from articlefetch import ArticleFetcher, ResponseCache
+
+ARTICLE = (
+    '<html><head><title>t</title><script>var tracking = 1;</script></head><body>'
+    '<nav><a href="/">Home</a><a href="/about">About</a></nav>'
+    '<article><h1>見出し</h1><p>一段落目の本文です。</p><p>二段落目の本文です。</p></article>'
+    '<aside><p>関連記事の宣伝</p></aside><footer><p>Copyright</p></footer></body></html>'
+)
+HTML = {'Content-Type': 'text/html; charset=utf-8'}
+
+
+# テスト用のサーバーはループバックにあるので、プライベートアドレスへの接続を許可する
+def make_fetcher(tmp_path, **kwargs):
+    kwargs.setdefault('allow_private', True)
+    return ArticleFetcher(cache=ResponseCache(str(tmp_path / 'articles.sqlite3')), **kwargs)
+
+
+@pytest.fixture
+def closing():
+    fetchers = []
+    yield fetchers.append
+    for fetcher in fetchers:
+        fetcher.close()
+
+
+def test_extracts_main_content(stub_server, tmp_path, closing):
+    stub_server.routes['/article'] = lambda request: (200, HTML, ARTICLE)
+    fetcher = make_fetcher(tmp_path)
+    closing(fetcher)
+    assert fetcher.fetch(stub_server.url + '/article') == '見出し\n\n一段落目の本文です。\n\n二段落目の本文です。'
+
+
+def test_response_size_is_capped(stub_server, tmp_path, closing):
+    body = '<article>' + ''.join(f'<p>paragraph {i} ' + 'x' * 200 + '</p>' for i in range(2000)) + '</article>'
+    stub_server.routes['/large'] = lambda request: (200, HTML, body)
+    fetcher = make_fetcher(tmp_path, max_bytes=4096, max_tokens=100000)
+    closing(fetcher)
+    text = fetcher.fetch(stub_server.url + '/large')
+    assert text.startswith('paragraph 0 ')
+    assert len(text) < 4096
+    assert 'paragraph 1999' not in text
+
+
+def test_conditional_requests_reuse_cached_text(stub_server, tmp_path, closing):
+    state = {'etag': '"v1"', 'text': '<article><p>版1</p></article>'}
+
+    def route(request):
+        if request['headers'].get('If-None-Match') == state['etag']:
+            return 304, {'ETag': state['etag']}, b''
+        return 200, dict(HTML, ETag=state['etag'], **{'Last-Modified': 'Mon, 06 Nov 2023 10:00:00 GMT'}), state['text']
+
+    stub_server.routes['/page'] = route
+    url = stub_server.url + '/page'
+    # 再検証なしで使う期間を0にして、毎回条件付きリクエストを送る
+    fetcher = make_fetcher(tmp_path, fresh_seconds=0)
+    closing(fetcher)
+    assert fetcher.fetch(url) == '版1'
+    assert fetcher.fetch(url) == '版1'
+    second = stub_server.requests_to('/page')[1]
+    assert second['headers']['If-None-Match'] == '"v1"'
+    assert second['headers']['If-Modified-Since'] == 'Mon, 06 Nov 2023 10:00:00 GMT'
+
+    state.update(etag='"v2"', text='<article><p>版2</p></article>')
+    assert fetcher.fetch(url) == '版2'
+
+    # 新しいうちはリクエストを送らずキャッシュを使う
+    fresh = make_fetcher(tmp_path, fresh_seconds=3600)
+    closing(fresh)
+    assert fresh.fetch(url) == '版2'
+    assert len(stub_server.requests_to('/page')) == 3
+
+
+def test_per_host_concurrency_is_limited(stub_server, tmp_path, closing):
+    state = {'active': 0, 'peak': 0}
+    lock = threading.Lock()
+
+    def slow(request):
+        with lock:
+            state['active'] += 1
+            state['peak'] = max(state['peak'], state['active'])
+        time.sleep(0.2)
+        with lock:
+            state['active'] -= 1
+        return 200, HTML, '<article><p>本文</p></article>'
+
+    stub_server.routes['/slow'] = slow
+    fetcher = make_fetcher(tmp_path, per_host=2)
+    closing(fetcher)
+
+    async def fetch_all():
+        return await asyncio.gather(*(fetcher.afetch(f'{stub_server.url}/slow?n={n}') for n in range(6)))
+
+    assert asyncio.run(fetch_all()) == ['本文'] * 6
+    assert state['peak'] == 2
+
+
+@pytest.fixture
+def fetcher():
+    fetcher = ArticleFetcher(timeout=0.3, allow_private=True)
+    yield fetcher
+    fetcher.close()
+
+
+def test_article_fetch_timeout_returns_none(stub_server, fetcher):
+    def slow(request):
+        time.sleep(1)
+        return 200, {'Content-Type': 'text/html'}, '<article><p>late</p></article>'
+
+    stub_server.routes['/slow'] = slow
+    stub_server.routes['/ok'] = lambda request: (
+        200, {'Content-Type': 'text/html; charset=utf-8'}, '<article><p>本文</p></article>')
+    started = time.monotonic()
+    assert fetcher.fetch(stub_server.url + '/slow') is None
+    assert time.monotonic() - started < 0.9
+    # タイムアウトの後も同じセッションで取得できる
+    assert fetcher.fetch(stub_server.url + '/ok') == '本文'
+
+
+def test_article_fetch_errors_return_none(stub_server, fetcher):
+    stub_server.routes['/error'] = lambda request: (500, {}, 'boom')
+    stub_server.routes['/image'] = lambda request: (200, {'Content-Type': 'image/png'}, b'\x89PNG')
+    assert fetcher.fetch(stub_server.url + '/error') is None
+    assert fetcher.fetch(stub_server.url + '/missing') is None
+    assert fetcher.fetch(stub_server.url + '/image') is None
+    assert fetcher.fetch('ftp://example.com/file') is None
+    assert fetcher.fetch(None) is None
+    # 接続できないホスト
+    assert fetcher.fetch('http://127.0.0.1:9/') is None
+
+
+def test_refuses_private_and_link_local_addresses(stub_server, tmp_path, closing):
+    stub_server.routes['/internal'] = lambda request: (200, HTML, '<article><p>社内の情報</p></article>')
+    fetcher = make_fetcher(tmp_path, allow_private=False)
+    closing(fetcher)
+    port = stub_server.url.rsplit(':', 1)[-1]
+    assert fetcher.fetch(stub_server.url + '/internal') is None
+    # 名前解決の結果がループバックになるホスト名も拒否する
+    assert fetcher.fetch(f'http://localhost:{port}/internal') is None
+    assert fetcher.fetch(f'http://[::ffff:127.0.0.1]:{port}/internal') is None
+    assert fetcher.fetch('http://169.254.169.254/latest/meta-data/') is None
+    assert fetcher.fetch('http://10.0.0.1/') is None
+    assert fetcher.fetch('file:///etc/passwd') is None
+    assert stub_server.requests_to('/internal') == []
+
+
+def test_redirect_to_private_address_is_refused(stub_server, tmp_path, closing, monkeypatch):
+    # テスト用のサーバーだけを公開アドレスとして扱う
+    monkeypatch.setattr(articlefetch, 'is_public_address', lambda address: address == '127.0.0.1')
+    stub_server.routes['/moved'] = lambda request: (302, {'Location': '/article'}, b'')
+    stub_server.routes['/article'] = lambda request: (200, HTML, ARTICLE)
+    stub_server.routes['/metadata'] = lambda request: (
+        302, {'Location': 'http://169.254.169.254/latest/meta-data/'}, b'')
+    fetcher = make_fetcher(tmp_path, allow_private=False)
+    closing(fetcher)
+    assert fetcher.fetch(stub_server.url + '/moved').startswith('見出し')
+    assert fetcher.fetch(stub_server.url + '/metadata') is None
+    assert len(stub_server.requests_to('/metadata')) == 1
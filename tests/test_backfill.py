@@ -0,0 +1,71 @@
+import sys
+
+import pytest
+
+import backfill
+from archive import ArticleArchive
+from backfill import BackfillStore, custom_id, load_corpus
+
+# backtest.py（HNLoader）の出力と同じ形式（IDがなく、出典URLからIDを作る）
+HNLOADER_DUMP = (
+    "page_content='A new database engine' metadata={'source': 'https://example.com/db', 'title': 'DB'}\n\n"
+    "page_content='Rust 2.0 released' metadata={'source': 'https://example.com/rust', 'title': 'Rust'}\n\n"
+)
+
+
+def enrichment(index):
+    return {
+        'summary': f'要約{index}',
+        'opinion': f'意見{index}',
+        'lead': f'リード文{index}',
+        'categories': ['プログラミング'],
+    }
+
+
+def test_export_hnloader_corpus_to_archive(tmp_path, monkeypatch):
+    corpus = tmp_path / 'hn.txt'
+    corpus.write_text(HNLOADER_DUMP, encoding='utf-8')
+    db = str(tmp_path / 'backfill.sqlite3')
+    archive_dir = str(tmp_path / 'archive')
+    monkeypatch.setenv('ARCHIVE_DIR', archive_dir)
+
+    documents = load_corpus(str(corpus))
+    # IDは16文字の16進数の文字列になる
+    assert all(len(document['id']) == 16 for document in documents)
+    store = BackfillStore(db)
+    store.add_items(documents)
+    store.save_results([(custom_id(document['id'], 'enrich'), enrichment(index))
+                        for index, document in enumerate(documents)])
+    store.close()
+
+    monkeypatch.setattr(sys, 'argv', ['backfill.py', '--db', db, 'export', '--archive'])
+    backfill.main()
+
+    archive = ArticleArchive(archive_dir)
+    records = list(archive.scan())
+    assert len(records) == 2
+    for record in records:
+        assert record['id'] < 0
+        assert archive.get(record['id'])['summary'] == record['summary']
+    assert {record['title'] for record in records} == {'DB', 'Rust'}
+
+    # 2回目は書き出し済みなので何も追記しない
+    backfill.main()
+    assert len(list(archive.scan())) == 2
+
+
+def test_archive_rejects_batch_with_invalid_id_without_writing(tmp_path):
+    archive = ArticleArchive(str(tmp_path / 'archive'), codec='gzip')
+    good = {'id': 1, 'archived_at': 0, 'categories': []}
+    with pytest.raises(ValueError):
+        archive.extend([good, dict(good, id='93d8c81a064b7ef9')])
+    # フレームも索引も書かれていない
+    assert not [name for name in (tmp_path / 'archive').iterdir() if name.name.startswith('segment-')]
+    assert len(archive) == 0
+    assert archive.extend([good]) == 1
+    assert archive.get(1)['id'] == 1
+
+
+def test_archive_item_id_keeps_hn_ids():
+    assert backfill.archive_item_id('12345') == 12345
+    assert backfill.archive_item_id('93d8c81a064b7ef9') == backfill.archive_item_id('93d8c81a064b7ef9') < 0
@@ -0,0 +1,28 @@
+import numpy as np
+
+from categorizer import CategoryEngine
+
+TAXONOMY = {'AI': 'ai', 'セキュリティ': 'security', '宇宙': 'space', 'ゲーム': 'games', '科学': 'science'}
+
+
+# 各カテゴリとの類似度を指定した値にしたエンジン
+def engine_with_scores(scores):
+    engine = CategoryEngine(TAXONOMY, embed_fn=None)
+    engine.scores = lambda text: np.array(scores, dtype=np.float32)
+    return engine
+
+
+def test_unrelated_story_falls_back_to_llm():
+    # ada-002 では無関係な文どうしでも 0.7〜0.8 になる（以前の 0.78 では上位3件が割り当てられていた）
+    engine = engine_with_scores([0.79, 0.80, 0.78, 0.81, 0.79])
+    assert engine.assign('Local bakery wins a regional bread contest') is None
+
+
+def test_related_categories_clear_the_margin():
+    engine = engine_with_scores([0.84, 0.88, 0.78, 0.79, 0.79])
+    assert engine.assign('New exploit targets GPU drivers used for model training') == ['セキュリティ', 'AI']
+
+
+def test_uniformly_high_scores_are_not_enough():
+    engine = engine_with_scores([0.86, 0.87, 0.85, 0.86, 0.86])
+    assert engine.assign('A long essay that mentions every topic in passing') is None
@@ -0,0 +1,26 @@
+from chunking import strip_boilerplate
+
+
+def test_strips_navigation_and_copyright_lines():
+    text = '\n'.join([
+        'Skip to main content', 'Sign in', 'Subscribe now', 'Share this article', 'Share on Twitter',
+        'Follow us on Mastodon', 'Accept all cookies', 'Advertisement', 'Privacy Policy',
+        'The compiler now caches parsed headers.',
+        '© 2024 Example Media', 'Copyright 2024 Example Media. All rights reserved.',
+    ])
+    assert strip_boilerplate(text) == 'The compiler now caches parsed headers.'
+
+
+# 定型文と同じ語で始まる本文の文は消さない
+def test_keeps_sentences_that_start_with_boilerplate_words():
+    sentences = [
+        'Shares of Apple fell 5% after the earnings call.',
+        'Cookies are stored for thirty days.',
+        'Subscribers lost access to the archive on Monday.',
+        'Sign-in tokens now expire after an hour.',
+        'Log in attempts from new devices require a second factor.',
+        'Copyright law does not cover facts.',
+        'Following the outage, the team added a second region.',
+        'Advertisement revenue doubled year over year.',
+    ]
+    assert strip_boilerplate('\n'.join(sentences)) == '\n'.join(sentences)
@@ -0,0 +1,126 @@
+import os
+import signal
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from daemon import AdaptiveInterval, NewsDaemon, install_signal_handlers
+from pipeline import ThreadPipeline, Stage, shutdown
+
+
+# 新着ニュースの代わり（maxitem と未処理のIDだけを持つ）
+class FakeSource:
+    def __init__(self):
+        self.pending = []
+        self.max_item = 100
+        self.max_item_calls = 0
+
+    def add(self, count):
+        self.pending.extend(range(self.max_item + 1, self.max_item + count + 1))
+        self.max_item += count
+
+    def fetch_max_item(self):
+        self.max_item_calls += 1
+        return self.max_item
+
+
+class FakeStateStore:
+    def due_retries(self, limit):
+        return []
+
+
+# maindeploy と同じく、最大 MAX_ITEMS 件をパイプラインに流して処理した件数を返す
+class FakeRun:
+    def __init__(self, module, stages):
+        self.module = module
+        self.pipeline = ThreadPipeline(stages)
+        self.calls = 0
+        self.skipped = []
+
+    def __call__(self):
+        self.calls += 1
+        source = self.module.hn_source
+        batch, source.pending = source.pending[:self.module.MAX_ITEMS], source.pending[self.module.MAX_ITEMS:]
+        result = self.pipeline.run(((item_id, item_id) for item_id in batch), stop=shutdown)
+        # 停止で投入しなかった件は次回に回す
+        self.skipped.extend(result.skipped)
+        source.pending = result.skipped + source.pending
+        return len(result.completed)
+
+
+def make_module(max_items):
+    return SimpleNamespace(state_store=FakeStateStore(), hn_source=FakeSource(), MAX_ITEMS=max_items)
+
+
+@pytest.fixture
+def clean_shutdown():
+    handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGINT)}
+    shutdown.clear()
+    yield
+    shutdown.clear()
+    for signum, handler in handlers.items():
+        signal.signal(signum, handler)
+
+
+def test_interval_backs_off_when_idle_and_resets_when_busy(clean_shutdown):
+    module = make_module(max_items=3)
+    written = []
+    run_once = FakeRun(module, [Stage('write', written.append)])
+    daemon = NewsDaemon(module, run_once, AdaptiveInterval(1, 8, backoff=2, speedup=0.5))
+
+    # 最初の確認では maxitem が変わったとみなして1回処理する
+    assert daemon.poll() == 2
+    assert [daemon.poll() for _ in range(3)] == [4, 8, 8]
+    assert run_once.calls == 1
+    assert daemon.stats['unchanged'] == 3
+
+    module.hn_source.add(2)
+    assert daemon.poll() == 4
+    assert written == [101, 102]
+
+    # 1回で処理しきれないほど溜まっていれば下限に戻し、maxitem を見ずに続きを処理する
+    module.hn_source.add(7)
+    assert daemon.poll() == 1
+    max_item_calls = module.hn_source.max_item_calls
+    assert [daemon.poll(), daemon.poll()] == [1, 1]
+    assert module.hn_source.max_item_calls == max_item_calls
+    assert written == list(range(101, 110))
+    assert daemon.stats['stories'] == 9
+    assert daemon.poll() == 2
+
+
+def test_shutdown_signal_drains_in_flight_items(clean_shutdown):
+    module = make_module(max_items=10)
+    module.hn_source.add(10)
+    started = threading.Event()
+    release = threading.Event()
+    entered = []
+    written = []
+
+    def generate(item_id):
+        entered.append(item_id)
+        if item_id == 101:
+            started.set()
+            release.wait(5)
+        return item_id
+
+    run_once = FakeRun(module, [Stage('generate', generate, queue_size=1), Stage('write', written.append)])
+    daemon = NewsDaemon(module, run_once, AdaptiveInterval(0.01, 0.01))
+    install_signal_handlers()
+    stats = {}
+    thread = threading.Thread(target=lambda: stats.update(daemon.run()))
+    thread.start()
+    assert started.wait(5)
+
+    # 処理の途中で SIGTERM を受けても、投入済みの件を書き込んでから戻る
+    os.kill(os.getpid(), signal.SIGTERM)
+    assert shutdown.is_set()
+    release.set()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert stats['polls'] == 1
+    assert written == entered
+    assert 101 in written and 102 in written
+    assert run_once.skipped and sorted(written + run_once.skipped) == list(range(101, 111))
+    assert module.hn_source.pending == run_once.skipped
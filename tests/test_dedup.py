@@ -0,0 +1,42 @@
+from types import SimpleNamespace
+
+import pytest
+
+import dedup
+from dedup import DedupIndex
+
+ARTICLE = ('The new release of the compiler caches parsed headers between builds, '
+           'which cuts incremental build times for large C++ projects by about forty percent.')
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=1_000_000.0)
+    monkeypatch.setattr(dedup, 'time', SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+def test_expired_fingerprints_are_not_reused(tmp_path, clock):
+    index = DedupIndex(str(tmp_path / 'dedup.sqlite3'), max_age=100, compact_interval=None)
+    index.add(1, ARTICLE, {'summary': 's'})
+    assert index.find(ARTICLE)['item_id'] == 1
+    # 再起動しない常駐プロセスでも、保持期間を過ぎた生成結果は使わない
+    clock.now += 101
+    assert index.find(ARTICLE) is None
+
+
+def test_add_compacts_expired_fingerprints_periodically(tmp_path, clock):
+    path = str(tmp_path / 'dedup.sqlite3')
+    index = DedupIndex(path, max_age=100, compact_interval=50)
+    index.add(1, ARTICLE, {'summary': 's'})
+    index.add(2, 'An unrelated story about a small robot that waters houseplants on a schedule.', {})
+    clock.now += 120
+    index.add(3, 'Another unrelated story about city budgets and the cost of maintaining bridges.', {})
+    assert len(index) == 1
+    assert index._bands[0] and all(item_ids == [3] for item_ids in index._bands[0].values())
+    rows = index._conn.execute('SELECT item_id FROM fingerprints').fetchall()
+    assert rows == [(3,)]
+    # 同じ記事を登録し直すと保持期間が延び、また使われる
+    index.add(1, ARTICLE, {'summary': 't'})
+    assert index.find(ARTICLE)['enrichment'] == {'summary': 't'}
+    assert DedupIndex(path, max_age=100).find(ARTICLE)['item_id'] == 1
@@ -0,0 +1,66 @@
+import pytest
+
+from hnsource import HNItemSource
+
+
+# Firebase と同じく X-Firebase-ETag を付けたリクエストにだけ ETag を返し、一致すれば 304 を返す
+def firebase_route(value, etag):
+    def route(request):
+        if request['headers'].get('X-Firebase-ETag') != 'true':
+            return 200, {}, value()
+        if request['headers'].get('If-None-Match') == etag():
+            return 304, {'ETag': etag()}, b''
+        return 200, {'ETag': etag()}, value()
+    return route
+
+
+@pytest.fixture
+def hn(stub_server):
+    stories = {'ids': [101, 102, 103, 104, 105]}
+    stub_server.routes['/v0/maxitem.json'] = lambda request: (200, {}, max(stories['ids']))
+    stub_server.routes['/v0/newstories.json'] = firebase_route(
+        lambda: sorted(stories['ids'], reverse=True), lambda: f'"{len(stories["ids"])}"')
+    for item_id in range(101, 110):
+        stub_server.routes[f'/v0/item/{item_id}.json'] = (
+            lambda request, item_id=item_id: (200, {}, {'id': item_id, 'type': 'story', 'title': f'Story {item_id}',
+                                                        'text': 'a<p>b', 'dead': item_id == 103}))
+    source = HNItemSource(stub_server.url + '/v0', max_workers=4)
+    return stub_server, source, stories
+
+
+def test_newstories_is_fetched_conditionally(hn):
+    server, source, stories = hn
+    assert source.fetch_new_ids() == [101, 102, 103, 104, 105]
+    first = server.requests_to('/v0/newstories.json')[0]
+    assert first['headers']['X-Firebase-ETag'] == 'true'
+    assert 'If-None-Match' not in first['headers']
+
+    # コメントなどで maxitem だけが増えた場合は、newstories は 304 で前回の一覧を使う
+    server.routes['/v0/maxitem.json'] = lambda request: (200, {}, 106)
+    assert source.fetch_new_ids(watermark=103) == [104, 105]
+    second = server.requests_to('/v0/newstories.json')[1]
+    assert second['headers']['If-None-Match'] == '"5"'
+
+    # 一覧が変われば新しい ETag で全体を受け取る
+    stories['ids'].append(106)
+    assert source.fetch_new_ids(watermark=105) == [106]
+    assert len(server.requests_to('/v0/newstories.json')) == 3
+    assert source.fetch_new_ids(watermark=103, limit=2) == [104, 105]
+
+
+def test_unchanged_maxitem_skips_newstories(hn):
+    server, source, stories = hn
+    assert source.fetch_new_ids(watermark=105) == []
+    assert server.requests_to('/v0/newstories.json') == []
+    assert len(server.requests_to('/v0/maxitem.json')) == 1
+
+
+def test_fetch_new_returns_only_unseen_live_items(hn):
+    server, source, stories = hn
+    documents = source.fetch_new(watermark=101)
+    # 103 は dead なので除外される
+    assert [document['id'] for document in documents] == [102, 104, 105]
+    assert documents[0]['page_content'] == 'Story 102\n\na\n\nb'
+    fetched = {request['path'] for request in server.requests if request['path'].startswith('/v0/item/')}
+    assert fetched == {'/v0/item/102.json', '/v0/item/103.json', '/v0/item/104.json', '/v0/item/105.json'}
+
@@ -0,0 +1,83 @@
+from sheetwriter import BufferedSheetWriter
+
+
+class FakeRequest:
+    def __init__(self, result):
+        self.result = result
+
+    def execute(self):
+        return self.result()
+
+
+# spreadsheets.get と batchUpdate（appendCells・updateCells）だけを持つ Sheets API の代替
+class FakeSpreadsheets:
+    def __init__(self):
+        self.rows = [['', '', '', '', '', '', '', '', '', 100]]
+        self.bodies = []
+
+    def spreadsheets(self):
+        return self
+
+    def get(self, spreadsheetId, ranges, **kwargs):
+        watermark = self.rows[0][9]
+        return FakeRequest(lambda: {'sheets': [{
+            'properties': {'sheetId': 7},
+            'data': [{'rowData': [{'values': [{'formattedValue': str(watermark)}]}]}],
+        }]})
+
+    def batchUpdate(self, spreadsheetId, body):
+        def apply():
+            self.bodies.append(body)
+            for request in body['requests']:
+                if 'appendCells' in request:
+                    # サーバー側でその時点の末尾に追加される
+                    for row in request['appendCells']['rows']:
+                        self.rows.append([next(iter(cell.get('userEnteredValue', {'': None}).values())) for cell in row['values']])
+                else:
+                    cell = request['updateCells']['rows'][0]['values'][0]['userEnteredValue']
+                    self.rows[0][9] = cell['numberValue']
+            return {}
+        return FakeRequest(apply)
+
+
+def test_concurrent_writers_append_without_overwriting():
+    service = FakeSpreadsheets()
+    first = BufferedSheetWriter(service, 'sheet')
+    second = BufferedSheetWriter(service, 'sheet')
+    # 両方が書き込む前にメタデータを読む（以前は同じ行番号に書き込んで上書きしていた）
+    assert first.fetch_watermark() == '100'
+    assert second.fetch_watermark() == '100'
+    first.add_row(['t', 'a', 'b', 'c', 'd', 101])
+    second.add_row(['t', 'e', 'f', 'g', 'h', 102])
+    first.set_watermark(101)
+    second.set_watermark(102)
+    first.flush()
+    second.flush()
+
+    assert [row[5] for row in service.rows[1:]] == [101, 102]
+    assert service.rows[0][9] == 102
+    for body in service.bodies:
+        assert body['requests'][0]['appendCells']['sheetId'] == 7
+        assert not any('range' in request for request in body['requests'])
+    assert first.request_count == 2
+
+
+def test_flush_keeps_strings_raw_and_skips_empty_cells():
+    service = FakeSpreadsheets()
+    writer = BufferedSheetWriter(service, 'sheet')
+    writer.add_row(['=SUM(A1:A2)', None, 3])
+    writer.flush()
+    cells = service.bodies[0]['requests'][0]['appendCells']['rows'][0]['values']
+    assert cells == [{'userEnteredValue': {'stringValue': '=SUM(A1:A2)'}}, {}, {'userEnteredValue': {'numberValue': 3}}]
+    assert len(service.bodies[0]['requests']) == 1
+
+
+def test_sort_rows_orders_hn_rows_by_news_id():
+    service = FakeSpreadsheets()
+    writer = BufferedSheetWriter(service, 'sheet')
+    # パイプラインの完了順（フィードの記事は負のID）
+    for item_id in [105, -42, 101, 103, -7]:
+        writer.add_row(['t', 's', 'o', 'c', 'l', item_id])
+    writer.sort_rows()
+    writer.flush()
+    assert [row[5] for row in service.rows[1:]] == [101, 103, 105, -42, -7]
@@ -0,0 +1,83 @@
+from hnsource import HNItemSource
+from statestore import StateStore, STATUS_FAILED
+from sources import IngestScheduler, HNNewestSource, HNTopSource
+
+
+# 新着（newstories）とトップページ（topstories）のIDだけを返すHNの代替
+class FakeHNSource:
+    def __init__(self, new_ids, top_ids):
+        self.new_ids = new_ids
+        self.top_ids = top_ids
+        self.oldest_new_id = min(new_ids)
+
+    def fetch_new_ids(self, watermark=None, limit=None, filter_unseen=None):
+        new_ids = sorted(item_id for item_id in self.new_ids if watermark is None or item_id > watermark)
+        if filter_unseen is not None:
+            new_ids = filter_unseen(new_ids)
+        return new_ids[:limit] if limit else new_ids
+
+    def fetch_top_ids(self, limit=None):
+        return self.top_ids[:limit] if limit else self.top_ids
+
+
+# maindeploy.process_new_content と同じ順序で状態を記録する
+def run_once(scheduler, hn_source, store, limit):
+    batch = scheduler.next_batch(hn_source, store, store.watermark(), store.due_retries(limit), limit)
+    store.mark_pending(*batch.held_back)
+    store.mark_done(*[item_id for item_id, _ in batch.items])
+    return [item_id for item_id, _ in batch.items]
+
+
+def test_completed_top_story_does_not_skip_pending_newest(tmp_path):
+    store = StateStore(str(tmp_path / 'state.sqlite3'))
+    store.mark_polled(100)
+    store.mark_done(100)
+    # トップページの記事は、まだ取得していない新着（101〜106）より大きいID
+    hn_source = FakeHNSource(new_ids=[101, 102, 103, 104, 105, 106], top_ids=[900])
+    scheduler = IngestScheduler([HNTopSource(quota=1), HNNewestSource()])
+
+    first = run_once(scheduler, hn_source, store, limit=3)
+    assert first == [900, 101, 102]
+    assert store.watermark() == 102
+
+    processed = list(first)
+    while len(processed) < 7:
+        batch = run_once(scheduler, hn_source, store, limit=3)
+        assert batch
+        processed.extend(batch)
+    assert sorted(processed) == [101, 102, 103, 104, 105, 106, 900]
+    assert store.watermark() == 106
+
+
+def test_watermark_only_tracks_polled_ids(tmp_path):
+    store = StateStore(str(tmp_path / 'state.sqlite3'))
+    store.mark_polled(101, 102, 103)
+    store.mark_done(101, 102)
+    store.mark_pending(103)
+    store.mark_done(500)
+    # 未完了のトップページの記事（300）は新着の最新記事IDを止めない
+    store.mark_pending(300)
+    assert store.watermark() == 102
+    store.mark_done(103)
+    assert store.watermark() == 103
+
+
+def test_stuck_pending_id_outside_newstories_does_not_stall_ingestion(tmp_path, stub_server):
+    store = StateStore(str(tmp_path / 'state.sqlite3'))
+    # 予算で後回しにしたまま新着一覧（最新500件）から外れたID（50）と、その後に処理した100〜105
+    store.mark_polled(50, *range(100, 106))
+    store.mark_pending(50)
+    store.mark_done(*range(100, 106))
+    assert store.watermark() == 49
+
+    new_ids = list(range(100, 113))
+    stub_server.routes['/v0/maxitem.json'] = lambda request: (200, {}, max(new_ids))
+    stub_server.routes['/v0/newstories.json'] = lambda request: (200, {}, sorted(new_ids, reverse=True))
+    hn_source = HNItemSource(stub_server.url + '/v0')
+    scheduler = IngestScheduler([HNNewestSource()])
+
+    # 以前は最新記事IDより上の古い方から3件（100〜102、処理済み）だけを取得し、毎回何も処理しなかった
+    assert run_once(scheduler, hn_source, store, limit=3) == [106, 107, 108]
+    assert store.status(50) == STATUS_FAILED
+    assert store.watermark() == 108
+    assert run_once(scheduler, hn_source, store, limit=3) == [109, 110, 111]
@@ -0,0 +1,108 @@
+import json
+import threading
+from urllib.parse import parse_qs
+
+import pytest
+
+from wppublisher import WordPressPublisher, PublishState, STATE_PENDING
+
+API_PATH = '/wp-json/wp/v2/posts'
+
+
+# WordPress REST API の投稿エンドポイントの代わり（作成・更新・スラッグ検索）
+class MockWordPress:
+    def __init__(self, server):
+        self.server = server
+        self.posts = {}
+        # 作成は保存するが応答を失敗させる回数（タイムアウトの再現）
+        self.lose_create_responses = 0
+        self._lock = threading.Lock()
+        server.routes[API_PATH] = self.posts_route
+
+    def posts_route(self, request):
+        if request['method'] == 'GET':
+            slug = parse_qs(request['query']).get('slug', [None])[0]
+            return 200, {}, [post for post in self.posts.values() if slug is None or post['slug'] == slug]
+        with self._lock:
+            post_id = len(self.posts) + 1
+            self.posts[post_id] = dict(json.loads(request['body']), id=post_id)
+            self.server.routes[f'{API_PATH}/{post_id}'] = self.post_route
+            if self.lose_create_responses:
+                self.lose_create_responses -= 1
+                return 500, {}, {'code': 'internal_server_error'}
+        return 201, {}, self.posts[post_id]
+
+    def post_route(self, request):
+        post_id = int(request['path'].rsplit('/', 1)[-1])
+        with self._lock:
+            self.posts[post_id].update(json.loads(request['body']))
+        return 200, {}, self.posts[post_id]
+
+    def writes(self):
+        return [request for request in self.server.requests if request['method'] == 'POST']
+
+
+def sheet_row(item_id, lead, summary='要約です。', opinion='意見です。', categories='AI'):
+    return ['2024-01-01 09:00:00', summary, opinion, categories, lead, str(item_id)]
+
+
+@pytest.fixture
+def wordpress(stub_server):
+    return MockWordPress(stub_server)
+
+
+@pytest.fixture
+def state_path(tmp_path):
+    return str(tmp_path / 'wordpress.sqlite3')
+
+
+def make_publisher(stub_server, state_path):
+    return WordPressPublisher(stub_server.url + '/wp-json/wp/v2', PublishState(state_path),
+                              token='secret', max_workers=2)
+
+
+def test_publishes_only_new_and_changed_rows(stub_server, wordpress, state_path):
+    rows = [['日時', '要約', '意見', 'カテゴリ', 'リード文', 'ID'],
+            sheet_row(1, 'リード1'), sheet_row(2, 'リード2'), sheet_row(3, 'リード3', summary='要約できませんでした')]
+    publisher = make_publisher(stub_server, state_path)
+    assert publisher.publish(rows) == {'created': 2, 'updated': 0, 'failed': 0, 'unchanged': 0}
+    assert sorted(post['slug'] for post in wordpress.posts.values()) == ['hn-1', 'hn-2']
+    first = wordpress.writes()[0]
+    assert first['headers']['Authorization'] == 'Bearer secret'
+    assert first['headers']['Idempotency-Key'].startswith(json.loads(first['body'])['slug'] + ':')
+
+    # 公開状態はファイルに残るので、新しいプロセスでも変化のない行は送らない
+    publisher = make_publisher(stub_server, state_path)
+    rows[2] = sheet_row(2, 'リード2', summary='書き直した要約。')
+    rows.append(sheet_row(4, 'リード4'))
+    sent = len(stub_server.requests)
+    assert publisher.publish(rows) == {'created': 1, 'updated': 1, 'failed': 0, 'unchanged': 1}
+    assert len(stub_server.requests) - sent == 2
+    updated = next(post for post in wordpress.posts.values() if post['slug'] == 'hn-2')
+    assert '書き直した要約。' in updated['content']
+    assert stub_server.requests_to(f"{API_PATH}/{updated['id']}")
+
+    sent = len(stub_server.requests)
+    assert publisher.publish(rows)['unchanged'] == 3
+    assert len(stub_server.requests) == sent
+
+
+def test_lost_create_response_does_not_duplicate_post(stub_server, wordpress, state_path):
+    rows = [sheet_row(7, 'リード7')]
+    wordpress.lose_create_responses = 1
+    publisher = make_publisher(stub_server, state_path)
+    assert publisher.publish(rows)['failed'] == 1
+    assert publisher.state.load()['hn-7'][2] == STATE_PENDING
+
+    # 再実行ではスラッグで既存の投稿を見つけて更新する
+    assert publisher.publish(rows) == {'created': 0, 'updated': 1, 'failed': 0, 'unchanged': 0}
+    assert len(wordpress.posts) == 1
+    lookup = [request for request in stub_server.requests_to(API_PATH) if request['method'] == 'GET']
+    assert parse_qs(lookup[0]['query'])['slug'] == ['hn-7']
+    assert publisher.state.load()['hn-7'][0] == 1
+
+
+def test_feed_stories_are_not_published_as_hn_posts(stub_server, wordpress, state_path):
+    publisher = make_publisher(stub_server, state_path)
+    assert publisher.publish([sheet_row(-461168601842738790, 'フィードの記事'), sheet_row(8, 'リード8')])['created'] == 2
+    assert sorted(post['slug'] for post in wordpress.posts.values()) == ['feed-461168601842738790', 'hn-8']
@@ -0,0 +1,407 @@
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from llmcache import content_hash
+from metrics import metrics
+
+# 複数のインスタンスが同時に動いても同じニュースを二重に処理しないよう、
+# ニュースごとにリース（有効期限付きの処理権）を取ってから処理する
+# google-cloud-storage は GCS のバックエンドを使う時だけインポートする
+
+# リースの保存先（'' なら使わない、'sqlite' か 'gcs'）
+LEASE_BACKEND = os.getenv('LEASE_BACKEND', '')
+# SQLite のバックエンドのデフォルトの保存先（同じマシンの複数プロセスやテスト用）
+DEFAULT_LEASE_PATH = os.path.join(tempfile.gettempdir(), 'autonews_leases.sqlite3')
+# リースの有効秒数（Cloud Functions の最大実行時間より長くする）
+DEFAULT_LEASE_TTL = 600
+# 完了したリースを残す秒数
+DEFAULT_LEASE_RETENTION = 7 * 24 * 60 * 60
+
+# リースの状態
+LEASE_HELD = 'held'
+LEASE_RELEASED = 'released'
+LEASE_DONE = 'done'
+
+
+# 取得したリース
+# token はリースを取るたびに増える番号（フェンシングトークン）で、期限切れの後に
+# 別のインスタンスが取り直すと変わる。version はバックエンドの比較用（GCS の世代番号）
+class Lease:
+    def __init__(self, item_id, owner, token, expires_at, version=None):
+        self.item_id = item_id
+        self.owner = owner
+        self.token = token
+        self.expires_at = expires_at
+        self.version = version
+
+
+# リースを取れるかどうかを判定する関数（取れるなら True、完了済みなら LEASE_DONE、処理中なら False）
+def _claimable(record, owner, now):
+    if record is None:
+        return True
+    if record['status'] == LEASE_DONE:
+        return LEASE_DONE
+    if record['status'] == LEASE_HELD and record['expires_at'] > now and record['owner'] != owner:
+        return False
+    return True
+
+
+# 自分のシャードのIDを先に、それ以外（他のインスタンスが落ちた時の引き継ぎ分）を後に並べる関数
+def shard_order(item_ids, shard, shards):
+    if shards <= 1:
+        return list(item_ids)
+    return sorted(item_ids, key=lambda item_id: item_id % shards != shard)
+
+
+# SQLite にリースを保存するバックエンド
+# BEGIN IMMEDIATE で書き込みロックを取ってから判定するので、同じファイルを使う複数のプロセスでも安全
+class SQLiteLeaseBackend:
+    def __init__(self, path=DEFAULT_LEASE_PATH):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(
+            'CREATE TABLE IF NOT EXISTS leases ('
+            ' item_id INTEGER PRIMARY KEY,'
+            ' owner TEXT NOT NULL,'
+            ' token INTEGER NOT NULL,'
+            ' expires_at REAL NOT NULL,'
+            ' status TEXT NOT NULL,'
+            ' updated_at REAL NOT NULL);'
+            'CREATE INDEX IF NOT EXISTS leases_updated_at ON leases (updated_at);'
+        )
+
+    # 取れるだけのリースを取り、(取得したリース, 完了済みのID) を返す
+    def acquire(self, item_ids, owner, ttl, limit=None):
+        granted, finished = [], []
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                for item_id in item_ids:
+                    if limit is not None and len(granted) >= limit:
+                        break
+                    row = self._conn.execute(
+                        'SELECT owner, token, expires_at, status FROM leases WHERE item_id = ?',
+                        (item_id,)).fetchone()
+                    record = dict(zip(('owner', 'token', 'expires_at', 'status'), row)) if row else None
+                    claimable = _claimable(record, owner, now)
+                    if claimable == LEASE_DONE:
+                        finished.append(item_id)
+                        continue
+                    if not claimable:
+                        continue
+                    token = (record['token'] if record else 0) + 1
+                    self._conn.execute(
+                        'INSERT OR REPLACE INTO leases (item_id, owner, token, expires_at, status, updated_at) '
+                        'VALUES (?, ?, ?, ?, ?, ?)',
+                        (item_id, owner, token, now + ttl, LEASE_HELD, now),
+                    )
+                    granted.append(Lease(item_id, owner, token, now + ttl))
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        return granted, finished
+
+    # トークンが変わっていないリースだけを更新し、更新できたリースを返す
+    def _update(self, leases, status, expires_at=None):
+        updated = []
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                for lease in leases:
+                    new_expires_at = lease.expires_at if expires_at is None else expires_at
+                    cursor = self._conn.execute(
+                        'UPDATE leases SET status = ?, expires_at = ?, updated_at = ? '
+                        'WHERE item_id = ? AND token = ? AND status = ?',
+                        (status, new_expires_at, now, lease.item_id, lease.token, LEASE_HELD),
+                    )
+                    if cursor.rowcount:
+                        lease.expires_at = new_expires_at
+                        updated.append(lease)
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        return updated
+
+    def renew(self, leases, ttl):
+        return self._update(leases, LEASE_HELD, time.time() + ttl)
+
+    def complete(self, leases):
+        return self._update(leases, LEASE_DONE)
+
+    def release(self, leases):
+        return self._update(leases, LEASE_RELEASED, 0)
+
+    # まだ自分が持っているリースを返す（書き込み直前のフェンシングに使う）
+    def validate(self, leases):
+        held = []
+        with self._lock:
+            for lease in leases:
+                row = self._conn.execute(
+                    'SELECT token, status FROM leases WHERE item_id = ?', (lease.item_id,)).fetchone()
+                if row and row[0] == lease.token and row[1] == LEASE_HELD:
+                    held.append(lease)
+        return held
+
+    # 指定した秒数より古い、処理中でないリースを削除する
+    def compact(self, max_age):
+        with self._lock:
+            return self._conn.execute(
+                'DELETE FROM leases WHERE status != ? AND updated_at < ?',
+                (LEASE_HELD, time.time() - max_age),
+            ).rowcount
+
+    def close(self):
+        self._conn.close()
+
+
+# Cloud Storage にリースを保存するバックエンド（複数の Cloud Functions インスタンスで共有する）
+# ニュースごとに1つのオブジェクトを置き、世代番号の事前条件（if_generation_match）で
+# 読んだ時から変わっていない場合だけ書き換えるので、同じリースを2つのインスタンスが取ることはない
+class GCSLeaseBackend:
+    def __init__(self, bucket, prefix='leases/', client=None, max_workers=8):
+        if client is None:
+            from google.cloud import storage
+            client = storage.Client()
+        from google.api_core.exceptions import PreconditionFailed
+
+        self._precondition_failed = PreconditionFailed
+        self.bucket = client.bucket(bucket)
+        self.prefix = prefix
+        self.max_workers = max_workers
+
+    def _blob_name(self, item_id):
+        return f'{self.prefix}{item_id}.json'
+
+    def _read(self, item_id):
+        blob = self.bucket.get_blob(self._blob_name(item_id))
+        if blob is None:
+            return None, 0
+        return json.loads(blob.download_as_bytes(if_generation_match=blob.generation)), blob.generation
+
+    # 読んだ世代のままなら書き込み、新しい世代番号を返す（他のインスタンスに先を越されたら None）
+    def _write(self, item_id, record, generation):
+        blob = self.bucket.blob(self._blob_name(item_id))
+        try:
+            blob.upload_from_string(json.dumps(record), content_type='application/json',
+                                    if_generation_match=generation)
+        except self._precondition_failed:
+            return None
+        return blob.generation
+
+    def _acquire_one(self, item_id, owner, ttl):
+        try:
+            record, generation = self._read(item_id)
+        except self._precondition_failed:
+            return False
+        now = time.time()
+        claimable = _claimable(record, owner, now)
+        if claimable == LEASE_DONE or not claimable:
+            return claimable
+        token = (record['token'] if record else 0) + 1
+        new_record = {'owner': owner, 'token': token, 'expires_at': now + ttl, 'status': LEASE_HELD,
+                      'updated_at': now}
+        new_generation = self._write(item_id, new_record, generation)
+        if new_generation is None:
+            return False
+        return Lease(item_id, owner, token, now + ttl, new_generation)
+
+    # 1件ずつ数回のリクエストが必要なので、並行に取る（上限を超えて取れた分はすぐに返す）
+    def acquire(self, item_ids, owner, ttl, limit=None):
+        item_ids = list(item_ids)
+        if not item_ids:
+            return [], []
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(item_ids))) as executor:
+            results = list(executor.map(lambda item_id: self._acquire_one(item_id, owner, ttl), item_ids))
+        granted = [result for result in results if isinstance(result, Lease)]
+        finished = [item_id for item_id, result in zip(item_ids, results) if result == LEASE_DONE]
+        if limit is not None and len(granted) > limit:
+            self.release(granted[limit:])
+            granted = granted[:limit]
+        return granted, finished
+
+    def _update_one(self, lease, status, expires_at):
+        new_expires_at = lease.expires_at if expires_at is None else expires_at
+        record = {'owner': lease.owner, 'token': lease.token, 'expires_at': new_expires_at, 'status': status,
+                  'updated_at': time.time()}
+        # リースを取った後に書き換えられていれば、期限切れで別のインスタンスに取られている
+        generation = self._write(lease.item_id, record, lease.version)
+        if generation is None:
+            return None
+        lease.version = generation
+        lease.expires_at = new_expires_at
+        return lease
+
+    def _update(self, leases, status, expires_at=None):
+        leases = list(leases)
+        if not leases:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(leases))) as executor:
+            results = list(executor.map(lambda lease: self._update_one(lease, status, expires_at), leases))
+        return [lease for lease in results if lease is not None]
+
+    def renew(self, leases, ttl):
+        return self._update(leases, LEASE_HELD, time.time() + ttl)
+
+    def complete(self, leases):
+        return self._update(leases, LEASE_DONE)
+
+    def release(self, leases):
+        return self._update(leases, LEASE_RELEASED, 0)
+
+    # オブジェクトのメタデータだけを取得し、世代番号が変わっていないリースを返す
+    def validate(self, leases):
+        leases = list(leases)
+        if not leases:
+            return []
+
+        def check(lease):
+            blob = self.bucket.get_blob(self._blob_name(lease.item_id))
+            return blob is not None and blob.generation == lease.version
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(leases))) as executor:
+            return [lease for lease, held in zip(leases, executor.map(check, leases)) if held]
+
+    # 古いリースのオブジェクトはバケットのライフサイクルルールで削除する
+    def compact(self, max_age):
+        return 0
+
+    def close(self):
+        pass
+
+
+# ニュースのリースを取り、処理中は定期的に延長し、書き込み前に持っているかを確かめるクラス
+class WorkClaimer:
+    def __init__(self, backend, owner=None, ttl=DEFAULT_LEASE_TTL, shard=None, shards=1):
+        self.backend = backend
+        self.owner = owner or f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.ttl = ttl
+        self.shards = max(1, shards)
+        # シャード番号が指定されていなければインスタンスごとの名前から決める
+        if shard is None:
+            shard = int(content_hash(self.owner)[:8], 16) % self.shards
+        self.shard = shard
+        self._leases = {}
+        self._lock = threading.Lock()
+        # 延長と書き込み前の確認が同時に走ると世代番号の比較がずれるので、バックエンドの操作は順番に行う
+        self._backend_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    @classmethod
+    def from_env(cls):
+        if LEASE_BACKEND == 'sqlite':
+            backend = SQLiteLeaseBackend(os.getenv('LEASE_DB', DEFAULT_LEASE_PATH))
+        elif LEASE_BACKEND == 'gcs':
+            bucket = os.getenv('LEASE_BUCKET')
+            if not bucket:
+                raise ValueError("環境変数 'LEASE_BUCKET' が設定されていません。")
+            backend = GCSLeaseBackend(bucket, os.getenv('LEASE_PREFIX', 'leases/'))
+        elif LEASE_BACKEND:
+            raise ValueError(f"LEASE_BACKEND '{LEASE_BACKEND}' は使えません（'sqlite' か 'gcs'）。")
+        else:
+            return None
+        shard = os.getenv('LEASE_SHARD')
+        return cls(
+            backend,
+            ttl=float(os.getenv('LEASE_TTL', DEFAULT_LEASE_TTL)),
+            shard=int(shard) if shard else None,
+            shards=int(os.getenv('LEASE_SHARDS', '1')),
+        )
+
+    # IDのリースを自分のシャードから順に取り、(取れたID, 他のインスタンスが完了済みのID) を返す
+    # どちらにも入らないIDは他のインスタンスが処理中か、上限で試さなかったもの
+    def claim(self, item_ids, limit=None):
+        ordered = shard_order(item_ids, self.shard, self.shards)
+        granted, finished = self.backend.acquire(ordered, self.owner, self.ttl, limit)
+        with self._lock:
+            for lease in granted:
+                self._leases[lease.item_id] = lease
+        metrics.incr('lease_claims_total', len(granted), result='granted')
+        metrics.incr('lease_claims_total', len(finished), result='done')
+        metrics.incr('lease_claims_total', len(ordered) - len(granted) - len(finished), result='busy')
+        if granted:
+            self._start_heartbeat()
+        return [lease.item_id for lease in granted], finished
+
+    def held(self):
+        with self._lock:
+            return list(self._leases)
+
+    def _take(self, item_ids):
+        with self._lock:
+            return [self._leases.pop(item_id) for item_id in item_ids if item_id in self._leases]
+
+    def _lost(self, leases, kept):
+        kept_ids = {lease.item_id for lease in kept}
+        lost = [lease.item_id for lease in leases if lease.item_id not in kept_ids]
+        if lost:
+            print(f"Lost leases for items {lost}")
+            metrics.incr('lease_lost_total', len(lost))
+        return lost
+
+    # 書き込みの直前に呼び、まだリースを持っているIDを返す
+    # 期限切れの後に別のインスタンスが取り直したIDはトークンが変わっているので書き込まない
+    def fence(self, item_ids):
+        with self._lock:
+            leases = [self._leases[item_id] for item_id in item_ids if item_id in self._leases]
+        with self._backend_lock:
+            held = self.backend.validate(leases)
+        for item_id in self._lost(leases, held):
+            self._take([item_id])
+        return [lease.item_id for lease in held]
+
+    # 処理が完了したIDを記録し、他のインスタンスが再び処理しないようにする
+    def complete(self, item_ids):
+        leases = self._take(item_ids)
+        with self._backend_lock:
+            self._lost(leases, self.backend.complete(leases))
+
+    # 処理しなかった（失敗した）IDのリースを返し、すぐに他のインスタンスが取れるようにする
+    def release(self, item_ids=None):
+        leases = self._take(self.held() if item_ids is None else item_ids)
+        with self._backend_lock:
+            self.backend.release(leases)
+
+    def renew(self):
+        with self._lock:
+            leases = list(self._leases.values())
+        if not leases:
+            return
+        with self._backend_lock:
+            kept = self.backend.renew(leases, self.ttl)
+        self._take(self._lost(leases, kept))
+
+    # 有効期限の3分の1ごとにリースを延長するスレッドを（初回だけ）起動する
+    def _start_heartbeat(self):
+        with self._lock:
+            if self._heartbeat is not None:
+                return
+            self._heartbeat = threading.Thread(target=self._run_heartbeat, name='lease-heartbeat', daemon=True)
+        self._heartbeat.start()
+
+    def _run_heartbeat(self):
+        while not self._stop.wait(self.ttl / 3):
+            try:
+                self.renew()
+            except Exception as e:
+                print(f"Error renewing leases: {e}")
+
+    def compact(self, max_age=DEFAULT_LEASE_RETENTION):
+        return self.backend.compact(max_age)
+
+    def close(self):
+        self._stop.set()
+        self.release()
+        self.backend.close()
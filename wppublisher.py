@@ -0,0 +1,264 @@
+import os
+import json
+import html
+import time
+import sqlite3
+import tempfile
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from llmcache import content_hash
+from enrich import FAILURE_MESSAGES
+from metrics import metrics
+
+# スプレッドシートの行をWordPressに公開するジョブ
+# 以前の Apps Script の postToWordpress は毎時すべての行を送り直していたので廃止した
+# 代わりに `python wppublisher.py` を cron や Cloud Scheduler から定期実行する
+# （--source archive ならシートを読まずにローカルのアーカイブから送る）
+
+# 公開状態のデフォルトの保存先
+DEFAULT_PUBLISH_STATE_PATH = os.path.join(tempfile.gettempdir(), 'autonews_wordpress.sqlite3')
+# スプレッドシートから読む範囲（日時・要約・意見・カテゴリ・リード文・ニュースID）
+SHEET_RANGE = 'A:F'
+# 投稿タイトルの最大文字数
+TITLE_MAX_CHARS = 80
+
+# 投稿の状態
+STATE_PENDING = 'pending'
+STATE_PUBLISHED = 'published'
+
+
+# 投稿の識別子（WordPressのスラッグにも使う）
+# HNのニュースは hn-ID、フィードの記事（負のIDを持つ）は feed-IDの絶対値にする
+# フィード名は行に含まれないので、スプレッドシートとアーカイブのどちらから公開しても同じになるよう使わない
+# ニュースIDがない古い行は日時とリード文から識別子を作る
+def post_key(item_id, timestamp='', lead=''):
+    if not item_id:
+        return 'row-' + content_hash(timestamp + lead)[:16]
+    if item_id.startswith('-'):
+        return f'feed-{item_id[1:]}'
+    return f'hn-{item_id}'
+
+
+# スプレッドシートの1行を投稿の辞書に変換する関数（生成に失敗した行や空行は None）
+def row_to_post(row):
+    row = list(row) + [''] * (6 - len(row))
+    timestamp, summary, opinion, categories, lead, item_id = [str(value).strip() for value in row[:6]]
+    # 見出し行などの日時で始まらない行は飛ばす
+    if not timestamp[:1].isdigit():
+        return None
+    if not summary or not lead or summary in FAILURE_MESSAGES or lead in FAILURE_MESSAGES:
+        return None
+    key = post_key(item_id, timestamp, lead)
+    title = lead.splitlines()[0]
+    if len(title) > TITLE_MAX_CHARS:
+        title = title[:TITLE_MAX_CHARS - 1] + '…'
+    sections = [('', lead), ('要約', summary)]
+    if opinion and opinion not in FAILURE_MESSAGES:
+        sections.append(('意見', opinion))
+    if categories and categories not in FAILURE_MESSAGES:
+        sections.append(('カテゴリ', categories))
+    content = ''
+    for heading, text in sections:
+        if heading:
+            content += f'<h2>{html.escape(heading)}</h2>'
+        content += ''.join(f'<p>{html.escape(p.strip())}</p>' for p in text.split('\n\n') if p.strip())
+    return {'key': key, 'title': title, 'content': content}
+
+
+# 投稿ごとのWordPressの投稿IDと内容のハッシュを保存するクラス
+class PublishState:
+    def __init__(self, path=DEFAULT_PUBLISH_STATE_PATH):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS posts ('
+            ' key TEXT PRIMARY KEY,'
+            ' post_id INTEGER,'
+            ' content_hash TEXT NOT NULL,'
+            ' status TEXT NOT NULL,'
+            ' updated_at REAL NOT NULL)'
+        )
+
+    @classmethod
+    def from_env(cls):
+        return cls(os.getenv('WP_STATE_PATH', DEFAULT_PUBLISH_STATE_PATH))
+
+    # key -> (投稿ID, ハッシュ, 状態)
+    def load(self):
+        with self._lock:
+            rows = self._conn.execute('SELECT key, post_id, content_hash, status FROM posts').fetchall()
+        return {key: (post_id, digest, status) for key, post_id, digest, status in rows}
+
+    def save(self, key, post_id, digest, status):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO posts (key, post_id, content_hash, status, updated_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (key, post_id, digest, status, time.time()),
+            )
+
+    def close(self):
+        self._conn.close()
+
+
+# 新しい投稿と内容が変わった投稿だけをWordPressに送るクラス
+# 変化のない投稿はローカルのハッシュ比較だけで飛ばすので、リクエスト数はシートの行数に比例しない
+class WordPressPublisher:
+    def __init__(self, api_url, state, auth=None, token=None, post_status='publish', max_workers=4,
+                 timeout=30, session=None):
+        self.api_url = api_url.rstrip('/')
+        self.state = state
+        self.post_status = post_status
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.request_count = 0
+        # キープアライブ接続をプールして使い回すセッション
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        if token:
+            session.headers['Authorization'] = f'Bearer {token}'
+        if auth:
+            session.auth = auth
+        self.session = session
+
+    @classmethod
+    def from_env(cls):
+        api_url = os.getenv('WP_API_URL')
+        if not api_url:
+            return None
+        auth = None
+        if os.getenv('WP_USER') and os.getenv('WP_APP_PASSWORD'):
+            auth = (os.getenv('WP_USER'), os.getenv('WP_APP_PASSWORD'))
+        return cls(
+            api_url,
+            PublishState.from_env(),
+            auth=auth,
+            token=os.getenv('WP_TOKEN'),
+            post_status=os.getenv('WP_POST_STATUS', 'publish'),
+            max_workers=int(os.getenv('WP_MAX_WORKERS', '4')),
+        )
+
+    def _request(self, method, path, **kwargs):
+        response = self.session.request(method, f'{self.api_url}/{path}', timeout=self.timeout, **kwargs)
+        self.request_count += 1
+        response.raise_for_status()
+        return response.json()
+
+    def _payload(self, post):
+        return {'title': post['title'], 'content': post['content'], 'status': self.post_status,
+                'slug': post['key']}
+
+    # 前回の作成が完了したか分からない投稿を、スラッグで探す
+    def _find_by_slug(self, slug):
+        posts = self._request('GET', 'posts', params={'slug': slug, 'status': 'any', 'context': 'edit'})
+        return posts[0]['id'] if posts else None
+
+    def _publish_one(self, post, digest, known):
+        key = post['key']
+        post_id, _, status = known or (None, None, None)
+        # 前回の作成が途中で失敗していれば、二重投稿しないよう先に既存の投稿を探す
+        if post_id is None and status == STATE_PENDING:
+            post_id = self._find_by_slug(key)
+        headers = {'Idempotency-Key': f'{key}:{digest}'}
+        if post_id is None:
+            self.state.save(key, None, digest, STATE_PENDING)
+            post_id = self._request('POST', 'posts', json=self._payload(post), headers=headers)['id']
+            action = 'created'
+        else:
+            self._request('POST', f'posts/{post_id}', json=self._payload(post), headers=headers)
+            action = 'updated'
+        self.state.save(key, post_id, digest, STATE_PUBLISHED)
+        metrics.incr('wordpress_posts_total', action=action)
+        return action
+
+    # 新しい投稿と変更された投稿を (投稿, ハッシュ, 既存の状態) のリストで返す
+    def plan(self, rows):
+        known = self.state.load()
+        changes = {}
+        for row in rows:
+            post = row_to_post(row)
+            if post is None:
+                continue
+            digest = content_hash(json.dumps(self._payload(post), ensure_ascii=False, sort_keys=True))
+            previous = known.get(post['key'])
+            if previous and previous[2] == STATE_PUBLISHED and previous[1] == digest:
+                continue
+            # 同じ投稿が複数行にある場合は後の行を優先する
+            changes[post['key']] = (post, digest, previous)
+        return list(changes.values())
+
+    # 行のうち新しいものと変更されたものだけを並行に送信し、件数を返す
+    def publish(self, rows):
+        rows = list(rows)
+        changes = self.plan(rows)
+        counts = {'created': 0, 'updated': 0, 'failed': 0, 'unchanged': 0}
+        if changes:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(changes))) as executor:
+                futures = [executor.submit(self._publish_one, *change) for change in changes]
+                for (post, _, _), future in zip(changes, futures):
+                    try:
+                        counts[future.result()] += 1
+                    except Exception as e:
+                        print(f"Error publishing {post['key']} to WordPress: {e}")
+                        metrics.incr('wordpress_posts_total', action='failed')
+                        counts['failed'] += 1
+        keys = {post['key'] for post in map(row_to_post, rows) if post}
+        counts['unchanged'] = len(keys) - len(changes)
+        return counts
+
+
+# スプレッドシートから処理済みの行をすべて読む関数
+def read_sheet_rows(service, spreadsheet_id, sheet_range=SHEET_RANGE):
+    result = service.spreadsheets().values().get(
+        spreadsheetId=spreadsheet_id, range=sheet_range).execute()
+    return result.get('values', [])
+
+
+# ローカルのアーカイブから直近の記録を行として読む関数（スプレッドシート全体を取得しない）
+def read_archive_rows(days):
+    from archive import ArticleArchive, DEFAULT_ARCHIVE_DIR, record_to_row
+
+    archive = ArticleArchive(os.getenv('ARCHIVE_DIR', DEFAULT_ARCHIVE_DIR))
+    return [record_to_row(record) for record in archive.scan(since=time.time() - days * 24 * 60 * 60)]
+
+
+# スプレッドシート全体（またはアーカイブの直近の記録）を読み、新しい行と変更された行だけを公開する
+# （Apps Script の postToWordpress を毎時実行する代わりにこれを定期実行する）
+def main():
+    parser = argparse.ArgumentParser(description='スプレッドシートの行をWordPressに差分だけ公開する')
+    parser.add_argument('--dry-run', action='store_true', help='送信せずに新規・変更の件数だけを表示する')
+    parser.add_argument('--source', default=os.getenv('WP_SOURCE', 'sheet'), choices=['sheet', 'archive'],
+                        help='読み込む場所（archive ならローカルのアーカイブ）')
+    parser.add_argument('--days', type=float, default=7, help='アーカイブから読む日数')
+    args = parser.parse_args()
+
+    publisher = WordPressPublisher.from_env()
+    if publisher is None:
+        raise ValueError("環境変数 'WP_API_URL' が設定されていません。")
+    if args.source == 'archive':
+        rows = read_archive_rows(args.days)
+    else:
+        # 認証情報とスプレッドシートIDはデプロイ用の設定を使う
+        from maindeploy import get_service, SPREADSHEET_ID
+
+        rows = read_sheet_rows(get_service(), SPREADSHEET_ID)
+    if args.dry_run:
+        print(json.dumps({'rows': len(rows), 'changes': len(publisher.plan(rows))}))
+        return
+    try:
+        print(json.dumps(publisher.publish(rows)))
+    finally:
+        metrics.flush()
+
+
+if __name__ == '__main__':
+    main()